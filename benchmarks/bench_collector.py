@@ -0,0 +1,195 @@
+"""
+End-to-end benchmark of the plugin's backfill and steady-state polls against a simulated ELB and
+CloudWatch backend (tests.fake_aws), so no AWS account or network access is needed.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.bench_collector --regions 8 --elbs-per-region 40 --backfill-hours 2 --output results.json
+
+Results are printed as JSON (and optionally written to a file) so they can be compared across versions.
+Note that the time spent generating fake responses is included in the measured latencies.
+
+With --collector async, CloudWatch is served over HTTP by a local stub server (FakeCloudwatchServer), which
+also checks the requests' signatures.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from boundary_aws_plugin import boundary_plugin
+from boundary_aws_plugin import status_store
+from boundary_aws_plugin.cloudwatch_plugin import CloudwatchPlugin
+from boundary_aws_plugin.derived_metrics import DerivedMetrics
+from boundary_aws_plugin.poll_scheduler import PollScheduler
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from tests.fake_aws import FakeAws, FakeCloudwatchServer, FakeElbCloudwatchMetrics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class LineCounter(object):
+    """
+    Stands in for stdout, counting the metric lines written to it.
+    """
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, out):
+        self.lines += out.count('\n')
+
+    def flush(self):
+        pass
+
+
+def measure(func, fake_aws, line_counter, trace_memory):
+    """
+    Runs func, returning a dictionary of measurements.  With trace_memory, only the peak memory use is measured,
+    since tracing slows everything else down considerably.
+    """
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            func()
+            return dict(peak_memory=tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+    calls_before = fake_aws.get_calls()
+    lines_before = line_counter.lines
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    calls = fake_aws.get_calls()
+    api_calls = dict((action, count - calls_before.get(action, 0)) for action, count in calls.items())
+    lines = line_counter.lines - lines_before
+    return dict(latency=elapsed, api_calls=api_calls,
+                total_api_calls=sum(count for action, count in api_calls.items() if action != 'Throttled'),
+                output_lines=lines, output_lines_per_second=lines / elapsed if elapsed else None)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--regions', type=int, default=8, help='number of regions')
+    parser.add_argument('--elbs-per-region', type=int, default=40, help='number of load balancers in each region')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated latency of each API call, in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of API calls that are throttled')
+    parser.add_argument('--density', type=float, default=1.0, help='fraction of CloudWatch periods with a datapoint')
+    parser.add_argument('--backfill-hours', type=float, default=2.0, help='length of the simulated outage to backfill')
+    parser.add_argument('--polls', type=int, default=3, help='number of steady-state polls to measure')
+    parser.add_argument('--fetch-backend', default='batched', choices=('batched', 'statistics'))
+    parser.add_argument('--collector', default='threads', choices=('threads', 'async'))
+    parser.add_argument('--region-workers', type=int, default=4)
+    parser.add_argument('--metric-workers', type=int, default=8)
+    parser.add_argument('--api-rate-limit', type=float, default=1000.0)
+    parser.add_argument('--output', help='file to write the JSON results to')
+    return parser.parse_args(argv)
+
+
+def run_phases(args, trace_memory=False):
+    """
+    Runs the backfill and steady-state phases against a new fake AWS account.
+    """
+    fake_aws = FakeAws(region_count=args.regions, load_balancers_per_region=args.elbs_per_region,
+                       latency=args.latency, throttle_rate=args.throttle_rate, density=args.density)
+    basename = 'bench-collector-%d' % os.getpid()
+    server = None
+    if args.collector == 'async':
+        server = FakeCloudwatchServer(fake_aws.cloudwatch, 'benchmark', 'benchmark-secret').start()
+    plugin = CloudwatchPlugin(None, '', basename)
+    plugin.cloudwatch_metrics = FakeElbCloudwatchMetrics(
+        fake_aws, 'benchmark', 'benchmark-secret', region_workers=args.region_workers,
+        metric_workers=args.metric_workers, fetch_backend=args.fetch_backend, entity_cache_ttl=3600,
+        empty_region_ttl=3600, connections=fake_aws.connection_registry(),
+        rate_limiter=RateLimiter(args.api_rate_limit, base_delay=0.05, max_delay=1.0),
+        collector=args.collector, cloudwatch_endpoint=server and server.endpoint)
+    plugin.derived_metrics = DerivedMetrics(plugin.cloudwatch_metrics.get_derived_metrics())
+    if server and trace_memory:
+        # Tracing slows the stub server down along with everything else.
+        plugin.cloudwatch_metrics.async_collector.timeout = 600
+
+    reported_metrics = status_store.StatusStore(basename)
+    # Pretend the plugin last reported something before the outage.
+    region = fake_aws.regions[0].name
+    reported_metrics[(region, '%s-elb-0' % region, 'AWS_ELB_REQUEST_COUNT')] = (
+        datetime.datetime.utcnow() - datetime.timedelta(hours=args.backfill_hours, minutes=-20), 0.0, 'Sum')
+
+    def steady_state():
+        for _ in range(args.polls):
+            # Simulate a minute passing since the last poll: every metric has one new sample, and a fresh
+            # scheduler considers every metric due.
+            for metric_key, (timestamp, value, statistic) in list(reported_metrics.items()):
+                reported_metrics[metric_key] = (timestamp - datetime.timedelta(minutes=1), value, statistic)
+            plugin.scheduler = PollScheduler(60)
+            plugin.poll(reported_metrics)
+
+    line_counter = LineCounter()
+    stdout, sys.stdout = sys.stdout, line_counter
+    try:
+        return dict(
+            backfill=measure(lambda: plugin.backfill(reported_metrics), fake_aws, line_counter, trace_memory),
+            steady_state=measure(steady_state, fake_aws, line_counter, trace_memory))
+    finally:
+        sys.stdout = stdout
+        plugin.cloudwatch_metrics.close()
+        if server:
+            server.stop()
+        try:
+            os.remove(status_store.status_store_filename(basename))
+        except OSError:
+            pass
+
+
+def run(args):
+    results = run_phases(args)
+    if tracemalloc:
+        for phase, memory in run_phases(args, trace_memory=True).items():
+            results[phase].update(memory)
+    else:
+        # Python 2: only the peak resident set size of the whole process is available.
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        for phase in results.values():
+            phase['peak_memory'] = peak_rss
+
+    steady_state = results['steady_state']
+    steady_state['latency_per_poll'] = steady_state['latency'] / args.polls
+    steady_state['api_calls_per_poll'] = steady_state['total_api_calls'] / args.polls
+    for phase, result in sorted(results.items()):
+        sys.stderr.write('%s: %.2fs, %d API calls, %d lines, peak memory %.1f MB\n' %
+                         (phase, result['latency'], result['total_api_calls'], result['output_lines'],
+                          result['peak_memory'] / 1e6))
+    return dict(benchmark='collector', revision=git_revision(), python=platform.python_version(),
+                timestamp=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                config=vars(args), results=results)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+    boundary_plugin.HOSTNAME = 'benchmark'
+    output = json.dumps(run(args), indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
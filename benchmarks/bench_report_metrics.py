@@ -0,0 +1,74 @@
+"""
+Measures how many metric lines per second the plugin can write to the Boundary relay, reporting
+them one at a time (as the plugin used to, and with the current in-process lock) and in batches.
+
+Run from the repository root:
+    python -m benchmarks.bench_report_metrics
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from boundary_aws_plugin import boundary_plugin
+
+LINE_COUNT = 200000
+
+# Earlier versions shared a lock with the keepalive subprocess.
+legacy_lock = multiprocessing.Lock()
+
+
+def legacy_report_metric(name, value, source=None, timestamp=None):
+    """
+    boundary_report_metric as it was before batching: lock, format, print, flush and reopen the log
+    file for every metric.
+    """
+    with legacy_lock:
+        source = source or boundary_plugin.HOSTNAME
+        if timestamp:
+            timestamp = boundary_plugin.unix_time_millis(timestamp)
+        out = "%s %s %s%s" % (name, value, source, (' %d' % timestamp) if timestamp else '')
+        print(out)
+        sys.stdout.flush()
+
+        if boundary_plugin.metric_log_file:
+            with open(boundary_plugin.metric_log_file, 'a') as f:
+                f.write(out + "\n")
+
+
+def make_metrics(count):
+    start = datetime.datetime(2015, 1, 1)
+    return [('AWS_ELB_REQUEST_COUNT', float(i), 'elb-%d' % (i % 300), start + datetime.timedelta(minutes=i // 300))
+            for i in range(count)]
+
+
+def bench(name, func, metrics):
+    start = time.time()
+    func(metrics)
+    elapsed = time.time() - start
+    sys.stderr.write('%-20s %10.0f lines/s\n' % (name, len(metrics) / elapsed))
+
+
+def main():
+    metrics = make_metrics(LINE_COUNT)
+    log_filename = os.path.join(tempfile.gettempdir(), 'bench-report-metrics-%d.log' % os.getpid())
+    boundary_plugin.log_metrics_to_file(log_filename)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        bench('one at a time', lambda m: [legacy_report_metric(*metric) for metric in m], metrics)
+        bench('in-process lock', lambda m: [boundary_plugin.boundary_report_metric(*metric) for metric in m], metrics)
+        bench('batched', boundary_plugin.boundary_report_metrics, metrics)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        boundary_plugin.log_metrics_to_file(None)
+        os.remove(log_filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Compares the memory used by a day of collected samples held in a SeriesStore against the dictionary of
+(Timestamp, Value, Statistic) tuples it replaced, and the time handle_metrics takes to pick out the samples
+newer than the status store's, order them for reporting and update the status store.
+
+Run from the repository root:
+    python -m benchmarks.bench_series_store
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import itertools
+import operator
+import time
+import tracemalloc
+
+from boundary_aws_plugin.boundary_plugin import unix_time
+from boundary_aws_plugin.series_store import SeriesStore
+
+SERIES_COUNTS = (100, 1000)
+
+"""
+Samples per series: a day at a 60-second resolution, as retrieved by a backfill.
+"""
+SAMPLES_PER_SERIES = 1440
+
+START_TIME = datetime.datetime(2015, 1, 1)
+
+
+def series_keys(series_count):
+    return [('us-east-1', 'elb-%d' % (i // 13), 'AWS_ELB_METRIC_%d' % (i % 13)) for i in range(series_count)]
+
+
+def make_dict(series_count):
+    timestamps = [START_TIME + datetime.timedelta(minutes=minute) for minute in range(SAMPLES_PER_SERIES)]
+    # As parsed from responses: a separate datetime and float object for every sample.
+    return dict((key, [(timestamp + datetime.timedelta(0), float(i + n), 'Sum')
+                       for n, timestamp in enumerate(timestamps)])
+                for i, key in enumerate(series_keys(series_count)))
+
+
+def make_store(series_count):
+    timestamps = [unix_time(START_TIME) + minute * 60 for minute in range(SAMPLES_PER_SERIES)]
+    out = SeriesStore()
+    for i, key in enumerate(series_keys(series_count)):
+        out.extend(key, 'Sum', timestamps, [float(i + n) for n in range(SAMPLES_PER_SERIES)])
+    return out
+
+
+def measure(func, *args):
+    """
+    Returns the memory allocated by the result of func(*args), the time the call took, and the result.
+    """
+    tracemalloc.start()
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory, elapsed, result
+
+
+def dict_ingest(data, reported_metrics):
+    # The per-sample loop handle_metrics used to run.
+    out = []
+    for metric_key, metric_list in data.items():
+        for item in metric_list:
+            if reported_metrics.get(metric_key, (datetime.datetime.min,)) >= item:
+                continue
+            out.append(('AWS_ELB_' + metric_key[2], item[1], metric_key[1], item[0]))
+            reported_metrics[metric_key] = item
+    return out
+
+
+def store_ingest(data, reported_metrics):
+    # As in CloudwatchPlugin.handle_metrics.
+    new_data = data.select_after(reported_metrics)
+    out = []
+    for metric_key, statistic, timestamps, values in new_data.series():
+        out.extend(zip(itertools.repeat('AWS_ELB_' + metric_key[2]), values, itertools.repeat(metric_key[1]),
+                       timestamps))
+    out.sort(key=operator.itemgetter(3))
+    reported_metrics.update(new_data.latest_samples())
+    return out
+
+
+def bench(series_count):
+    datapoints = series_count * SAMPLES_PER_SERIES
+    dict_memory, dict_build, data = measure(make_dict, series_count)
+    store_memory, store_build, store = measure(make_store, series_count)
+
+    # Half of each series has already been reported.  (The watermark falls between samples: the two differ
+    # on samples sharing its timestamp.)
+    watermark = START_TIME + datetime.timedelta(minutes=SAMPLES_PER_SERIES // 2, seconds=30)
+    reported_metrics = dict((key, (watermark, 0.0, 'Sum')) for key in series_keys(series_count))
+    start = time.time()
+    dict_out = dict_ingest(data, dict(reported_metrics))
+    dict_select = time.time() - start
+    start = time.time()
+    store_out = store_ingest(store, dict(reported_metrics))
+    store_select = time.time() - start
+    assert len(dict_out) == len(store_out)
+
+    return dict(series=series_count, datapoints=datapoints,
+                dict_bytes=dict_memory / datapoints, store_bytes=store_memory / datapoints,
+                ratio=dict_memory / store_memory, dict_build=dict_build, store_build=store_build,
+                dict_select=dict_select, store_select=store_select)
+
+
+def main():
+    for series_count in SERIES_COUNTS:
+        results = bench(series_count)
+        print('%(series)5d series, %(datapoints)7d datapoints: '
+              'dict %(dict_bytes).1f bytes/datapoint, series store %(store_bytes).1f bytes/datapoint (%(ratio).1fx less) | '
+              'build dict %(dict_build).3fs store %(store_build).3fs | '
+              'handle new samples dict %(dict_select).3fs store %(store_select).3fs' % results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Startup benchmark: time from launching the plugin to its first metric line, against a simulated ELB and
+CloudWatch backend (tests.fake_aws), so no AWS account or network access is needed.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.bench_startup --regions 8 --elbs-per-region 40 --discovery-latency 0.5
+
+Each run starts the plugin in a new process, as the relay does, and is measured in three situations:
+    cold: no status store and no topology snapshot (first start)
+    restart: a status store but no topology snapshot (a restart with versions before the snapshot)
+    warm: a status store and a topology snapshot
+For restarts, the status store is aged as if the plugin had been down for a few minutes, so that there is
+something to report.
+The time taken to start the interpreter and import the plugin is reported separately.  boto isn't used, so
+the time it takes to import is not included.
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from boundary_aws_plugin import boundary_plugin
+from boundary_aws_plugin import status_store
+from boundary_aws_plugin import topology_snapshot
+from boundary_aws_plugin.cloudwatch_plugin import CloudwatchPlugin
+from elb_plugin import ElbCloudwatchMetrics
+from tests.fake_aws import FakeAws
+from .bench_collector import git_revision
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StartupElbCloudwatchMetrics(ElbCloudwatchMetrics):
+    """
+    ElbCloudwatchMetrics against the fake AWS account of a child process.
+    """
+    fake_aws = None
+
+    def __init__(self, access_key_id, secret_access_key, **kwargs):
+        kwargs['connections'] = self.fake_aws.connection_registry()
+        super(StartupElbCloudwatchMetrics, self).__init__(access_key_id, secret_access_key, **kwargs)
+
+    def get_region_list(self):
+        return self.fake_aws.regions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--regions', type=int, default=8, help='number of regions')
+    parser.add_argument('--elbs-per-region', type=int, default=40, help='number of load balancers in each region')
+    parser.add_argument('--discovery-latency', type=float, default=0.5,
+                        help='simulated latency of each ELB API call, in seconds')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='simulated latency of each CloudWatch API call, in seconds')
+    parser.add_argument('--region-workers', type=int, default=4)
+    parser.add_argument('--downtime', type=float, default=5.0,
+                        help='minutes the plugin is down for before each restart')
+    parser.add_argument('--runs', type=int, default=3, help='number of runs of each situation')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--child', metavar='BASENAME', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def child_main(args):
+    """
+    Runs the plugin, as started by the relay, against a fake AWS account.
+    """
+    fake_aws = FakeAws(region_count=args.regions, load_balancers_per_region=args.elbs_per_region)
+    fake_aws.elb.latency, fake_aws.cloudwatch.latency = args.discovery_latency, args.latency
+    StartupElbCloudwatchMetrics.fake_aws = fake_aws
+    boundary_plugin.HOSTNAME = 'benchmark'
+    CloudwatchPlugin(StartupElbCloudwatchMetrics, '', args.child).main()
+
+
+def start_child(args, workdir, basename, stdout=subprocess.PIPE):
+    command = [sys.executable, '-u', '-m', 'benchmarks.bench_startup', '--child', basename,
+               '--regions', str(args.regions), '--elbs-per-region', str(args.elbs_per_region),
+               '--discovery-latency', str(args.discovery_latency), '--latency', str(args.latency)]
+    env = dict(os.environ, PYTHONPATH=REPOSITORY_ROOT)
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=stdout)
+
+
+def stop_child(child):
+    if child.poll() is None:
+        child.terminate()
+    if child.stdout:
+        child.stdout.close()
+    child.wait()
+
+
+def time_to_first_metric(args, workdir, basename):
+    """
+    Starts the plugin, returning the time it took to report its first metric (not counting keepalives).
+    """
+    start = time.time()
+    child = start_child(args, workdir, basename)
+    try:
+        for line in iter(child.stdout.readline, b''):
+            if not line.startswith(b'BOGUS_METRIC'):
+                return time.time() - start
+        raise RuntimeError("Plugin exited with code %s without reporting a metric" % child.wait())
+    finally:
+        stop_child(child)
+
+
+def save_snapshot(args, workdir, basename):
+    """
+    Runs the plugin until it has saved a topology snapshot (after its first poll).
+    """
+    # Nobody reads the output, so it mustn't fill up a pipe.
+    with open(os.devnull, 'wb') as devnull:
+        child = start_child(args, workdir, basename, devnull)
+    try:
+        while not os.path.exists(topology_snapshot.topology_snapshot_filename(basename)):
+            if child.poll() is not None:
+                raise RuntimeError("Plugin exited with code %s without saving a snapshot" % child.returncode)
+            time.sleep(0.05)
+    finally:
+        stop_child(child)
+
+
+def age_status_store(basename, minutes):
+    """
+    Moves the last sample reported for every metric back, as if the plugin had been down for that long.
+    """
+    delta = datetime.timedelta(minutes=minutes)
+    status_store.save_status_store(basename, dict(
+        (key, (timestamp - delta, value, statistic))
+        for key, (timestamp, value, statistic) in status_store.load_status_store(basename).items()))
+
+
+def time_imports():
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import elb_plugin'], cwd=REPOSITORY_ROOT)
+    return time.time() - start
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(args):
+    basename = 'bench-startup-%d' % os.getpid()
+    store_filename = status_store.status_store_filename(basename)
+    snapshot_filename = topology_snapshot.topology_snapshot_filename(basename)
+    # Children are stopped in the middle of their backfill, which would otherwise be resumed by the next one.
+    marker_filename = status_store.backfill_marker_filename(basename)
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, 'param.json'), 'w') as f:
+        # A long poll interval, so that only the first poll happens while we're measuring.
+        json.dump(dict(access_key_id='benchmark', secret_key='benchmark-secret', pollInterval=600000,
+                       region_workers=args.region_workers, api_rate_limit=1000), f)
+
+    results = dict(imports=dict(runs=[time_imports() for _ in range(args.runs)]))
+    try:
+        cold, restart, warm = [], [], []
+        for _ in range(args.runs):
+            remove(store_filename)
+            remove(snapshot_filename)
+            remove(marker_filename)
+            cold.append(time_to_first_metric(args, workdir, basename))
+
+            save_snapshot(args, workdir, basename)
+            age_status_store(basename, args.downtime)
+            remove(marker_filename)
+            warm.append(time_to_first_metric(args, workdir, basename))
+
+            remove(snapshot_filename)
+            age_status_store(basename, args.downtime)
+            remove(marker_filename)
+            restart.append(time_to_first_metric(args, workdir, basename))
+        results.update(cold=dict(runs=cold), restart=dict(runs=restart), warm=dict(runs=warm))
+    finally:
+        remove(store_filename)
+        remove(snapshot_filename)
+        remove(marker_filename)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for situation, result in sorted(results.items()):
+        result['time_to_first_metric' if situation != 'imports' else 'time'] = median(result['runs'])
+        sys.stderr.write('%s: %.3fs (median of %d)\n' % (situation, median(result['runs']), len(result['runs'])))
+    config = dict((name, value) for name, value in vars(args).items() if name != 'child')
+    return dict(benchmark='startup', revision=git_revision(), python=platform.python_version(),
+                timestamp=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                config=config, results=results)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        child_main(args)
+        return
+    output = json.dumps(run(args), indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
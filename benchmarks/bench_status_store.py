@@ -0,0 +1,77 @@
+"""
+Compares the status store against the pickle file it replaced.
+
+Run from the repository root:
+    python -m benchmarks.bench_status_store
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import os
+import pickle
+import tempfile
+import time
+
+from boundary_aws_plugin import status_store
+
+SERIES_COUNTS = (10000, 100000)
+
+
+def make_reported_metrics(series_count, minute=0):
+    timestamp = datetime.datetime(2015, 1, 1) + datetime.timedelta(minutes=minute)
+    return dict((('us-east-1', 'elb-%d' % (i // 13), 'AWS_ELB_METRIC_%d' % (i % 13)), (timestamp, float(i), 'Sum'))
+                for i in range(series_count))
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def pickle_save(filename, data):
+    with open(filename, 'wb') as f:
+        pickle.dump(data, f)
+
+
+def pickle_load(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def bench(series_count):
+    data = make_reported_metrics(series_count)
+    basename = 'bench-status-store-%d' % os.getpid()
+    pickle_filename = os.path.join(tempfile.gettempdir(), basename + '.pickle')
+
+    results = dict(series=series_count)
+    results['pickle_save'], _ = timed(pickle_save, pickle_filename, data)
+    results['pickle_load'], _ = timed(pickle_load, pickle_filename)
+    os.remove(pickle_filename)
+
+    store = status_store.StatusStore(basename, data)
+    results['full_save'], _ = timed(store.save)
+    results['load'], _ = timed(status_store.load_status_store, basename)
+
+    # A poll that saw new data for 1% of the series.
+    for key in list(store)[:series_count // 100]:
+        timestamp, value, statistic = store[key]
+        store[key] = (timestamp + datetime.timedelta(minutes=1), value, statistic)
+    results['incremental_save_1pct'], _ = timed(store.save)
+
+    # A poll that saw new data for every series.
+    store.update(make_reported_metrics(series_count, minute=2))
+    results['incremental_save_all'], _ = timed(store.save)
+    os.remove(status_store.status_store_filename(basename))
+    return results
+
+
+def main():
+    for series_count in SERIES_COUNTS:
+        results = bench(series_count)
+        print('%(series)7d series: pickle save %(pickle_save).3fs load %(pickle_load).3fs | '
+              'status store full save %(full_save).3fs load %(load).3fs, '
+              'incremental save (1%%) %(incremental_save_1pct).3fs (100%%) %(incremental_save_all).3fs' % results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import asyncio
+import logging
+import re
+import ssl
+import time
+from urllib.parse import urlencode, urlsplit
+
+from . import metric_fetchers
+from . import sigv4
+from .cloudwatch_metrics import RegionData
+from .series_store import SeriesStore
+
+"""
+Collects metrics with asyncio instead of worker threads: every GetMetricData request of every region is
+in flight on a single thread, over a minimal non-blocking HTTP client signing requests itself, so that
+thousands of load balancers can be polled from one process without a thread per request.
+
+Requires Python 3.7 or later; the rest of the plugin only imports this module when the async collector
+is selected.
+"""
+
+"""
+URL of the CloudWatch API endpoint of each region; {region} is replaced with the region name.
+"""
+DEFAULT_CLOUDWATCH_ENDPOINT = 'https://monitoring.{region}.amazonaws.com/'
+
+CLOUDWATCH_API_VERSION = '2010-08-01'
+
+"""
+Seconds to wait for a response to any single request before failing it.
+"""
+REQUEST_TIMEOUT = 20
+
+
+class AwsResponseError(Exception):
+    """
+    An error response from an AWS API.  Mirrors boto.exception.BotoServerError, so that the rate limiter
+    recognizes throttling errors.
+    """
+    def __init__(self, status, reason, body=None):
+        super(AwsResponseError, self).__init__(status, reason, body)
+        self.status, self.reason, self.body = status, reason, body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        match = re.search('<Code>(.*?)</Code>', body or '')
+        self.error_code = match and match.group(1)
+
+
+class AsyncHttpClient(object):
+    """
+    A minimal HTTP/1.1 client for asyncio, keeping connections to each host open between requests.
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.timeout = timeout
+        # (scheme, host, port) -> list of idle (reader, writer) pairs
+        self.idle = dict()
+        self.ssl_context = ssl.create_default_context()
+
+    async def request(self, method, url, headers, body):
+        """
+        Makes a request, returning a tuple of (status, reason, body).
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = ''.join(['%s %s HTTP/1.1\r\n' % (method, path)] +
+                          ['%s: %s\r\n' % header for header in headers.items()] +
+                          ['Content-Length: %d\r\n\r\n' % len(body)]).encode('latin-1') + body
+
+        idle = self.idle.setdefault(key, [])
+        while idle:
+            # The server may have closed an idle connection in the meantime; if so, try the next one.
+            reader, writer = idle.pop()
+            try:
+                return await asyncio.wait_for(self.exchange(key, reader, writer, request), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(key[1], key[2], ssl=self.ssl_context if key[0] == 'https' else None),
+            self.timeout)
+        return await asyncio.wait_for(self.exchange(key, reader, writer, request), self.timeout)
+
+    async def exchange(self, key, reader, writer, request):
+        try:
+            writer.write(request)
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError('Connection closed by server')
+            _, status, reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    chunks.append(await reader.readexactly(size + 2))
+                    if not size:
+                        break
+                body = b''.join(chunk[:-2] for chunk in chunks)
+            elif 'content-length' in headers:
+                body = await reader.readexactly(int(headers['content-length']))
+            else:
+                body, keep_alive = await reader.read(), False
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive:
+            self.idle[key].append((reader, writer))
+        else:
+            writer.close()
+        return int(status), reason, body
+
+    async def close(self):
+        writers = [writer for connections in self.idle.values() for _, writer in connections]
+        self.idle.clear()
+        for writer in writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+
+
+async def gather_results(coroutines):
+    """
+    Runs coroutines concurrently, returning their results in order, with the exception raised by each that
+    failed in place of its result.  If we are cancelled, they all are.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AsyncCollector(object):
+    """
+    Implements CloudwatchMetrics.iter_metric_data for a CloudwatchMetrics object with asyncio, using its
+    region list, entity cache, metric list, rate limiter and instrumentation.  Each region's requests
+    are limited to the object's metric_workers at a time.  Entities are still discovered through the
+    (mostly cached) synchronous entity cache, on the event loop's default executor.
+    """
+
+    def __init__(self, metrics, endpoint=None, timeout=REQUEST_TIMEOUT):
+        """
+        @param metrics The CloudwatchMetrics object to collect for.
+        @param endpoint URL of the CloudWatch endpoint; see DEFAULT_CLOUDWATCH_ENDPOINT.
+        @param timeout Seconds to wait for the response to each request.
+        """
+        self.metrics = metrics
+        self.endpoint = endpoint or DEFAULT_CLOUDWATCH_ENDPOINT
+        self.timeout = timeout
+        self.fetcher = metric_fetchers.BatchedFetcher(metrics.cloudwatch_namespace)
+        self.loop = None
+        self.client = None
+
+    def iter_metric_data(self, regions, start_time, end_time, only_latest, series_start_times, series_filter):
+        """
+        See CloudwatchMetrics.iter_metric_data; all arguments are required here.  All regions are collected
+        concurrently, and each is yielded as soon as it is done.  The event loop only runs while waiting for the
+        next region, so requests still in flight are held up while the caller handles a region.
+        """
+        if not self.loop:
+            # The loop (and the connections opened on it) are kept for the next poll.
+            self.loop = asyncio.new_event_loop()
+            self.client = AsyncHttpClient(self.timeout)
+        pending = set(self.loop.create_task(self.collect_region(region, start_time, end_time, only_latest,
+                                                                series_start_times, series_filter))
+                      for region in regions)
+        try:
+            while pending:
+                done, pending = self.loop.run_until_complete(
+                    asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield task.result()
+        finally:
+            # E.g. KeyboardInterrupt, or the caller stopped: don't leave requests running in the background.
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    async def collect_region(self, region, start_time, end_time, only_latest, series_start_times, series_filter):
+        """
+        See CloudwatchMetrics.get_region_metric_data; a failure of the whole region is returned in the RegionData.
+        """
+        try:
+            return await self.collect_region_metric_data(region, start_time, end_time, only_latest,
+                                                         series_start_times, series_filter)
+        except Exception as e:
+            return RegionData(region.name, SeriesStore(), [(None, e)])
+
+    async def collect_region_metric_data(self, region, start_time, end_time, only_latest, series_start_times,
+                                         series_filter):
+        metrics = self.metrics
+        logging.getLogger('AsyncCollector').info("Region: %s", region.name)
+        entities = await self.loop.run_in_executor(None, metrics.entity_cache.get, region)
+        queries = metrics.get_region_queries(region, entities, start_time, series_start_times, series_filter)
+
+        # Every window and batch of up to 500 queries is a separate request, so all of them can be in flight.
+        batches = []
+        for window_start in sorted(set(query.start_time for query in queries)):
+            if not metric_fetchers.split_time_range(window_start, end_time):
+                continue
+            window = [query for query in queries if query.start_time == window_start]
+            batch_size = self.fetcher.batch_size
+            batches.extend(window[i:i + batch_size] for i in range(0, len(window), batch_size))
+
+        semaphore = asyncio.Semaphore(metrics.metric_workers)
+
+        async def fetch(batch):
+            async with semaphore:
+                out = SeriesStore()
+                await self.fetch_window(region, batch, batch[0].start_time, end_time, out)
+                return out
+
+        results = await gather_results(fetch(batch) for batch in batches)
+        batches, results, retry_batches = metrics.split_failed_batches(batches, results)
+        if retry_batches:
+            batches += retry_batches
+            results += await gather_results(fetch(batch) for batch in retry_batches)
+        return metrics.get_region_data(region, batches, results, only_latest)
+
+    async def fetch_window(self, region, queries, start_time, end_time, out):
+        """
+        See BatchedFetcher.fetch_window.
+        """
+        params = self.fetcher.build_params(queries, start_time, end_time)
+        while True:
+            result = await self.call(self.request, region, params)
+            next_token = self.fetcher.parse_result(result, queries, out, AwsResponseError)
+            if not next_token:
+                return
+            params['NextToken'] = next_token
+
+    async def call(self, func, *args):
+        """
+        The asynchronous equivalent of CloudwatchMetrics.call_aws: awaits func(*args) once the rate limiter
+        allows it, retrying it if it is throttled, and times each attempt.
+        """
+        rate_limiter, instrumentation = self.metrics.rate_limiter, self.metrics.instrumentation
+        attempt = 0
+        while True:
+            wait = rate_limiter.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            start = time.time()
+            try:
+                result = await func(*args)
+            except Exception as e:
+                delay = rate_limiter.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                rate_limiter.succeeded()
+                return result
+            finally:
+                if instrumentation.enabled:
+                    instrumentation.record('api_call', time.time() - start)
+
+    async def request(self, region, params):
+        """
+        Makes a single GetMetricData request, returning the GetMetricDataResult element of the response.
+        """
+        params = dict(params, Action='GetMetricData', Version=CLOUDWATCH_API_VERSION)
+        url = self.endpoint.format(region=region.name)
+        body = urlencode(sorted(params.items())).encode('utf-8')
+        headers = sigv4.sign_request('POST', url, {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'},
+                                     body, region.name, 'monitoring', self.metrics.access_key_id,
+                                     self.metrics.secret_access_key)
+        status, reason, response = await self.client.request('POST', url, headers, body)
+        if status != 200:
+            raise AwsResponseError(status, reason, response)
+        return metric_fetchers.get_metric_data_result(response)
+
+    def close(self):
+        """
+        Cancels anything still running on the event loop and closes it, along with all open connections.
+        """
+        if not self.loop:
+            return
+        pending = [task for task in asyncio.all_tasks(self.loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+        self.loop = self.client = None
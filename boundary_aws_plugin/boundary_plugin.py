@@ -1,44 +1,56 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-import logging
 import datetime
+import itertools
 import time
 import socket
 import json
-import multiprocessing
-from contextlib import contextmanager
+import threading
 import sys
-import os
 
 HOSTNAME = socket.gethostname()
 
 metric_log_file = None
+metric_log = None
 plugin_params = None
-keepalive_process = None
-keepalive_lock = None
+keepalive_thread = None
+# Serializes writes to stdout between the main thread, worker threads and the keepalive thread.
+output_lock = threading.Lock()
+# time.time() of the last write to the relay.
+last_output_time = time.time()
 
 """
 If the plugin doesn't generate any output for 30 seconds (hard-coded), the
 Boundary Relay thinks we're dead and kills us.  Because we may not have any
 data to output for much longer than that, we workaround this by outputting
-a bogus metric every so often.  This constant controls the delay between
-bogus metrics; it should be significantly less than 30 seconds to prevent
-any timing issues.
+a bogus metric whenever nothing else has been written for this long.  It
+should be significantly less than 30 seconds to prevent any timing issues.
 """
 KEEPALIVE_INTERVAL = 15
 
+"""
+The number of metric lines boundary_report_metrics formats and writes at a time.  A backfill can report
+millions of samples; writing them in batches keeps the buffer small while still saving most of the cost
+of a write and flush per line.
+"""
+OUTPUT_BATCH_SIZE = 1000
+
 
 def log_metrics_to_file(filename):
     """
     Logs all reported metrics to a file for debugging purposes.
     @param filename File name to log to; specify None to disable logging.
     """
-    global metric_log_file
-    metric_log_file = filename
+    global metric_log_file, metric_log
+    if metric_log:
+        metric_log.close()
+    metric_log_file, metric_log = filename, None
+
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
 
 
 def unix_time(dt):
-    epoch = datetime.datetime.utcfromtimestamp(0)
-    delta = dt - epoch
+    delta = dt - EPOCH
     return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
 
 
@@ -46,12 +58,35 @@ def unix_time_millis(dt):
     return unix_time(dt) * 1000.0
 
 
-@contextmanager
-def maybe_lock(lock):
-    if lock: lock.acquire()
-    yield
-    if lock: lock.release()
-    return
+def format_metric(name, value, source=None, timestamp=None):
+    """
+    Formats a metric as a line for the Boundary relay (without the trailing newline).
+    See boundary_report_metric for a description of the parameters.
+    """
+    source = source or HOSTNAME
+    if timestamp:
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = unix_time(timestamp)
+        return "%s %s %s %d" % (name, value, source, timestamp * 1000.0)
+    return "%s %s %s" % (name, value, source)
+
+
+def write_output(out):
+    """
+    Writes one or more complete, newline-terminated metric lines to the Boundary relay in a single write.
+    """
+    global metric_log, last_output_time
+    with output_lock:
+        sys.stdout.write(out)
+        # Flush stdout before we release the lock so output doesn't get intermixed
+        sys.stdout.flush()
+        last_output_time = time.time()
+
+        if metric_log_file:
+            if not metric_log:
+                metric_log = open(metric_log_file, 'a')
+            metric_log.write(out)
+            metric_log.flush()
 
 
 def boundary_report_metric(name, value, source=None, timestamp=None):
@@ -60,22 +95,27 @@ def boundary_report_metric(name, value, source=None, timestamp=None):
     @param name Metric name, as defined in the plugin's plugin.json file.
     @param value Metric value, should be a number.
     @param source Metric source.  Defaults to the machine's hostname.
-    @param timestamp Timestamp of the metric as a Python datetime object.  Defaults to none
-        (Boundary uses the current time in that case).
-    """
-    with maybe_lock(keepalive_lock) as _:
-        source = source or HOSTNAME
-        if timestamp:
-            timestamp = unix_time_millis(timestamp)
-        out = "%s %s %s%s" % (name, value, source, (' %d' % timestamp) if timestamp else '')
-        print(out)
-        # Flush stdout before we release the lock so output doesn't get intermixed
-        sys.stdout.flush()
+    @param timestamp Timestamp of the metric as a Python datetime object, or in seconds since the epoch.
+        Defaults to none (Boundary uses the current time in that case).
+    """
+    write_output(format_metric(name, value, source, timestamp) + "\n")
 
-        global metric_log_file
-        if metric_log_file:
-            with open(metric_log_file, 'a') as f:
-                f.write(out + "\n")
+
+def boundary_report_metrics(metrics):
+    """
+    Reports a number of metrics to the Boundary relay at once.  This is much faster than calling
+    boundary_report_metric for each one, since they are formatted into buffers of OUTPUT_BATCH_SIZE
+    lines, each written with one write and flush.
+    @param metrics An iterable of (name, value, source, timestamp) tuples; see boundary_report_metric.
+        It is only consumed one batch at a time, so it can be a generator.
+    """
+    metrics = iter(metrics)
+    while True:
+        lines = [format_metric(*metric) for metric in itertools.islice(metrics, OUTPUT_BATCH_SIZE)]
+        if not lines:
+            break
+        lines.append('')
+        write_output("\n".join(lines))
 
 
 def report_alive():
@@ -97,33 +137,42 @@ def parse_params():
     return plugin_params
 
 
+def poll_interval():
+    """
+    Returns the plugin's poll interval in seconds, as configured in the plugin's parameters.
+    """
+    params = parse_params()
+    return float(params.get("pollInterval", 1000)) / 1000
+
+
 def sleep_interval():
     """
     Sleeps for the plugin's poll interval, as configured in the plugin's parameters.
     """
-    params = parse_params()
-    time.sleep(float(params.get("pollInterval", 1000) / 1000))
+    time.sleep(poll_interval())
 
 
-def __keepalive_process_main(parent_pid):
-    # Workaround: on Linux, the Boundary Relay's sends SIGTERM to kill the plugin, which kills the main process but
-    # doesn't kill the keepalive process.  We work around this by identifying that our parent has died (and
-    # accordingly, our parent is now init) and killing ourselves.
-    # Note that os.getppid() doesn't exist on Windows, hence the getattr workaround.
-    while parent_pid == getattr(os, 'getppid', lambda: parent_pid)():
-        report_alive()
-        time.sleep(KEEPALIVE_INTERVAL)
+def _keepalive_thread_main():
+    while True:
+        idle = time.time() - last_output_time
+        if idle >= KEEPALIVE_INTERVAL:
+            report_alive()
+            idle = 0
+        # Clamped in case the system clock was set back.
+        time.sleep(min(KEEPALIVE_INTERVAL - idle, KEEPALIVE_INTERVAL))
 
 
-def start_keepalive_subprocess():
+def start_keepalive_thread():
     """
-    Starts the subprocess that keeps us alive by reporting bogus metrics.
+    Starts the background thread that keeps us alive by reporting a bogus metric whenever nothing
+    else has been reported for KEEPALIVE_INTERVAL seconds.
     This function should be called only once on plugin startup.
     See notes on KEEPALIVE_INTERVAL for more information.
     """
-    global keepalive_lock, keepalive_process
+    global keepalive_thread
 
-    assert not keepalive_lock and not keepalive_process
-    keepalive_lock = multiprocessing.Lock()
-    keepalive_process = multiprocessing.Process(target=__keepalive_process_main, args=(os.getpid(),))
-    keepalive_process.start()
+    assert not keepalive_thread
+    # A daemon thread dies with the plugin, so unlike a subprocess it can't outlive it.
+    keepalive_thread = threading.Thread(target=_keepalive_thread_main, name='keepalive')
+    keepalive_thread.daemon = True
+    keepalive_thread.start()
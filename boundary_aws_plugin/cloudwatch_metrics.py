@@ -1,24 +1,90 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-import boto
-import boto.ec2.cloudwatch
+import collections
 import datetime
 import logging
 import abc
+import threading
+
+from .collection_filter import CollectionFilter
+from . import connection_registry
+from . import entity_cache
+from . import metric_fetchers
+from .instrumentation import Instrumentation
+from .rate_limiter import RateLimiter
+from .series_store import SeriesStore
+from .topology_snapshot import SnapshotEntity, SnapshotRegion
+from . import worker_pool
+
+"""
+The metrics collected for a single region by CloudwatchMetrics.iter_metric_data.
+    region_name is the name of the region
+    data is a SeriesStore of the samples, in the format returned by get_metric_data
+    failures is a list of (keys, error) tuples for what could not be fetched: keys is the list of
+        (RegionId, EntityName, MetricName) keys affected, or None if the whole region failed (e.g. because its
+        entities could not be discovered), and error is the exception
+"""
+RegionData = collections.namedtuple('RegionData', 'region_name data failures')
 
 
 class CloudwatchMetrics(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, access_key_id, secret_access_key, cloudwatch_namespace):
+    # Name (metric_name_id) of a cheap metric whose non-zero values show that an entity is active, used to poll
+    # idle entities less often; see PollScheduler.  None if the entities have no such metric.
+    sentinel_metric = None
+
+    def __init__(self, access_key_id, secret_access_key, cloudwatch_namespace, region_workers=1, metric_workers=1,
+                 fetch_backend='statistics', entity_cache_ttl=0, empty_region_ttl=0, connections=None,
+                 rate_limiter=None, instrumentation=None, collector='threads', cloudwatch_endpoint=None,
+                 entity_source=None, collection_filter=None):
         """
         Initializes the class.
         @param access_key_id AWS Access Key ID.
         @param secret_access_key AWS Secret Access Key.
         @param cloudwatch_namespace The namespace of all metrics this class will
             request from CloudWatch, e.g. 'AWS/ELB'.
+        @param region_workers Number of regions to collect metrics for in parallel.
+        @param metric_workers Number of concurrent CloudWatch calls to make within each region.
+        @param fetch_backend How metrics are retrieved from CloudWatch: 'statistics' makes one GetMetricStatistics
+            call per metric, 'batched' packs up to 500 metrics into each GetMetricData call.
+        @param entity_cache_ttl Number of seconds discovered entities are reused before being refreshed in
+            the background.  0 rediscovers entities on every call.
+        @param empty_region_ttl Number of seconds before a region with no entities is probed again.
+        @param connections The ConnectionRegistry to get AWS connections from; defaults to the
+            registry shared by the whole process.
+        @param rate_limiter The RateLimiter all AWS API calls go through; defaults to one allowing 20 calls per second.
+        @param instrumentation The Instrumentation object to record timings with; defaults to a disabled one.
+        @param collector 'threads' collects regions and batches with worker threads, through boto; 'async'
+            makes all GetMetricData requests concurrently from a single thread with asyncio (Python 3.7+ only;
+            fetch_backend and region_workers are then ignored, and metric_workers limits the requests in flight
+            for each region).
+        @param cloudwatch_endpoint URL of the CloudWatch endpoint used by the async collector, with {region}
+            standing for the region name; defaults to AWS's.
+        @param entity_source Optional function returning the entities of a region, as SnapshotEntity objects, in
+            place of discovering them: e.g. those another process discovered for this one (see sharded_plugin).
+            The collection filter is expected to have been applied to them already.
+        @param collection_filter The CollectionFilter selecting the regions, entities and metrics to collect;
+            defaults to collecting everything.
         """
         self.access_key_id, self.secret_access_key = access_key_id, secret_access_key
         self.cloudwatch_namespace = cloudwatch_namespace
+        self.region_workers, self.metric_workers = max(1, region_workers), max(1, metric_workers)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.fetcher = metric_fetchers.FETCH_BACKENDS[fetch_backend](cloudwatch_namespace, call=self.call_aws)
+        self.connections = connections or connection_registry.default_registry
+        self.entity_cache = entity_cache.EntityCache(self.discover_entities, entity_cache_ttl, empty_region_ttl)
+        self.entity_source = entity_source
+        self.collection_filter = collection_filter or CollectionFilter()
+        # Regions restored from a topology snapshot, used instead of get_region_list until it has been revalidated.
+        self.snapshot_regions = None
+        if collector == 'async':
+            from .async_collector import AsyncCollector
+            self.async_collector = AsyncCollector(self, cloudwatch_endpoint)
+        elif collector == 'threads':
+            self.async_collector = None
+        else:
+            raise ValueError("Unknown collector: %s" % collector)
 
     @abc.abstractmethod
     def get_region_list(self):
@@ -47,6 +113,13 @@ class CloudwatchMetrics(object):
         """
         raise NotImplementedError()
 
+    def get_entity_tags(self, region, entities):
+        """
+        Returns a dictionary of {EntityName: {TagKey: TagValue}} with the tags of the given entities, used by tag
+        rules.  Override in child classes whose entities have tags; by default, entities have none.
+        """
+        return dict()
+
     def get_entity_source_name(self, entity):
         """
         Returns the source name to be reported for an entity
@@ -71,85 +144,338 @@ class CloudwatchMetrics(object):
         """
         raise NotImplementedError()
 
-    def get_metric_data(self, only_latest=True, start_time=None, end_time=None):
+    def get_derived_metric_list(self):
+        """
+        Returns a list of metrics computed locally from the metrics in get_metric_list, without any further API
+        calls.  Each tuple in the list should have the form
+            (metric_name_id, definition)
+        where
+            metric_name_id is the metric identifier in Boundary (e.g. AWS_ELB_HTTP_CODE_BACKEND_5XX_RATE)
+            definition says how it is computed from the metric_name_ids of its inputs, e.g. a
+                derived_metrics.Ratio
+
+        Override in child classes with derived metrics; by default, there are none.
+        """
+        return ()
+
+    def connection(self, service, region):
+        """
+        Checks out a connection to an AWS service in a region from the connection registry.
+        @param service The service name, e.g. 'cloudwatch' or 'elb'.
+        @param region The boto.regioninfo.RegionInfo object for the region.
+        """
+        return self.connections.connection(service, region.name, self.access_key_id, self.secret_access_key)
+
+    def call_aws(self, func, *args, **kwargs):
+        """
+        Makes an AWS API call, subject to the rate limiter and retried if it is throttled.
+        """
+        return self.rate_limiter.call(self.instrumentation.timed, 'api_call', func, *args, **kwargs)
+
+    def get_regions(self):
+        """
+        Returns the regions from get_region_list selected by the collection filter.
+        """
+        regions = self.snapshot_regions
+        if regions is None:
+            regions = self.get_region_list()
+        return [region for region in regions if self.collection_filter.region_selected(region.name)]
+
+    def get_topology(self):
+        """
+        Returns the regions and the entities discovered in each so far, in a form that can be saved as JSON and
+        passed to seed_topology: a dictionary of {RegionName: [[EntityName, dimensions], ...]}.
+        """
+        regions = dict((region.name, region) for region in self.get_regions())
+        out = dict()
+        for region_name, entities in self.entity_cache.get_entries().items():
+            region = regions.get(region_name)
+            if region is not None:
+                out[region_name] = [[self.entity_source_name(entity), self.entity_dimensions(region, entity)]
+                                    for entity in entities]
+        return out
+
+    def seed_topology(self, topology):
+        """
+        Starts from a topology returned by get_topology (e.g. by an earlier run of the plugin), so that metrics
+        can be fetched without waiting on discovery.  Its entities are used until the entity cache has refreshed
+        them in the background, and its regions until get_region_list has been called in the background (which
+        also takes importing boto off the first poll).
+        """
+        self.snapshot_regions = [SnapshotRegion(region_name) for region_name in sorted(topology)]
+        for region_name, entities in topology.items():
+            self.entity_cache.seed(region_name, [SnapshotEntity(name, dimensions) for name, dimensions in entities])
+
+        def revalidate_regions():
+            try:
+                self.get_region_list()
+            except Exception as e:
+                logging.getLogger('CloudwatchMetrics').error("Error listing regions: %s", e)
+                return
+            self.snapshot_regions = None
+
+        thread = threading.Thread(target=revalidate_regions)
+        thread.daemon = True
+        thread.start()
+
+    def get_metrics(self):
+        """
+        Returns the metrics from get_metric_list selected by the collection filter.
+        """
+        return [metric for metric in self.get_metric_list()
+                if self.collection_filter.metric_selected(metric[0], metric[2])]
+
+    def get_derived_metrics(self):
+        """
+        Returns the metrics from get_derived_metric_list selected by the collection filter.
+        """
+        return [metric for metric in self.get_derived_metric_list()
+                if self.collection_filter.metric_selected(metric[0], metric[0])]
+
+    def discover_entities(self, region):
+        """
+        Calls get_entities_for_region, keeping the entities selected by the collection filter (looking up their
+        tags if needed), and recording how long discovery took for the region.  With an entity_source, returns
+        its entities instead.
+        """
+        if self.entity_source:
+            return list(self.entity_source(region))
+        with self.instrumentation.timer('discovery', region.name):
+            entities = [entity for entity in self.get_entities_for_region(region)
+                        if self.collection_filter.entity_selected(self.get_entity_source_name(entity))]
+            if entities and self.collection_filter.has_tag_rules:
+                tags = self.get_entity_tags(region, entities)
+                entities = [entity for entity in entities
+                            if self.collection_filter.tags_selected(tags.get(self.get_entity_source_name(entity), {}))]
+            return entities
+
+    def entity_source_name(self, entity):
+        """
+        Returns get_entity_source_name(entity), also for entities restored from a topology snapshot.
+        """
+        if isinstance(entity, SnapshotEntity):
+            return entity.name
+        return self.get_entity_source_name(entity)
+
+    def entity_dimensions(self, region, entity):
+        """
+        Returns get_entity_dimensions(region, entity), also for entities restored from a topology snapshot.
+        """
+        if isinstance(entity, SnapshotEntity):
+            return entity.dimensions
+        return self.get_entity_dimensions(region, entity)
+
+    def get_metric_data(self, only_latest=True, start_time=None, end_time=None, series_start_times=None,
+                        series_filter=None):
         """
         Retrieves AWS ELB metrics from CloudWatch.
         @param only_latest True to return only the single latest sample for each metric; False to return
             all the metrics returned between start_time and end_time.
         @param start_time The earliest metric time to retrieve (inclusive); defaults to 20 minutes before end_time.
         @param end_time The latest metric time to retrieve (exclusive); defaults to now.
-        @return A dictionary, in the following format:
+        @param series_start_times Optional dictionary of {(RegionId, EntityName, MetricName): start_time}
+            overriding start_time for individual metrics, so that metrics already known up to some point
+            are only fetched from there on.
+        @param series_filter Optional function called with each (RegionId, EntityName, MetricName) key before it
+            is fetched; metrics for which it returns False are skipped.
+        @return A SeriesStore, which reads as a dictionary in the following format:
             {(RegionId, EntityName, MetricName): [(Timestamp, Value, Statistic), (Timestamp, Value, Statistic), ...],
              (RegionId, EntityName, MetricName): [(Timestamp, Value, Statistic), (Timestamp, Value, Statistic), ...], ...}
             That is, the dictionary keys are tuples of the region, entity name and metric name, and the
             dictionary values are lists of tuples of timestamp, value and statistic (TVS).  The TVS lists are
             guaranteed to be sorted in ascending order (latest timestamp last).
-            If only_latest is True, each TVS list is guaranteed to have at most one
-            value (but may have zero if no data is available for the requested range).
+            If only_latest is True, each TVS list is guaranteed to have exactly one value.  Metrics without
+            any data in the requested range are left out.
 
         @note AWS reports metrics in either 60-second or 5-minute intervals, depending on monitoring service level and metric.
             Keep in mind that even if end_time is now, the latest datapoint returned may be up to 5 minutes in the past.
         @note The Timestamp value will be for the *beginning* of each period.  For example, for a period of 60 seconds, a metric
             returned with a timestamp of 11:23 will be for the period of [11:23, 11:24); or the period of 11:23:00 through 11:23:59.999.
+        @note If anything fails, the error is raised and nothing is returned; see iter_metric_data to keep what
+            could be fetched.
         """
-        logger = logging.getLogger('CloudwatchMetrics')
+        out = SeriesStore()
+        for region_data in self.iter_metric_data(only_latest, start_time, end_time, series_start_times,
+                                                 series_filter):
+            for _, error in region_data.failures:
+                raise error
+            out.update(region_data.data)
+        return out
 
+    def iter_metric_data(self, only_latest=True, start_time=None, end_time=None, series_start_times=None,
+                         series_filter=None, region_names=None):
+        """
+        Retrieves metrics like get_metric_data, but yields the data of each region as a RegionData as soon as it
+        has been collected, so that it can be reported while the other regions are still being collected.  A
+        failure only costs what it affects: a region that fails (e.g. times out) is recorded as such, and a
+        batch of metrics that fails is retried one entity at a time, so that e.g. a load balancer deleted
+        mid-sweep only costs its own metrics.  An entity is either returned whole or recorded as failed.
+        @param only_latest, start_time, end_time, series_start_times, series_filter See get_metric_data.
+        @param region_names Optional collection of the names of the regions to collect (e.g. those to retry);
+            defaults to all.
+        @return An iterator of RegionData, in no particular order.
+        """
         # Note: although we want a 60-second period, not all CloudWatch metrics are provided in 60-second
         # periods, depending on service level and metric.  Instead, query the last 20 minutes, and take
         # the latest period we can get.
-        period = 60
         end_time = end_time or datetime.datetime.utcnow()
         start_time = start_time or (end_time - datetime.timedelta(minutes=20))
+        series_start_times = series_start_times or dict()
+        regions = [region for region in self.get_regions() if region_names is None or region.name in region_names]
+        if self.async_collector:
+            return self.async_collector.iter_metric_data(regions, start_time, end_time, only_latest,
+                                                         series_start_times, series_filter)
 
-        # CloudWatch can return a maximum of 1,440 datapoints in a single call.  With a period of 60 seconds, that
-        # works out to 1,440 minutes = 24 hours.  If we need more than 24 hours of data, split into a number of
-        # calls.  To prevent off-by-one issues, use 23 hours as the maximum time.
-        time_ranges = []
-        while end_time - start_time > datetime.timedelta(hours=23):
-            block_end = start_time + datetime.timedelta(hours=23)
-            time_ranges.append((start_time, block_end))
-            start_time = block_end
-        # Use a 30-second buffer for equality checks so we ignore things like leap seconds
-        # (the CloudWatch period is 60 seconds anyway, so any less than that doesn't matter)
-        if end_time - start_time > datetime.timedelta(seconds=30):
-            time_ranges.append((start_time, end_time))
+        def collect(region):
+            try:
+                return self.get_region_metric_data(region, start_time, end_time, only_latest, series_start_times,
+                                                   series_filter)
+            except Exception as e:
+                return RegionData(region.name, SeriesStore(), [(None, e)])
 
-        out = dict()
-        for region in self.get_region_list():
-            logger.info("Region: %s", region.name)
-
-            cw = boto.ec2.cloudwatch.connect_to_region(region.name, aws_access_key_id=self.access_key_id, aws_secret_access_key=self.secret_access_key)
-
-            entities = self.get_entities_for_region(region)
-            for entity in entities:
-                logger.info("\tEntity: %s" % self.get_entity_source_name(entity))
-
-                for metric in self.get_metric_list():
-                    metric_name, metric_statistic, metric_boundary_id = metric[:3]
-                    logger.info("\t\tMetric: %s %s %s" % (metric_name, metric_statistic, metric_boundary_id))
-                    
-                    data = []
-                    for st, et in time_ranges:
-                        data.extend(cw.get_metric_statistics(period=period, start_time=st, end_time=et,
-                                                             metric_name=metric_name, namespace=self.cloudwatch_namespace,
-                                                             statistics=metric_statistic,
-                                                             dimensions=self.get_entity_dimensions(region, entity)))
-
-                    if not data:
-                        logger.info("\t\t\tNo data")
-                        continue
+        # Regions are collected in parallel; a slow region only holds up its own worker.
+        return worker_pool.imap_unordered(collect, regions, self.region_workers)
+
+    def close(self):
+        """
+        Stops any collection still in progress and releases the resources held by the collector.
+        """
+        if self.async_collector:
+            self.async_collector.close()
+
+    def get_region_metric_data(self, region, start_time, end_time, only_latest, series_start_times,
+                               series_filter=None):
+        """
+        Retrieves metrics for all entities in a single region.
+        @param region The boto.regioninfo.RegionInfo object for the region to get metrics for.
+        @param start_time, end_time, only_latest, series_start_times, series_filter See get_metric_data.
+        @return A RegionData (see iter_metric_data).
+        """
+        logging.getLogger('CloudwatchMetrics').info("Region: %s", region.name)
+        queries = self.get_region_queries(region, self.entity_cache.get(region), start_time, series_start_times,
+                                          series_filter)
 
-                    if only_latest:
-                        # Pick out the latest sample only
-                        data = [max(data, key=lambda d: d['Timestamp'])]
-                    else:
-                        # Output all retrieved samples as a list, sorted by timestamp
-                        data = sorted(data, key=lambda d: d['Timestamp'])
+        def fetch(batch):
+            with self.connection('cloudwatch', region) as cw:
+                return self.fetcher.fetch(cw, batch, end_time)
 
-                    out_metric = []
-                    for sample in data:
-                        logger.info("\t\t\tValue: %s: %s" % (sample['Timestamp'], sample[metric_statistic]))
-                        out_metric.append((sample['Timestamp'], sample[metric_statistic], metric_statistic))
-                    out[(region.name, self.get_entity_source_name(entity), metric_boundary_id)] = out_metric
+        batch_size = self.fetcher.batch_size
+        batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+        results = worker_pool.map_concurrently(fetch, batches, self.metric_workers, return_exceptions=True)
+        batches, results, retry_batches = self.split_failed_batches(batches, results)
+        if retry_batches:
+            batches += retry_batches
+            results += worker_pool.map_concurrently(fetch, retry_batches, self.metric_workers,
+                                                    return_exceptions=True)
+        return self.get_region_data(region, batches, results, only_latest)
 
+    def get_region_queries(self, region, entities, start_time, series_start_times, series_filter=None):
+        """
+        Returns the list of MetricQuery objects for all metrics of the given entities in a region, sorted by
+        start time so that queries with the same time window are kept together and can share a single request.
+        @param start_time, series_start_times, series_filter See get_metric_data.
+        """
+        logger = logging.getLogger('CloudwatchMetrics')
+        # Per-metric and per-sample logging is only worth its cost when it will actually be written.
+        verbose = logger.isEnabledFor(logging.INFO)
+
+        metrics = self.get_metrics()
+        queries = []
+        for entity in entities:
+            if verbose:
+                logger.info("\tEntity: %s", self.entity_source_name(entity))
+            dimensions = self.entity_dimensions(region, entity)
+            for metric in metrics:
+                metric_name, metric_statistic, metric_boundary_id = metric[:3]
+                key = (region.name, self.entity_source_name(entity), metric_boundary_id)
+                if series_filter and not series_filter(key):
+                    continue
+                queries.append(metric_fetchers.MetricQuery(key, metric_name, metric_statistic, dimensions,
+                                                           series_start_times.get(key, start_time)))
+        queries.sort(key=lambda query: query.start_time)
+        return queries
+
+    def split_failed_batches(self, batches, results):
+        """
+        Separates the batches of queries that failed from the others, splitting each failed batch into one batch
+        per entity to be retried on its own.
+        @param results The corresponding results of fetching each batch: SeriesStores, or exceptions for the
+            batches that failed.
+        @return A (batches, results, retry_batches) tuple of the batches that succeeded, their results, and the
+            batches to retry.
+        """
+        ok_batches, ok_results, retry_batches = [], [], []
+        for batch, result in zip(batches, results):
+            if not isinstance(result, Exception):
+                ok_batches.append(batch)
+                ok_results.append(result)
+                continue
+            by_entity = collections.OrderedDict()
+            for query in batch:
+                by_entity.setdefault(query.key[:2], []).append(query)
+            retry_batches.extend(by_entity.values())
+        return ok_batches, ok_results, retry_batches
+
+    def get_region_data(self, region, batches, results, only_latest):
+        """
+        Merges the results of fetching a region's batches of queries into a RegionData.  The metrics of an entity
+        with any failed batch are all left out and recorded as failed, so that the data reported for an entity
+        is always complete (e.g. derived metrics never see only some of their inputs).
+        @param results The corresponding results of fetching each batch: SeriesStores, or exceptions for the
+            batches that failed (even when retried).
+        @param only_latest See get_metric_data.
+        """
+        entity_errors = dict()
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                for query in batch:
+                    entity_errors.setdefault(query.key[:2], result)
+        if not entity_errors:
+            return RegionData(region.name, self.process_region_data(region, batches, results, only_latest), [])
+
+        # The failure may be caused by an entity that no longer exists; rediscover them.
+        self.entity_cache.invalidate(region.name)
+        ok = [(batch, result) for batch, result in zip(batches, results) if not isinstance(result, Exception)]
+        data = self.process_region_data(region, [batch for batch, _ in ok], [result for _, result in ok],
+                                        only_latest)
+        data = data.select(lambda key: key[:2] not in entity_errors)
+        # One failure per distinct error, e.g. a single one for all entities of a batch that timed out.
+        failures = collections.OrderedDict()
+        for batch in batches:
+            for query in batch:
+                error = entity_errors.get(query.key[:2])
+                if error is not None:
+                    failures.setdefault(id(error), ([], error))[0].append(query.key)
+        return RegionData(region.name, data, list(failures.values()))
+
+    def process_region_data(self, region, batches, batch_results, only_latest):
+        """
+        Merges the samples fetched for a region into the format returned by get_metric_data.
+        @param batches List of batches of MetricQuery objects.
+        @param batch_results The corresponding list of SeriesStore objects fetched for each batch.
+        @param only_latest See get_metric_data.
+        """
+        logger = logging.getLogger('CloudwatchMetrics')
+        verbose = logger.isEnabledFor(logging.INFO)
+
+        out = SeriesStore()
+        with self.instrumentation.timer('process', region.name):
+            for batch_data in batch_results:
+                out.update(batch_data)
+            if only_latest:
+                # Pick out the latest sample only
+                out.keep_latest()
+            else:
+                # Output all retrieved samples, sorted by timestamp
+                out.sort()
+
+        if verbose:
+            for batch in batches:
+                for query in batch:
+                    logger.info("\t\tMetric: %s %s %s", query.metric_name, query.statistic, query.key[2])
+                    if query.key not in out:
+                        logger.info("\t\t\tNo data")
+                        continue
+                    for timestamp, value, _ in out[query.key]:
+                        logger.info("\t\t\tValue: %s: %s", timestamp, value)
         return out
@@ -1,10 +1,29 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
 import logging
 import datetime
+import heapq
+import itertools
+import signal
+import sys
 import time
 
+try:
+    from itertools import izip as zip
+except ImportError:
+    # Python 3
+    pass
+
 from . import boundary_plugin
+from .boundary_plugin import unix_time
+from .collection_filter import CollectionFilter, FILTER_SETTINGS
+from .derived_metrics import DerivedMetrics
+from . import instrumentation
+from . import metric_fetchers
+from . import poll_scheduler
+from . import rate_limiter
 from . import status_store
+from . import topology_snapshot
 
 """
 If getting statistics from CloudWatch fails, we will retry up to this number of times before
@@ -13,84 +32,366 @@ giving up and aborting the plugin.  Use 0 for unlimited retries.
 PLUGIN_RETRY_COUNT = 0
 """
 If getting statistics from CloudWatch fails, we will wait this long (in seconds) before retrying.
-This value must not be greater than 30 seconds, because the Boundary Relay will think we've
-timed out and terminate us after 30 seconds of inactivity.
+The keepalive thread reports a bogus metric meanwhile, so the Boundary Relay doesn't think we've
+timed out.
 """
 PLUGIN_RETRY_DELAY = 5
+"""
+Metrics we have already reported are only fetched from the last reported sample onwards, minus this
+allowance for datapoints CloudWatch publishes late.  Metrics we have not reported before (or not for
+longer than the default window) are fetched over the default 20-minute window.
+"""
+INCREMENTAL_FETCH_LATENESS = datetime.timedelta(minutes=2)
+"""
+Metrics fetched by a poll without a later start time of their own are fetched over this window, up to the
+time of the poll.
+"""
+DEFAULT_FETCH_WINDOW = datetime.timedelta(minutes=20)
+"""
+Credentials of an AWS account to collect metrics from.  The name identifies the account when
+sharding; it defaults to the access key ID.
+"""
+Account = collections.namedtuple('Account', 'name access_key_id secret_key')
+
+"""
+Self-metrics reported (when enabled) for the timings of each instrumented stage, as
+(stage, metric name suffix).  Durations are reported as totals in milliseconds per poll, broken down
+by source (e.g. region) where the stage records one.
+"""
+SELF_METRIC_DURATIONS = (
+    ('poll', 'POLL_DURATION'),
+    ('discovery', 'DISCOVERY_DURATION'),
+    ('process', 'PROCESS_DURATION'),
+    ('emit', 'EMIT_DURATION'),
+    ('status_save', 'STATUS_STORE_SAVE_DURATION'),
+)
 
 
 class CloudwatchPlugin(object):
-    def __init__(self, cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename):
+    def __init__(self, cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename,
+                 self_metrics_prefix='AWS_PLUGIN_'):
+        """
+        @param self_metrics_prefix Prefix of the names of the self-metrics describing the plugin's own performance.
+        """
         self.cloudwatch_metrics_type = cloudwatch_metrics_type
         self.boundary_metric_prefix = boundary_metric_prefix
         self.status_store_filename = status_store_filename
+        self.self_metrics_prefix = self_metrics_prefix
+        self.instrumentation = instrumentation.Instrumentation()
+        # Basename of the files keeping this process's own state next to the status store: the topology snapshot
+        # and the backfill marker.
+        self.state_basename = status_store_filename
+        # Identifies the settings the topology snapshot is saved with (see collect); None disables snapshots.
+        self.topology_fingerprint = None
+        self.next_topology_snapshot = 0
+
+    def get_accounts(self, settings):
+        """
+        Returns the list of Accounts to collect metrics from: those listed in the accounts setting, or the
+        single account given by the access_key_id and secret_key settings.
+        """
+        accounts = settings.get('accounts')
+        if not accounts and not (settings.get('access_key_id') and settings.get('secret_key')):
+            raise ValueError("Either access_key_id and secret_key, or accounts, must be set")
+        accounts = accounts or [settings]
+        for account in accounts:
+            if not (account.get('access_key_id') and account.get('secret_key')):
+                raise ValueError("Account %s has no access_key_id or secret_key" %
+                                 (account.get('name') or account.get('access_key_id') or ''))
+        return [Account(account.get('name') or account['access_key_id'], account['access_key_id'],
+                        account['secret_key']) for account in accounts]
+
+    def get_collector_options(self, settings):
+        """
+        Returns the keyword arguments used to construct the CloudwatchMetrics object from the plugin's settings.
+        """
+        return dict(region_workers=int(settings.get('region_workers', 4)),
+                    metric_workers=int(settings.get('metric_workers', 8)),
+                    fetch_backend=settings.get('fetch_backend', 'batched'),
+                    collector=settings.get('collector', 'threads'),
+                    entity_cache_ttl=int(settings.get('entity_cache_ttl', 900)),
+                    empty_region_ttl=int(settings.get('empty_region_ttl', 21600)),
+                    rate_limiter=rate_limiter.RateLimiter(float(settings.get('api_rate_limit', 20))),
+                    instrumentation=self.instrumentation,
+                    collection_filter=CollectionFilter.from_settings(settings))
 
-    def get_metric_data_with_retries(self, *args, **kwargs):
+    def get_topology_fingerprint(self, settings):
         """
-        Calls the get_metric_data function, taking into account retry configuration.
+        Returns the fingerprint of the settings that decide which entities are discovered, which a topology snapshot
+        has to match to be used.
         """
-        retry_range = xrange(PLUGIN_RETRY_COUNT) if PLUGIN_RETRY_COUNT > 0 else iter(int, 1)
+        return topology_snapshot.settings_fingerprint([account.name for account in self.get_accounts(settings)],
+                                                      int(settings.get('shards', 1)),
+                                                      [settings.get(name) for name in FILTER_SETTINGS])
+
+    def save_topology_snapshot(self):
+        """
+        Saves the discovered topology and learned resolutions, if snapshots are enabled and one is due.
+        """
+        now = time.time()
+        if self.topology_fingerprint is None or now < self.next_topology_snapshot:
+            return
+        self.next_topology_snapshot = now + topology_snapshot.TOPOLOGY_SNAPSHOT_INTERVAL
+        # Only resolutions that differ from the default are worth keeping.
+        resolutions = dict((metric_key, resolution) for metric_key, resolution in self.scheduler.resolutions.items()
+                           if resolution != poll_scheduler.DEFAULT_RESOLUTION)
+        try:
+            topology_snapshot.save_topology_snapshot(self.state_basename, self.topology_fingerprint,
+                                                     self.cloudwatch_metrics.get_topology(), resolutions)
+        except Exception as e:
+            logging.error("Error saving topology snapshot: %s", e)
+
+    def get_series_start_times(self, reported_metrics, end_time):
+        """
+        Returns the series_start_times to pass to get_metric_data so that only data that might be new is fetched.
+        Metrics are fetched from their last reported sample, but no further back than the default 20-minute
+        window or, if the scheduler skipped them for longer than that, the end of the last poll that fetched
+        them; either way less INCREMENTAL_FETCH_LATENESS.  So no sample is missed however long a metric goes
+        unpolled, while metrics that rarely have data aren't fetched from their last sample every time.  The
+        inputs of rolling windows are fetched from further back until the derived metrics have their history
+        (see DerivedMetrics.lookback).
+        """
+        default_start = end_time - DEFAULT_FETCH_WINDOW
+        last_fetched = self.scheduler.last_fetched
+
+        def earliest(metric_key):
+            fetched = last_fetched.get(metric_key)
+            return min(default_start, fetched - INCREMENTAL_FETCH_LATENESS) if fetched else default_start
+
+        out = dict((metric_key, earliest(metric_key)) for metric_key in last_fetched)
+        for metric_key, reported in reported_metrics.items():
+            out[metric_key] = max(reported[0] - INCREMENTAL_FETCH_LATENESS, earliest(metric_key))
+        for metric_key, start_time in out.items():
+            out[metric_key] = start_time - self.derived_metrics.lookback(metric_key)
+        return out
+
+    def iter_metric_data_with_retries(self, **kwargs):
+        """
+        Calls the iter_metric_data function, taking into account retry configuration.
+        """
+        retry_range = range(PLUGIN_RETRY_COUNT) if PLUGIN_RETRY_COUNT > 0 else iter(int, 1)
         for _ in retry_range:
             try:
-                return self.cloudwatch_metrics.get_metric_data(*args, **kwargs)
+                return self.cloudwatch_metrics.iter_metric_data(**kwargs)
             except Exception as e:
                 logging.error("Error retrieving CloudWatch data: %s" % e)
-                boundary_plugin.report_alive()
                 time.sleep(PLUGIN_RETRY_DELAY)
-                boundary_plugin.report_alive()
 
         logging.fatal("Max retries exceeded retrieving CloudWatch data")
         raise Exception("Max retries exceeded retrieving CloudWatch data")
 
+    def report_metric_data(self, reported_metrics, observe=None, **kwargs):
+        """
+        Retrieves metrics region by region (see CloudwatchMetrics.iter_metric_data), reporting each region's data
+        and saving it to the status store as soon as it arrives, so that it is kept even if other regions fail,
+        or the plugin is stopped before they are done.  Whatever could not be retrieved is logged.
+        @param observe Optional function called with each region's data (a SeriesStore) before it is reported.
+        @param kwargs Arguments for iter_metric_data; start_time is required.
+        @return A (failed_keys, failed_regions) tuple of the set of the keys of the metrics, and the set of the
+            names of the regions, that could not be retrieved.
+        """
+        start_time, series_start_times = kwargs['start_time'], kwargs.get('series_start_times') or dict()
+
+        def fetch_start(metric_key):
+            return series_start_times.get(metric_key, start_time)
+
+        failed_keys, failed_regions = set(), set()
+        for region_data in self.iter_metric_data_with_retries(**kwargs):
+            for keys, error in region_data.failures:
+                if keys is None:
+                    logging.error("Error retrieving CloudWatch data for region %s: %s", region_data.region_name, error)
+                    failed_regions.add(region_data.region_name)
+                else:
+                    logging.error("Error retrieving CloudWatch data for %d metrics of %d entities in region %s: %s",
+                                  len(keys), len(set(key[1] for key in keys)), region_data.region_name, error)
+                    failed_keys.update(keys)
+            if observe:
+                observe(region_data.data)
+            if region_data.data:
+                self.handle_metrics(self.derived_metrics.derive(region_data.data, fetch_start, kwargs.get('end_time')),
+                                    reported_metrics)
+        return failed_keys, failed_regions
+
     def handle_metrics(self, data, reported_metrics):
-        # Data format:
-        # (RegionId, EntityName, MetricName) -> [(Timestamp, Value, Statistic), (Timestamp, Value, Statistic), ...]
-        for metric_key, metric_list in data.items():
+        """
+        Reports the samples of a SeriesStore (as returned by get_metric_data) that are later than the last sample
+        reported for their metric, oldest first across all of its metrics, and records the new last samples in the
+        status store.  Samples are only new if their timestamp is strictly later: one with the same timestamp as
+        the last reported sample is a duplicate, even if its value differs (e.g. CloudWatch revised it).
+        """
+        new_data = data.select_after(reported_metrics)
+        sources, series = [], []
+        for series_number, (metric_key, statistic, timestamps, values) in enumerate(new_data.series()):
             region_id, entity_name, metric_name = metric_key
+            sources.append((self.boundary_metric_prefix + metric_name, entity_name))
+            series.append(zip(timestamps, itertools.repeat(series_number), values))
+        # Each series is already in order, so they only have to be merged, one sample at a time as they are
+        # written; samples with the same timestamp come in series order.
+        out = ((sources[series_number][0], value, sources[series_number][1], timestamp)
+               for timestamp, series_number, value in heapq.merge(*series))
+        reported_metrics.update(new_data.latest_samples())
+
+        with self.instrumentation.timer('emit'):
+            boundary_plugin.boundary_report_metrics(out)
+        with self.instrumentation.timer('status_save'):
+            status_store.save_status_store(self.status_store_filename, reported_metrics)
+
+    def backfill(self, reported_metrics):
+        """
+        Brings us up to date!  Gets all data since the last time we know we reported valid data
+        (minus 20 minutes as a buffer), and reports it now, so that we report data on any time
+        this plugin was down for any reason.  The data is retrieved one chunk of time at a time, and
+        each region's data is reported and saved to the status store as soon as it arrives.  Every
+        metric is only fetched from its last reported sample, so an interrupted backfill resumes where
+        each metric left off; the start of the backfill is kept until it completes (see
+        status_store.save_backfill_start), so metrics that were behind are still caught up from there.
+        """
+        try:
+            earliest_timestamp = max(reported_metrics.values(), key=lambda v: v[0])[0] - datetime.timedelta(minutes=20)
+        except ValueError:
+            # Probably first run or someone deleted our status store file - just start from now
+            logging.error("No status store data; starting data collection from now")
+            return
+
+        interrupted_start = status_store.load_backfill_start(self.state_basename)
+        if interrupted_start and interrupted_start < earliest_timestamp:
+            logging.error("Resuming interrupted historical data collection")
+            earliest_timestamp = interrupted_start
+        status_store.save_backfill_start(self.state_basename, earliest_timestamp)
+
+        logging.error("Starting historical data collection from %s" % earliest_timestamp)
+        series_start_times = dict((metric_key, reported[0] - INCREMENTAL_FETCH_LATENESS -
+                                   self.derived_metrics.lookback(metric_key))
+                                  for metric_key, reported in reported_metrics.items())
+        for chunk_start, chunk_end in metric_fetchers.split_time_range(earliest_timestamp, datetime.datetime.utcnow()):
+            logging.info("Retrieving historical data from %s to %s", chunk_start, chunk_end)
+            self.backfill_chunk(reported_metrics, chunk_start, chunk_end, series_start_times)
+        status_store.clear_backfill_start(self.state_basename)
+        logging.error("Historical data collection complete")
+
+    def backfill_chunk(self, reported_metrics, start_time, end_time, series_start_times):
+        """
+        Retrieves and reports the data between start_time and end_time.  Whatever could not be retrieved is
+        retried on its own (up to PLUGIN_RETRY_COUNT times) before the next chunk, which would take the last
+        reported samples of the failed metrics past the gap.
+        @param series_start_times Dictionary of {(RegionId, EntityName, MetricName): start_time} of the metrics
+            that are only fetched from some later time; those that start after end_time are skipped.
+        """
+        start_times = dict((metric_key, max(metric_start, start_time))
+                           for metric_key, metric_start in series_start_times.items())
+
+        def due(metric_key):
+            return start_times.get(metric_key, start_time) < end_time
 
-            for metric_list_item in metric_list:
-                # Do not report duplicate or past samples (note: we are comparing tuples here, which
-                # amounts to comparing their timestamps).
-                if reported_metrics.get(metric_key, (datetime.datetime.min,)) >= metric_list_item:
-                    continue
+        kwargs = dict(only_latest=False, start_time=start_time, end_time=end_time, series_start_times=start_times,
+                      series_filter=due)
+        retry_range = range(PLUGIN_RETRY_COUNT) if PLUGIN_RETRY_COUNT > 0 else iter(int, 1)
+        for _ in retry_range:
+            failed_keys, failed_regions = self.report_metric_data(reported_metrics, **kwargs)
+            if not failed_keys and not failed_regions:
+                return
+            time.sleep(PLUGIN_RETRY_DELAY)
+            kwargs.update(region_names=failed_regions | set(metric_key[0] for metric_key in failed_keys),
+                          series_filter=lambda metric_key, keys=failed_keys, regions=failed_regions: (
+                              (metric_key in keys or metric_key[0] in regions) and due(metric_key)))
 
-                metric_timestamp, metric_value, metric_statistic = metric_list_item
+        logging.fatal("Max retries exceeded retrieving CloudWatch data")
+        raise Exception("Max retries exceeded retrieving CloudWatch data")
 
-                boundary_plugin.boundary_report_metric(self.boundary_metric_prefix + metric_name,
-                                                       metric_value, entity_name, metric_timestamp)
-                reported_metrics[metric_key] = metric_list_item
+    def poll(self, reported_metrics):
+        """
+        Retrieves and reports the latest data for every metric that the scheduler expects to have new data.
+        Metrics (or regions) that could not be retrieved are left to the next poll.
+        """
+        with self.instrumentation.timer('poll'):
+            end_time = datetime.datetime.utcnow()
+            # Every sample since the last one reported is kept, so metrics the scheduler skipped for a while
+            # catch up completely.
+            failed_keys, failed_regions = self.report_metric_data(
+                reported_metrics, lambda data: self.scheduler.observe(data, end_time),
+                only_latest=False, start_time=end_time - DEFAULT_FETCH_WINDOW, end_time=end_time,
+                series_start_times=self.get_series_start_times(reported_metrics, end_time),
+                series_filter=lambda metric_key: self.scheduler.should_fetch(metric_key, end_time))
+            self.scheduler.end_poll(end_time, failed_keys, failed_regions)
+            # Entities that were not polled (e.g. deleted load balancers) are only trimmed here.
+            self.derived_metrics.trim(unix_time(end_time) - self.derived_metrics.retention)
+        self.save_topology_snapshot()
+        logging.info("API rate limiter: %s", self.cloudwatch_metrics.rate_limiter.get_stats())
+        logging.info("AWS connections: %s", self.cloudwatch_metrics.connections.get_stats())
+        self.report_self_metrics()
 
-        status_store.save_status_store(self.status_store_filename, reported_metrics)
+    def report_self_metrics(self):
+        """
+        Reports the timings gathered since the last call as self-metrics, if instrumentation is enabled.
+        """
+        if not self.instrumentation.enabled:
+            return
+        stages = self.instrumentation.collect()
+        out = []
+        for stage, suffix in SELF_METRIC_DURATIONS:
+            for (stats_stage, source), stats in sorted(stages.items(), key=lambda item: repr(item[0])):
+                if stats_stage == stage:
+                    out.append((self.self_metrics_prefix + suffix, round(stats.total * 1000, 3), source, None))
+
+        api_calls = stages.get(('api_call', None))
+        if api_calls:
+            out.append((self.self_metrics_prefix + 'API_CALLS', api_calls.count, None, None))
+            out.append((self.self_metrics_prefix + 'API_LATENCY', round(api_calls.total / api_calls.count * 1000, 3), None, None))
+            out.append((self.self_metrics_prefix + 'API_LATENCY_P90', round(api_calls.percentile(0.9) * 1000, 3), None, None))
+            out.append((self.self_metrics_prefix + 'API_LATENCY_MAX', round(api_calls.max * 1000, 3), None, None))
+        boundary_plugin.boundary_report_metrics(out)
 
     def main(self):
         settings = boundary_plugin.parse_params()
-        reported_metrics = status_store.load_status_store(self.status_store_filename) or dict()
+        reported_metrics = status_store.load_status_store(self.status_store_filename)
 
         logging.basicConfig(level=logging.ERROR, filename=settings.get('log_file', None))
         reports_log = settings.get('report_log_file', None)
         if reports_log:
             boundary_plugin.log_metrics_to_file(reports_log)
-        boundary_plugin.start_keepalive_subprocess()
+        boundary_plugin.start_keepalive_thread()
+        self.instrumentation.enabled = bool(settings.get('self_metrics', False))
+
+        # The relay stops us with SIGTERM; exit normally, so that in-flight requests are cancelled and
+        # connections closed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-        self.cloudwatch_metrics = self.cloudwatch_metrics_type(settings['access_key_id'], settings['secret_key'])
+        accounts = self.get_accounts(settings)
+        if len(accounts) > 1 or int(settings.get('shards', 1)) > 1:
+            from . import sharded_plugin
+            sharded_plugin.supervise(self, settings, reported_metrics)
+            return
 
-        # Bring us up to date!  Get all data since the last time we know we reported valid data
-        # (minus 20 minutes as a buffer), and report it now, so that we report data on any time
-        # this plugin was down for any reason.
+        self.cloudwatch_metrics = self.cloudwatch_metrics_type(accounts[0].access_key_id, accounts[0].secret_key,
+                                                               **self.get_collector_options(settings))
+        self.collect(settings, reported_metrics)
+
+    def collect(self, settings, reported_metrics):
+        """
+        Catches up on data missed while the plugin wasn't running, then polls for new data forever.  If an earlier
+        run left a topology snapshot, its regions and entities are used straight away, and revalidated in the
+        background.
+        """
         try:
-            earliest_timestamp = max(reported_metrics.values(), key=lambda v: v[0])[0] - datetime.timedelta(minutes=20)
-        except ValueError:
-            # Probably first run or someone deleted our status store file - just start from now
-            logging.error("No status store data; starting data collection from now")
-            pass
-        else:
-            logging.error("Starting historical data collection from %s" % earliest_timestamp)
-            data = self.get_metric_data_with_retries(only_latest=False,
-                                                     start_time=earliest_timestamp, end_time=datetime.datetime.utcnow())
-            self.handle_metrics(data, reported_metrics)
-            logging.error("Historical data collection complete")
-
-        while True:
-            data = self.get_metric_data_with_retries()
-            self.handle_metrics(data, reported_metrics)
-            boundary_plugin.sleep_interval()
+            self.topology_fingerprint = self.get_topology_fingerprint(settings)
+            snapshot = topology_snapshot.load_topology_snapshot(self.state_basename,
+                                                                self.topology_fingerprint)
+            if snapshot:
+                self.cloudwatch_metrics.seed_topology(snapshot[0])
+            ingestion_lag = int(settings.get('ingestion_lag', 60))
+            self.derived_metrics = DerivedMetrics(self.cloudwatch_metrics.get_derived_metrics(),
+                                                  poll_scheduler.DEFAULT_RESOLUTION + ingestion_lag)
+            self.backfill(reported_metrics)
+
+            self.scheduler = poll_scheduler.PollScheduler(boundary_plugin.poll_interval(), ingestion_lag,
+                                                          self.cloudwatch_metrics.sentinel_metric,
+                                                          int(settings.get('idle_poll_interval', 600)),
+                                                          self.derived_metrics.sparse_inputs)
+            self.scheduler.seed(reported_metrics)
+            if snapshot:
+                self.scheduler.resolutions.update(snapshot[1])
+            while True:
+                self.poll(reported_metrics)
+                self.scheduler.wait_for_next_poll()
+        finally:
+            self.cloudwatch_metrics.close()
@@ -0,0 +1,111 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import fnmatch
+import re
+
+"""
+Names of the plugin settings holding collection rules, which are also CollectionFilter's arguments.
+"""
+FILTER_SETTINGS = ('include_regions', 'exclude_regions', 'include_entities', 'exclude_entities', 'include_tags',
+                   'exclude_tags', 'include_metrics', 'exclude_metrics')
+
+
+def _get_patterns(value):
+    """
+    Returns a list of patterns from a setting, given either as a list or as a comma-separated string.
+    """
+    if not value:
+        return []
+    if not isinstance(value, list):
+        value = value.split(',')
+    return [pattern.strip() for pattern in value if pattern.strip()]
+
+
+def compile_patterns(patterns):
+    """
+    Compiles a list of shell-style wildcard patterns (see fnmatch) into a single case-sensitive matching
+    function, or returns None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in patterns)).match
+
+
+def compile_tag_rules(rules):
+    """
+    Compiles tag rules into a list of (key, value matching function) tuples.  A rule is either 'Key=Pattern',
+    matching entities whose tag Key has a value matching the pattern, or just 'Key', matching entities with
+    that tag whatever its value.
+    """
+    compiled = []
+    for rule in rules:
+        key, _, pattern = rule.partition('=')
+        compiled.append((key.strip(), compile_patterns([pattern.strip() or '*'])))
+    return compiled
+
+
+def _selected(include, exclude, *values):
+    if include and not any(include(value) for value in values):
+        return False
+    return not (exclude and any(exclude(value) for value in values))
+
+
+def _tags_match(rules, tags):
+    return any(key in tags and match(tags[key]) for key, match in rules)
+
+
+class CollectionFilter(object):
+    """
+    Include and exclude rules selecting the regions, entities and metrics to collect.  Everything is
+    collected by default; when include rules are given for something, only what matches one of them is
+    collected, and anything matching an exclude rule is skipped.  The rules are compiled once, so checking
+    them is cheap enough to do before building any request.
+    """
+
+    def __init__(self, include_regions=None, exclude_regions=None, include_entities=None, exclude_entities=None,
+                 include_tags=None, exclude_tags=None, include_metrics=None, exclude_metrics=None):
+        """
+        @param include_regions, exclude_regions Lists of region name patterns, e.g. 'us-*'.
+        @param include_entities, exclude_entities Lists of entity (e.g. load balancer) name patterns.
+        @param include_tags, exclude_tags Lists of tag rules; see compile_tag_rules.
+        @param include_metrics, exclude_metrics Lists of patterns matched against both the CloudWatch and the
+            Boundary name of each metric, e.g. 'SpilloverCount' or 'AWS_ELB_HTTP_CODE_BACKEND_*'.
+        """
+        self.include_regions = compile_patterns(include_regions)
+        self.exclude_regions = compile_patterns(exclude_regions)
+        self.include_entities = compile_patterns(include_entities)
+        self.exclude_entities = compile_patterns(exclude_entities)
+        self.include_tags = compile_tag_rules(include_tags or [])
+        self.exclude_tags = compile_tag_rules(exclude_tags or [])
+        self.include_metrics = compile_patterns(include_metrics)
+        self.exclude_metrics = compile_patterns(exclude_metrics)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates a CollectionFilter from the plugin's settings; see FILTER_SETTINGS.
+        """
+        return cls(**dict((name, _get_patterns(settings.get(name))) for name in FILTER_SETTINGS))
+
+    @property
+    def has_tag_rules(self):
+        """
+        True if entities are selected by their tags, which then have to be looked up.
+        """
+        return bool(self.include_tags or self.exclude_tags)
+
+    def region_selected(self, region_name):
+        return _selected(self.include_regions, self.exclude_regions, region_name)
+
+    def entity_selected(self, entity_name):
+        return _selected(self.include_entities, self.exclude_entities, entity_name)
+
+    def tags_selected(self, tags):
+        """
+        @param tags Dictionary of an entity's tags.
+        """
+        if self.include_tags and not _tags_match(self.include_tags, tags):
+            return False
+        return not _tags_match(self.exclude_tags, tags)
+
+    def metric_selected(self, metric_name, metric_boundary_id):
+        return _selected(self.include_metrics, self.exclude_metrics, metric_name, metric_boundary_id)
@@ -0,0 +1,102 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import threading
+from contextlib import contextmanager
+
+
+def connect_cloudwatch(region_name, access_key_id, secret_access_key):
+    import boto.ec2.cloudwatch
+    return boto.ec2.cloudwatch.connect_to_region(region_name, aws_access_key_id=access_key_id,
+                                                 aws_secret_access_key=secret_access_key)
+
+
+def connect_elb(region_name, access_key_id, secret_access_key):
+    import boto.ec2.elb
+    return boto.ec2.elb.connect_to_region(region_name, aws_access_key_id=access_key_id,
+                                          aws_secret_access_key=secret_access_key)
+
+
+"""
+Functions creating a new connection for each service, given a region name and credentials.
+"""
+CONNECTION_FACTORIES = {
+    'cloudwatch': connect_cloudwatch,
+    'elb': connect_elb,
+}
+
+
+class ConnectionRegistry(object):
+    """
+    Keeps AWS connections open across polls, so that we don't pay for a new TLS handshake and
+    credential setup on every request.  boto connections must not be used by two threads at
+    once, so connections are checked out for exclusive use and returned to the registry
+    afterwards; concurrent users of the same (service, region) each get their own connection.
+    """
+
+    def __init__(self, factories=None):
+        """
+        @param factories Dictionary of service name -> connection factory; defaults to CONNECTION_FACTORIES.
+        """
+        self.factories = dict(factories or CONNECTION_FACTORIES)
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.broken = set()
+        self.stats = collections.Counter()
+
+    @contextmanager
+    def connection(self, service, region_name, access_key_id, secret_access_key):
+        """
+        Checks out a connection to a service in a region, creating one if none are idle.  Use as:
+            with registry.connection('cloudwatch', 'us-east-1', key, secret) as cw:
+                cw.get_metric_statistics(...)
+        A connection that fails with anything other than an error response from AWS is assumed to be
+        broken and is discarded rather than reused.
+        """
+        key = (service, region_name, access_key_id)
+        with self.lock:
+            conn = self.idle[key].pop() if self.idle[key] else None
+            if conn is not None:
+                self.stats['reused'] += 1
+            elif key in self.broken:
+                self.broken.discard(key)
+                self.stats['reconnects'] += 1
+
+        if conn is None:
+            conn = self.factories[service](region_name, access_key_id, secret_access_key)
+            with self.lock:
+                self.stats['created'] += 1
+
+        try:
+            yield conn
+        except Exception as e:
+            # Error responses from AWS (boto.exception.BotoServerError) carry an HTTP status; the
+            # connection itself is still fine in that case.
+            if getattr(e, 'status', None) is not None:
+                self.release(key, conn)
+            else:
+                with self.lock:
+                    self.broken.add(key)
+            raise
+        else:
+            self.release(key, conn)
+
+    def release(self, key, conn):
+        with self.lock:
+            self.idle[key].append(conn)
+
+    def get_stats(self):
+        """
+        Returns a dictionary of counters: connections created, checkouts that reused an idle connection,
+        reconnects after a broken connection, and connections currently idle.
+        """
+        with self.lock:
+            stats = dict(created=self.stats['created'], reused=self.stats['reused'],
+                         reconnects=self.stats['reconnects'])
+            stats['idle'] = sum(len(conns) for conns in self.idle.values())
+        return stats
+
+
+"""
+The registry shared by everything in this process.
+"""
+default_registry = ConnectionRegistry()
@@ -0,0 +1,202 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import datetime
+
+from .boundary_plugin import unix_time
+from .series_store import SeriesStore
+
+"""
+Statistic recorded in the status store for derived metrics.
+"""
+DERIVED_STATISTIC = 'Derived'
+
+"""
+Seconds of input samples kept beyond the longest rolling window, so that samples CloudWatch publishes
+late still find their neighbours.
+"""
+HISTORY_SLACK = 600
+
+
+class Ratio(object):
+    """
+    A percentage of one metric to another, e.g. 5XX responses per request, computed at each timestamp of
+    the denominator where it is non-zero.  A missing numerator sample counts as zero, since CloudWatch
+    leaves out periods in which a count metric had nothing to count; as the numerator may also just not be
+    published yet, ratios are only computed once it has had time to be (see DerivedMetrics).  With a window,
+    the ratio is of the sums of both metrics over the window instead.
+    """
+
+    def __init__(self, numerator, denominator, window=0):
+        """
+        @param numerator, denominator Names (metric_name_id) of the input metrics.
+        @param window Length of the rolling window in seconds, or 0 for a ratio of single samples.
+        """
+        self.numerator, self.denominator, self.window = numerator, denominator, window
+        self.inputs = (numerator, denominator)
+        self.driver = denominator
+        # A metric whose missing samples stand for zero has to be fetched whenever the driver is, even while it
+        # keeps coming back empty.
+        self.sparse_inputs = (numerator,)
+
+    def compute(self, history, timestamp):
+        denominator = _window_sum(history[self.denominator], timestamp, self.window)
+        if not denominator:
+            return None
+        return 100.0 * _window_sum(history[self.numerator], timestamp, self.window) / denominator
+
+
+class RollingSum(object):
+    """
+    The sum of a metric over a rolling window ending at each of its samples.
+    """
+
+    def __init__(self, source, window):
+        """
+        @param source Name (metric_name_id) of the input metric.
+        @param window Length of the window in seconds.
+        """
+        self.source, self.window = source, window
+        self.inputs = (source,)
+        self.driver = source
+        self.sparse_inputs = ()
+
+    def compute(self, history, timestamp):
+        return _window_sum(history[self.source], timestamp, self.window)
+
+
+def _window_sum(samples, timestamp, window):
+    """
+    Returns the sum of the samples in (timestamp - window, timestamp], or of the sample at timestamp alone if
+    window is 0.
+    @param samples Dictionary of {timestamp: value}.
+    """
+    if not window:
+        return samples.get(timestamp, 0.0)
+    return sum(value for sample_time, value in samples.items() if timestamp - window < sample_time <= timestamp)
+
+
+class DerivedMetrics(object):
+    """
+    Computes derived metrics (see CloudwatchMetrics.get_derived_metric_list) from the samples fetched for
+    their inputs, without any further API calls.  A short history of every input is kept between calls,
+    for rolling windows and for inputs fetched by different polls.
+
+    A rolling window is only computed once the history covers all of it.  The history of an entity starts
+    out empty (e.g. after a restart), so the first fetch of its windowed inputs should start a window
+    earlier than it otherwise would (see lookback); derived samples whose window still reaches back before
+    the start of the history are left out rather than reported from part of their inputs.
+
+    Derived metrics with sparse inputs (e.g. a Ratio) tell a missing sample from one that is late only by
+    waiting: their samples are held until settle_time has passed since their timestamp, and computed by a
+    later call, so that a numerator CloudWatch publishes after its denominator still counts.
+    """
+
+    def __init__(self, definitions, settle_time=0):
+        """
+        @param definitions List of (metric_name_id, definition) tuples, where definition is e.g. a Ratio.
+        @param settle_time Seconds after its timestamp by which every sample of a period is published, e.g.
+            the resolution plus the ingestion lag.
+        """
+        self.definitions = definitions
+        self.inputs = set(name for _, definition in definitions for name in definition.inputs)
+        # Sparse input -> the driver it is compared with
+        self.sparse_inputs = dict((name, definition.driver)
+                                  for _, definition in definitions for name in definition.sparse_inputs)
+        # Input of rolling windows -> length of the longest window over it, in seconds
+        self.windows = dict()
+        for _, definition in definitions:
+            for name in definition.inputs if definition.window else ():
+                self.windows[name] = max(self.windows.get(name, 0), definition.window)
+        self.retention = max([definition.window for _, definition in definitions] + [0]) + HISTORY_SLACK
+        # (RegionId, EntityName) -> metric_name_id -> {timestamp: value}, with timestamps in seconds since the epoch
+        self.history = collections.defaultdict(lambda: collections.defaultdict(dict))
+        # (RegionId, EntityName) -> time (in seconds since the epoch) since which the history holds every sample
+        # of the entity's windowed inputs
+        self.covered_from = dict()
+        self.settle_time = settle_time
+        # ((RegionId, EntityName), metric_name_id) -> set of the timestamps of the derived samples held back
+        self.held = collections.defaultdict(set)
+
+    def lookback(self, metric_key):
+        """
+        Returns how much earlier than usual (as a timedelta) a metric, given by its (RegionId, EntityName,
+        MetricName) key, should be fetched from so that the rolling windows over it can be computed from its
+        first new sample: a whole window for a windowed input whose entity has no history yet, 0 otherwise.
+        """
+        if metric_key[:2] in self.covered_from:
+            return datetime.timedelta(0)
+        return datetime.timedelta(seconds=self.windows.get(metric_key[2], 0))
+
+    def derive(self, data, fetch_start, now=None):
+        """
+        Adds the derived metrics for the samples in a SeriesStore (as returned by get_metric_data) to it.
+        Derived samples are produced at each timestamp of their driving metric (e.g. a ratio's denominator)
+        present in data, and at those held back by earlier calls for the entities in data.
+        @param fetch_start Function returning the time (a datetime) each metric of data was fetched from, given
+            its key.  All inputs of an entity in data are expected to have been fetched.
+        @param now Time (a datetime) data was fetched up to, if samples that have not settled are to be held.
+        """
+        if not self.definitions:
+            return data
+        driver_times = collections.defaultdict(set)
+        # (RegionId, EntityName) -> timestamp of its newest input sample in data
+        newest = dict()
+        for metric_key, _, timestamps, values in data.series():
+            region_id, entity_name, metric_name = metric_key
+            if metric_name not in self.inputs:
+                continue
+            entity = (region_id, entity_name)
+            self.history[entity][metric_name].update(zip(timestamps, values))
+            driver_times[entity, metric_name].update(timestamps)
+            newest[entity] = max(newest.get(entity, timestamps[-1]), timestamps[-1])
+        for entity in newest:
+            if entity not in self.covered_from:
+                self.covered_from[entity] = max([unix_time(fetch_start(entity + (metric_name,)))
+                                                 for metric_name in self.windows] + [0])
+
+        derived = SeriesStore()
+        for name, definition in self.definitions:
+            # The last timestamp whose inputs have all been published
+            settled = unix_time(now) - self.settle_time if now and definition.sparse_inputs else None
+            for entity in newest:
+                timestamps = driver_times.get((entity, definition.driver), set()) | self.held.pop((entity, name), set())
+                history = self.history[entity]
+                # The first timestamp whose whole window is covered
+                first = self.covered_from[entity] + definition.window if definition.window else 0
+                for timestamp in sorted(timestamps):
+                    if timestamp < first:
+                        continue
+                    if settled is not None and timestamp > settled:
+                        self.held[entity, name].add(timestamp)
+                        continue
+                    value = definition.compute(history, timestamp)
+                    if value is not None:
+                        derived.add(entity + (name,), DERIVED_STATISTIC, timestamp, value)
+        # Each entity only against its own samples: data may hold some regions only, and one region's samples
+        # may be far ahead of another's (e.g. during a backfill).
+        for entity, entity_newest in newest.items():
+            self.trim(entity_newest - self.retention, [entity])
+        data.update(derived)
+        return data
+
+    def trim(self, oldest, entities=None):
+        """
+        Forgets the input samples older than oldest (in seconds since the epoch), which no window can reach
+        anymore, along with entities that have none left (e.g. deleted load balancers) and their held samples.
+        @param entities Optional list of the (RegionId, EntityName) tuples of the entities to trim; defaults to all.
+        """
+        for entity in list(self.covered_from) if entities is None else entities:
+            series = self.history[entity]
+            for metric_name, samples in list(series.items()):
+                for sample_time in [sample_time for sample_time in samples if sample_time < oldest]:
+                    del samples[sample_time]
+                if not samples:
+                    del series[metric_name]
+            if series:
+                self.covered_from[entity] = max(self.covered_from[entity], oldest)
+            else:
+                # Its metrics are fetched from further back than the window once they have samples again.
+                del self.history[entity]
+                del self.covered_from[entity]
+                for name, _ in self.definitions:
+                    self.held.pop((entity, name), None)
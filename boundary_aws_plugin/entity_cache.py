@@ -0,0 +1,95 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import logging
+import threading
+import time
+
+
+class EntityCache(object):
+    """
+    Caches the entities discovered in each region, so that discovery calls (such as DescribeLoadBalancers)
+    are kept out of the polling loop.  Only the first lookup of a region blocks on the loader; after that,
+    expired entries keep being served while a background thread refreshes them.
+    """
+
+    def __init__(self, loader, ttl=900, empty_ttl=21600):
+        """
+        @param loader Function returning the list of entities for a boto.regioninfo.RegionInfo object.
+        @param ttl Number of seconds a region's entity list is considered fresh.  0 disables caching.
+        @param empty_ttl Number of seconds a region with no entities is considered fresh; regions without
+            entities rarely gain any, so they are re-probed less often.
+        """
+        self.loader, self.ttl, self.empty_ttl = loader, ttl, empty_ttl
+        self.lock = threading.Lock()
+        # Region name -> (entities, time loaded)
+        self.entries = dict()
+        self.refreshing = set()
+
+    def get(self, region):
+        """
+        Returns the list of entities for a region, refreshing it in the background if it has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(region.name)
+        if entry is None or not self.ttl:
+            return self.refresh(region)
+
+        entities, loaded_at = entry
+        if time.time() - loaded_at >= (self.ttl if entities else self.empty_ttl):
+            self.refresh_in_background(region)
+        return entities
+
+    def refresh(self, region):
+        """
+        Reloads the entities for a region, blocking until they have been retrieved.
+        """
+        entities = list(self.loader(region))
+        with self.lock:
+            self.entries[region.name] = (entities, time.time())
+        return entities
+
+    def refresh_in_background(self, region):
+        """
+        Starts reloading the entities for a region, unless a reload is already in progress.
+        """
+        with self.lock:
+            if region.name in self.refreshing:
+                return
+            self.refreshing.add(region.name)
+
+        def refresh_main():
+            try:
+                self.refresh(region)
+            except Exception as e:
+                logging.getLogger('EntityCache').error("Error refreshing entities for %s: %s", region.name, e)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(region.name)
+
+        thread = threading.Thread(target=refresh_main)
+        thread.daemon = True
+        thread.start()
+
+    def seed(self, region_name, entities):
+        """
+        Adds already expired entities for a region (e.g. from a topology snapshot): they are returned straight
+        away by the next lookup, which also starts refreshing them in the background.
+        """
+        with self.lock:
+            self.entries.setdefault(region_name, (entities, 0))
+
+    def get_entries(self):
+        """
+        Returns the entities currently cached, as a dictionary of {region name: list of entities}.
+        """
+        with self.lock:
+            return dict((region_name, entities) for region_name, (entities, _) in self.entries.items())
+
+    def invalidate(self, region_name):
+        """
+        Marks a region's entities as expired, e.g. because a metric query for one of them failed.
+        The cached entities are still returned until the background refresh completes.
+        """
+        with self.lock:
+            entry = self.entries.get(region_name)
+            if entry is not None:
+                self.entries[region_name] = (entry[0], 0)
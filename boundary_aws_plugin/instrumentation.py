@@ -0,0 +1,108 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import bisect
+import threading
+import time
+
+"""
+Upper bounds (in seconds) of the buckets of the latency histograms kept for each stage.
+"""
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, instrumentation, stage, source):
+        self.instrumentation, self.stage, self.source = instrumentation, stage, source
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.stage, time.time() - self.start, self.source)
+        return False
+
+
+class StageStats(object):
+    """
+    Timing statistics for one stage: number of times it ran, total and maximum duration, and a histogram.
+    """
+    def __init__(self):
+        self.count, self.total, self.max = 0, 0.0, 0.0
+        self.histogram = [0] * len(HISTOGRAM_BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the histogram bucket containing the given fraction of samples.
+        """
+        target, seen = fraction * self.count, 0
+        for bound, count in zip(HISTOGRAM_BUCKETS, self.histogram):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Instrumentation(object):
+    """
+    Collects timings of the plugin's stages (discovery, API calls, emitting metrics, saving the status
+    store, whole polls), so they can be reported as self-metrics.  When disabled, timer() returns a
+    shared no-op context manager and timed() calls straight through, so instrumented code pays
+    next to nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # (stage, source) -> StageStats
+        self.stages = dict()
+
+    def timer(self, stage, source=None):
+        """
+        Returns a context manager timing the code it wraps as a run of stage.
+        @param source Optional source the timing applies to (e.g. a region name).
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage, source)
+
+    def timed(self, stage, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), timing it as a run of stage.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        with _Timer(self, stage, None):
+            return func(*args, **kwargs)
+
+    def record(self, stage, seconds, source=None):
+        with self.lock:
+            stats = self.stages.get((stage, source))
+            if stats is None:
+                stats = self.stages[(stage, source)] = StageStats()
+            stats.add(seconds)
+
+    def collect(self):
+        """
+        Returns the statistics gathered since the last call as a dictionary of {(stage, source): StageStats},
+        and starts gathering anew.
+        """
+        with self.lock:
+            stages, self.stages = self.stages, dict()
+        return stages
@@ -0,0 +1,233 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import datetime
+import logging
+import xml.etree.ElementTree as ElementTree
+# Workaround: on Python 2, the first call to strptime isn't thread-safe, and fails if made from a worker thread.
+import _strptime
+
+from .boundary_plugin import unix_time
+from .series_store import SeriesStore
+
+"""
+A single metric to retrieve from CloudWatch.
+    key is the (RegionId, EntityName, MetricName) key the samples are reported under
+    metric_name is the AWS metric name (e.g. HTTPCode_ELB_4XX)
+    statistic is the statistic to collect (e.g. Sum or Average)
+    dimensions is a dictionary of CloudWatch dimensions identifying the entity
+    start_time is the earliest metric time to retrieve (inclusive)
+"""
+MetricQuery = collections.namedtuple('MetricQuery', 'key metric_name statistic dimensions start_time')
+
+"""
+GetMetricData accepts at most this many metric queries in a single call.
+"""
+GET_METRIC_DATA_MAX_QUERIES = 500
+
+CLOUDWATCH_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def split_time_range(start_time, end_time):
+    """
+    Splits a time range into blocks that can each be requested from CloudWatch in a single call.
+    @return A list of (start_time, end_time) tuples covering [start_time, end_time).
+    """
+    # CloudWatch can return a maximum of 1,440 datapoints in a single call.  With a period of 60 seconds, that
+    # works out to 1,440 minutes = 24 hours.  If we need more than 24 hours of data, split into a number of
+    # calls.  To prevent off-by-one issues, use 23 hours as the maximum time.
+    time_ranges = []
+    while end_time - start_time > datetime.timedelta(hours=23):
+        block_end = start_time + datetime.timedelta(hours=23)
+        time_ranges.append((start_time, block_end))
+        start_time = block_end
+    # Use a 30-second buffer for equality checks so we ignore things like leap seconds
+    # (the CloudWatch period is 60 seconds anyway, so any less than that doesn't matter)
+    if end_time - start_time > datetime.timedelta(seconds=30):
+        time_ranges.append((start_time, end_time))
+    return time_ranges
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 CloudWatch timestamp into a naive UTC datetime (as boto returns them).
+    """
+    return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def is_extended_statistic(statistic):
+    """
+    Returns True for percentile statistics (e.g. p99 or p99.9), which CloudWatch calls extended statistics.
+    """
+    return statistic[:1] == 'p' and statistic[1:].replace('.', '', 1).isdigit()
+
+
+def _call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def _local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element if _local_name(child) == name]
+
+
+def _child_items(element, name):
+    for child in _children(element, name):
+        return list(child)
+    return []
+
+
+def _child_text(element, name):
+    for child in _children(element, name):
+        return child.text
+    return None
+
+
+class StatisticsFetcher(object):
+    """
+    Fetches metrics with one GetMetricStatistics call per metric query and time range.  boto 2's
+    GetMetricStatistics has no extended statistics, so percentiles are fetched with GetMetricData instead
+    (still one query per call).
+    """
+    batch_size = 1
+
+    def __init__(self, namespace, period=60, call=_call):
+        """
+        @param namespace The CloudWatch namespace of the metrics to fetch.
+        @param period The CloudWatch period to request, in seconds.
+        @param call Function used to make each API request, as call(func, *args, **kwargs); e.g.
+            RateLimiter.call.
+        """
+        self.namespace, self.period, self.call = namespace, period, call
+        self.extended_fetcher = BatchedFetcher(namespace, period, call)
+
+    def fetch(self, cw, queries, end_time):
+        """
+        Retrieves samples for a batch of metric queries.
+        @param cw The CloudWatch connection to use.
+        @param queries List of MetricQuery objects; at most batch_size long.
+        @param end_time The latest metric time to retrieve (exclusive).
+        @return A SeriesStore of the samples, in no particular order.
+        """
+        out = SeriesStore()
+        for query in queries:
+            if is_extended_statistic(query.statistic):
+                out.update(self.extended_fetcher.fetch(cw, [query], end_time))
+                continue
+            for st, et in split_time_range(query.start_time, end_time):
+                for sample in self.call(cw.get_metric_statistics, period=self.period, start_time=st, end_time=et,
+                                        metric_name=query.metric_name, namespace=self.namespace,
+                                        statistics=query.statistic, dimensions=query.dimensions):
+                    out.add(query.key, query.statistic, unix_time(sample['Timestamp']), sample[query.statistic])
+        return out
+
+
+class BatchedFetcher(object):
+    """
+    Fetches metrics with GetMetricData, packing up to 500 metric queries into each call and following
+    NextToken pagination.  boto 2 has no wrapper for GetMetricData, so the request is made through the
+    connection's generic make_request and the XML response is parsed here.
+    """
+    batch_size = GET_METRIC_DATA_MAX_QUERIES
+
+    def __init__(self, namespace, period=60, call=_call):
+        """
+        See StatisticsFetcher.
+        """
+        self.namespace, self.period, self.call = namespace, period, call
+
+    def build_params(self, queries, start_time, end_time):
+        params = {
+            'StartTime': start_time.strftime(CLOUDWATCH_TIMESTAMP_FORMAT),
+            'EndTime': end_time.strftime(CLOUDWATCH_TIMESTAMP_FORMAT),
+            'ScanBy': 'TimestampAscending',
+        }
+        for n, query in enumerate(queries):
+            prefix = 'MetricDataQueries.member.%d.' % (n + 1)
+            params[prefix + 'Id'] = 'q%d' % n
+            params[prefix + 'ReturnData'] = 'true'
+            params[prefix + 'MetricStat.Period'] = str(self.period)
+            params[prefix + 'MetricStat.Stat'] = query.statistic
+            params[prefix + 'MetricStat.Metric.Namespace'] = self.namespace
+            params[prefix + 'MetricStat.Metric.MetricName'] = query.metric_name
+            for m, (name, value) in enumerate(sorted(query.dimensions.items())):
+                dimension_prefix = prefix + 'MetricStat.Metric.Dimensions.member.%d.' % (m + 1)
+                params[dimension_prefix + 'Name'] = name
+                params[dimension_prefix + 'Value'] = value
+        return params
+
+    def fetch(self, cw, queries, end_time):
+        """
+        Retrieves samples for a batch of metric queries.  See StatisticsFetcher.fetch.
+        GetMetricData is not limited to 1,440 datapoints per metric, so each window is requested
+        in one go; queries with different start times are sent as separate requests.
+        """
+        out = SeriesStore()
+        for start_time in sorted(set(query.start_time for query in queries)):
+            group = [query for query in queries if query.start_time == start_time]
+            if split_time_range(start_time, end_time):
+                self.fetch_window(cw, group, start_time, end_time, out)
+        return out
+
+    def fetch_window(self, cw, queries, start_time, end_time, out):
+        """
+        Retrieves samples for queries sharing a single time window, adding them to out.
+        """
+        logger = logging.getLogger('BatchedFetcher')
+        params = self.build_params(queries, start_time, end_time)
+        while True:
+            next_token = self.parse_result(self.call(self.request, cw, params), queries, out, cw.ResponseError)
+            if not next_token:
+                return
+            logger.debug("Following GetMetricData NextToken for %d queries", len(queries))
+            params['NextToken'] = next_token
+
+    def parse_result(self, result, queries, out, error_type):
+        """
+        Adds the samples in a GetMetricDataResult element to the SeriesStore out, returning the NextToken of the
+        result (if any).
+        @param queries The queries the request was built from.
+        @param error_type Exception type raised, as error_type(status, reason, body), if a query failed.
+        """
+        # All queries of a request share the same few timestamps, so convert each only once.
+        seconds = dict()
+        for results in _children(result, 'MetricDataResults'):
+            for member in _children(results, 'member'):
+                query = queries[int(_child_text(member, 'Id')[1:])]
+                status = _child_text(member, 'StatusCode')
+                if status not in ('Complete', 'PartialData'):
+                    raise error_type(200, status, "GetMetricData returned %s for %s" % (status, query.key))
+                timestamps = []
+                for item in _child_items(member, 'Timestamps'):
+                    timestamp = seconds.get(item.text)
+                    if timestamp is None:
+                        timestamp = seconds[item.text] = unix_time(parse_timestamp(item.text))
+                    timestamps.append(timestamp)
+                values = [float(v.text) for v in _child_items(member, 'Values')]
+                out.extend(query.key, query.statistic, timestamps, values)
+        return _child_text(result, 'NextToken')
+
+    def request(self, cw, params):
+        """
+        Makes a single GetMetricData request, returning the GetMetricDataResult element of the response.
+        """
+        response = cw.make_request('GetMetricData', params, verb='POST')
+        body = response.read()
+        if response.status != 200:
+            raise cw.ResponseError(response.status, response.reason, body)
+        return get_metric_data_result(body)
+
+
+def get_metric_data_result(body):
+    """
+    Returns the GetMetricDataResult element of a GetMetricData response body.
+    """
+    return _children(ElementTree.fromstring(body), 'GetMetricDataResult')[0]
+
+
+FETCH_BACKENDS = {
+    'statistics': StatisticsFetcher,
+    'batched': BatchedFetcher,
+}
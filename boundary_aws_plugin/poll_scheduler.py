@@ -0,0 +1,192 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import time
+
+from .series_store import from_unix_time
+
+"""
+Resolution (in seconds) assumed for metrics until we have seen enough of their samples to learn it.
+"""
+DEFAULT_RESOLUTION = 60
+
+"""
+An entity whose sentinel metric has shown no activity for this long (in seconds) is considered idle.
+"""
+IDLE_AFTER = 900
+
+
+class PollScheduler(object):
+    """
+    Decides which metrics are worth fetching on each poll, and keeps polls on a fixed-rate clock.
+
+    The resolution of each metric (the spacing of its samples, typically 60 seconds or 5 minutes) is
+    learned from the timestamps CloudWatch returns.  Since a sample's timestamp is the *beginning* of
+    its period, the sample after one timestamped T can't exist until T + 2 * resolution, plus the time
+    CloudWatch takes to publish it; until then, the metric is skipped.  A metric that is due but still
+    has nothing new is checked again after a quarter of its resolution.
+
+    With an idle interval, polling also adapts to how active each entity is.  A metric that keeps coming
+    back empty is rechecked less and less often (doubling the delay each time, up to the idle interval).
+    An entity whose sentinel metric (e.g. an ELB's request count) has shown no activity for IDLE_AFTER
+    seconds is idle: only its sentinel is polled at the normal rate, and its other metrics at most once
+    per idle interval, until the sentinel shows activity again.  Skipped metrics lose nothing, since
+    the next fetch starts from the last one (see last_fetched).
+
+    Sparse metrics, whose missing samples stand for zero in derived metrics (e.g. 5XX counts in error
+    rates), are fetched exactly when the driver they are compared with (e.g. the request count) is: when
+    their samples turn up says nothing about when the next one will, and they have to be fetched along
+    with the samples they are compared with.
+    """
+
+    def __init__(self, interval, ingestion_lag=60, sentinel_metric=None, idle_interval=0, sparse_metrics=None):
+        """
+        @param interval Time between polls, in seconds.
+        @param ingestion_lag Seconds to allow CloudWatch to publish a sample once its period has closed.
+        @param sentinel_metric The name (MetricName in metric keys) of a cheap metric whose non-zero values show
+            that an entity is active; None to poll every entity at the normal rate.
+        @param idle_interval Longest time, in seconds, metrics of idle entities and empty metrics are left
+            unpolled; 0 disables adaptive polling.
+        @param sparse_metrics Dictionary of {name: driver name} of metrics that are fetched whenever the driver
+            metric of the same entity is, whether or not a new sample of their own is expected.
+        """
+        self.interval = interval
+        self.ingestion_lag = datetime.timedelta(seconds=ingestion_lag)
+        # Start time of the current poll, in seconds since the epoch; the scheduler is created as the first one starts.
+        self.next_poll = time.time()
+        # Metric key -> resolution in seconds
+        self.resolutions = dict()
+        # Metric key -> timestamp of the latest sample seen
+        self.latest = dict()
+        # Metric key -> time before which a metric that had nothing new is not fetched again
+        self.recheck = dict()
+        # Metric keys fetched by the current poll
+        self.fetched = set()
+        self.sentinel_metric = sentinel_metric
+        self.idle_interval = idle_interval
+        self.sparse_metrics = dict(sparse_metrics or ())
+        # Metric key -> end time of the last poll that fetched it
+        self.last_fetched = dict()
+        # Metric key -> number of consecutive fetches that returned nothing new
+        self.empty_fetches = dict()
+        # (RegionId, EntityName) -> time of the latest activity seen on the entity's sentinel metric
+        self.last_activity = dict()
+
+    def seed(self, reported_metrics):
+        """
+        Initializes the latest sample times from the status store's reported metrics.
+        """
+        for metric_key, reported in reported_metrics.items():
+            self.latest[metric_key] = reported[0]
+
+    def get_resolution(self, metric_key):
+        return self.resolutions.get(metric_key, DEFAULT_RESOLUTION)
+
+    def should_fetch(self, metric_key, now):
+        """
+        Returns True if metric_key may have a new sample at time now, and records that it is being fetched.
+        Suitable for use as get_metric_data's series_filter.
+        """
+        driver = self.sparse_metrics.get(metric_key[2])
+        if not self.is_due(metric_key if driver is None else metric_key[:2] + (driver,), now):
+            return False
+        self.fetched.add(metric_key)
+        return True
+
+    def is_due(self, metric_key, now):
+        """
+        Returns True if metric_key may have a new sample at time now; see should_fetch.
+        """
+        recheck = self.recheck.get(metric_key)
+        if recheck and now < recheck:
+            return False
+        latest = self.latest.get(metric_key)
+        if latest and now < latest + datetime.timedelta(seconds=2 * self.get_resolution(metric_key)) + self.ingestion_lag:
+            return False
+        if self.idle_interval and self.sentinel_metric:
+            entity = metric_key[:2]
+            if metric_key[2] == self.sentinel_metric:
+                # Entities start out active.
+                self.last_activity.setdefault(entity, now)
+            elif self.is_idle(entity, now):
+                last_fetched = self.last_fetched.get(metric_key)
+                if last_fetched and now < last_fetched + datetime.timedelta(seconds=self.idle_interval):
+                    return False
+        return True
+
+    def is_idle(self, entity, now):
+        """
+        Returns True if an entity, given as a (RegionId, EntityName) tuple, has had no activity recently.
+        """
+        last_activity = self.last_activity.get(entity)
+        return bool(last_activity) and now - last_activity >= datetime.timedelta(seconds=IDLE_AFTER)
+
+    def observe(self, data, now):
+        """
+        Learns from the data returned by a poll (a SeriesStore, as returned by get_metric_data) made at time now.
+        A poll's data may be observed in parts (e.g. region by region), and end_poll must be called once it
+        has all been observed.
+        """
+        for metric_key, _, timestamps, values in data.series():
+            # Timestamps are sorted, in seconds since the epoch.
+            first, last = from_unix_time(timestamps[0]), from_unix_time(timestamps[-1])
+            deltas = [b - a for a, b in zip(timestamps, timestamps[1:]) if b > a]
+            previous = self.latest.get(metric_key)
+            if previous and previous < first:
+                deltas.append((first - previous).total_seconds())
+            if metric_key in self.resolutions:
+                deltas.append(self.resolutions[metric_key])
+            if deltas:
+                # CloudWatch leaves out periods without activity, so gaps can be longer than the resolution
+                # but never shorter.
+                self.resolutions[metric_key] = min(deltas)
+            if not previous or last > previous:
+                self.latest[metric_key] = last
+                self.last_fetched[metric_key] = now
+                self.fetched.discard(metric_key)
+                self.recheck.pop(metric_key, None)
+                self.empty_fetches.pop(metric_key, None)
+            if metric_key[2] == self.sentinel_metric:
+                active = [timestamp for timestamp, value in zip(timestamps, values) if value > 0]
+                if active:
+                    self.observe_activity(metric_key[:2], from_unix_time(active[-1]), now)
+
+    def end_poll(self, now, failed_keys=(), failed_regions=()):
+        """
+        Completes a poll made at time now, once all of its data has been observed.
+        @param failed_keys, failed_regions Collections of the keys of the metrics, and names of the regions, that
+            the poll could not fetch.  They stay due, so that the next poll retries them (from where the last
+            successful fetch left off).
+        """
+        # Whatever we fetched without getting anything new is left alone for a while (longer each time, with
+        # an idle interval, except for sentinels).
+        for metric_key in self.fetched:
+            if metric_key in failed_keys or metric_key[0] in failed_regions:
+                continue
+            self.last_fetched[metric_key] = now
+            delay = self.get_resolution(metric_key) / 4
+            if self.idle_interval and metric_key[2] != self.sentinel_metric:
+                empty_fetches = self.empty_fetches[metric_key] = self.empty_fetches.get(metric_key, 0) + 1
+                delay = min(delay * 2 ** (empty_fetches - 1), max(delay, self.idle_interval))
+            self.recheck[metric_key] = now + datetime.timedelta(seconds=delay)
+        self.fetched = set()
+
+    def observe_activity(self, entity, timestamp, now):
+        """
+        Records activity on an entity's sentinel metric at time timestamp.  If the entity was idle, all of its
+        metrics are polled again from the next poll.
+        """
+        was_idle = self.is_idle(entity, now)
+        self.last_activity[entity] = max(timestamp, self.last_activity.get(entity, timestamp))
+        if was_idle and not self.is_idle(entity, now):
+            for schedule in (self.recheck, self.empty_fetches):
+                for metric_key in [key for key in schedule if key[:2] == entity]:
+                    del schedule[metric_key]
+
+    def wait_for_next_poll(self):
+        """
+        Sleeps until the next poll is due.  Polls are made every interval seconds, measured from the start of
+        each poll rather than from the end of the previous one; if a poll overran, the next one starts at once.
+        """
+        now = time.time()
+        self.next_poll = max(now, self.next_poll + self.interval)
+        time.sleep(self.next_poll - now)
@@ -0,0 +1,127 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import logging
+import random
+import threading
+import time
+
+"""
+AWS error codes indicating that a request was throttled and should be retried later.
+"""
+THROTTLING_ERROR_CODES = frozenset(['Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                                    'RequestThrottled', 'TooManyRequestsException', 'SlowDown'])
+
+
+def is_throttling_error(e):
+    """
+    Returns True if an exception raised by an AWS call (typically boto.exception.BotoServerError)
+    means the request was throttled.
+    """
+    return getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES or getattr(e, 'status', None) == 429
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by all AWS API calls made by the plugin, which retries throttled requests
+    individually with jittered exponential backoff.  Every throttled request halves the allowed rate;
+    each successful request then raises it again by a small step, up to the configured rate.
+    """
+
+    def __init__(self, rate=20.0, burst=None, min_rate=1.0, max_retries=8, base_delay=0.5, max_delay=20.0):
+        """
+        @param rate Maximum number of requests per second.
+        @param burst Maximum number of requests that can be made at once after a quiet period; defaults to rate.
+        @param min_rate The allowed rate is never lowered below this, however often we are throttled.
+        @param max_retries Number of times a throttled request is retried before the error is raised.
+        @param base_delay, max_delay A request throttled for the n-th time waits a random time between 0 and
+            min(max_delay, base_delay * 2^n) seconds before being retried.  max_delay must stay well below the
+            30 seconds after which the Boundary relay considers us dead.
+        """
+        self.max_rate, self.min_rate = float(rate), min(float(min_rate), float(rate))
+        self.rate = self.max_rate
+        self.burst = float(burst or rate)
+        self.max_retries, self.base_delay, self.max_delay = max_retries, base_delay, max_delay
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def reserve(self):
+        """
+        Takes a token from the bucket, returning the number of seconds to wait before it may be used.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve our token even if it isn't there yet, so waiting callers are served in order.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.stats['requests'] += 1
+            if wait:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += wait
+        return wait
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, waiting until one is available.
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.stats['throttles'] += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def retry_delay(self, e, attempt):
+        """
+        Decides whether a request that failed with exception e on the given attempt (counting from 0) should be
+        retried.  Returns the number of seconds to wait before retrying it, or None if the error should be raised.
+        """
+        if not is_throttling_error(e) or attempt >= self.max_retries:
+            return None
+        self.throttled()
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        logging.getLogger('RateLimiter').info("Request throttled (%s); retrying in %.1fs", e, delay)
+        with self.lock:
+            self.stats['retries'] += 1
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) once a token is available, retrying it if it is throttled.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+            else:
+                self.succeeded()
+                return result
+
+    def get_stats(self):
+        """
+        Returns a dictionary describing the limiter's state: the current rate and available tokens, and counts of
+        requests, requests that had to wait (and total seconds waited), throttled requests and retries.
+        """
+        with self.lock:
+            tokens = min(self.burst, self.tokens + (time.time() - self.updated) * self.rate)
+            stats = dict(rate=self.rate, tokens=tokens)
+            for name in ('requests', 'waits', 'wait_time', 'throttles', 'retries'):
+                stats[name] = self.stats[name]
+        return stats
@@ -0,0 +1,176 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import array
+import bisect
+import datetime
+import itertools
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
+
+try:
+    from itertools import izip as zip
+except ImportError:
+    # Python 3
+    pass
+
+from .boundary_plugin import EPOCH, unix_time
+
+
+def from_unix_time(seconds):
+    """
+    The inverse of boundary_plugin.unix_time: converts seconds since the epoch to a naive UTC datetime.
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class SeriesStore(Mapping):
+    """
+    Samples collected from CloudWatch, stored by column to keep large backfills small: each series (metric of an
+    entity) is interned to an integer id, under which its timestamps (as seconds since the epoch) and values are
+    kept in two arrays of doubles, and its statistic once.  That is 16 bytes per sample, instead of a tuple, a
+    datetime and a float.
+
+    It can be used as a read-only dictionary in the format returned by CloudwatchMetrics.get_metric_data,
+        {(RegionId, EntityName, MetricName): [(Timestamp, Value, Statistic), ...], ...}
+    whose lists are built on access.  Code handling many samples should use series() and the columns instead.
+    Series without any samples are left out.
+    """
+
+    def __init__(self):
+        # (RegionId, EntityName, MetricName) -> series id
+        self.ids = dict()
+        # Region, metric and statistic names repeat across thousands of series, so only one copy of each is kept.
+        self.strings = dict()
+        # Indexed by series id:
+        self.series_keys = []
+        self.series_statistics = []
+        self.series_timestamps = []
+        self.series_values = []
+
+    def series_id(self, key, statistic):
+        """
+        Returns the id of a series, adding it if necessary.
+        """
+        series_id = self.ids.get(key)
+        if series_id is None:
+            key = tuple(self.strings.setdefault(part, part) for part in key)
+            series_id = self.ids[key] = len(self.series_keys)
+            self.series_keys.append(key)
+            self.series_statistics.append(self.strings.setdefault(statistic, statistic))
+            self.series_timestamps.append(array.array(str('d')))
+            self.series_values.append(array.array(str('d')))
+        return series_id
+
+    def add(self, key, statistic, timestamp, value):
+        """
+        Adds a single sample.
+        @param timestamp The sample's time, in seconds since the epoch.
+        """
+        series_id = self.series_id(key, statistic)
+        self.series_timestamps[series_id].append(timestamp)
+        self.series_values[series_id].append(value)
+
+    def extend(self, key, statistic, timestamps, values):
+        """
+        Adds a number of samples to a series.
+        @param timestamps, values Sequences of the samples' times (in seconds since the epoch) and values.
+        """
+        series_id = self.series_id(key, statistic)
+        self.series_timestamps[series_id].extend(timestamps)
+        self.series_values[series_id].extend(values)
+
+    def update(self, other):
+        """
+        Adds all samples of another SeriesStore.
+        """
+        for key, statistic, timestamps, values in other.series():
+            self.extend(key, statistic, timestamps, values)
+
+    def series(self):
+        """
+        Yields a (key, statistic, timestamps, values) tuple for every series with samples, where timestamps and
+        values are the series' arrays.
+        """
+        for series_id, key in enumerate(self.series_keys):
+            timestamps = self.series_timestamps[series_id]
+            if timestamps:
+                yield key, self.series_statistics[series_id], timestamps, self.series_values[series_id]
+
+    def sort(self):
+        """
+        Sorts the samples of every series by timestamp, oldest first.  Series that are already in order (as
+        GetMetricData returns them) are only checked, without copying them.
+        """
+        for series_id, timestamps in enumerate(self.series_timestamps):
+            if all(a <= b for a, b in zip(timestamps, itertools.islice(timestamps, 1, None))):
+                continue
+            # Not in order (e.g. GetMetricStatistics results): reorder the values to match.
+            values = self.series_values[series_id]
+            order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+            self.series_timestamps[series_id] = array.array(str('d'), (timestamps[i] for i in order))
+            self.series_values[series_id] = array.array(str('d'), (values[i] for i in order))
+
+    def keep_latest(self):
+        """
+        Drops all but the latest sample of every series.
+        """
+        for series_id, timestamps in enumerate(self.series_timestamps):
+            if len(timestamps) > 1:
+                latest = max(range(len(timestamps)), key=timestamps.__getitem__)
+                self.series_timestamps[series_id] = array.array(str('d'), [timestamps[latest]])
+                self.series_values[series_id] = array.array(str('d'), [self.series_values[series_id][latest]])
+
+    def select_after(self, watermarks):
+        """
+        Returns a new SeriesStore holding only the samples of each series later than its watermark.  A sample
+        with the same timestamp as the watermark counts as already reported, whatever its value.  The series
+        must be sorted; each is cut with a single binary search.
+        @param watermarks Dictionary of {key: (Timestamp, ...)}, such as the status store; series without an
+            entry are kept whole.
+        """
+        out = SeriesStore()
+        for key, statistic, timestamps, values in self.series():
+            watermark = watermarks.get(key)
+            start = bisect.bisect_right(timestamps, unix_time(watermark[0])) if watermark else 0
+            if start < len(timestamps):
+                out.extend(key, statistic, timestamps[start:], values[start:])
+        return out
+
+    def select(self, predicate):
+        """
+        Returns a new SeriesStore holding only the series whose key predicate(key) returns True for.
+        """
+        out = SeriesStore()
+        for key, statistic, timestamps, values in self.series():
+            if predicate(key):
+                out.extend(key, statistic, timestamps, values)
+        return out
+
+    def latest_samples(self):
+        """
+        Returns a dictionary of {key: (Timestamp, Value, Statistic)} holding the last sample of every series, in
+        the format of the status store.  The series must be sorted.
+        """
+        return dict((key, (from_unix_time(timestamps[-1]), values[-1], statistic))
+                    for key, statistic, timestamps, values in self.series())
+
+    def __getitem__(self, key):
+        series_id = self.ids[key]
+        statistic = self.series_statistics[series_id]
+        if not self.series_timestamps[series_id]:
+            raise KeyError(key)
+        return [(from_unix_time(timestamp), value, statistic)
+                for timestamp, value in zip(self.series_timestamps[series_id], self.series_values[series_id])]
+
+    def __contains__(self, key):
+        series_id = self.ids.get(key)
+        return series_id is not None and len(self.series_timestamps[series_id]) > 0
+
+    def __iter__(self):
+        return (key for key, _, _, _ in self.series())
+
+    def __len__(self):
+        return sum(1 for timestamps in self.series_timestamps if timestamps)
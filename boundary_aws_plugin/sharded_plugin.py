@@ -0,0 +1,322 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from . import boundary_plugin
+from . import rate_limiter
+from . import sharding
+from . import worker_pool
+from .cloudwatch_plugin import CloudwatchPlugin, PLUGIN_RETRY_DELAY
+from .series_store import SeriesStore
+from .topology_snapshot import SnapshotEntity
+
+"""
+Sharded mode splits the (account, region, entity) space across a number of worker processes by consistent
+hashing.  The main process discovers the entities of all accounts and regions, once for all workers, and
+sends each worker those of its shard; as entities appear or disappear, each is picked up or dropped by its
+worker after the next discovery, without the others being affected.  Workers keep their own watermarks and
+hand new samples to the main process, which is the only one writing to the Boundary relay and the status
+store.
+"""
+
+"""
+Seconds the writer waits for data from the workers before checking that they are still running.
+"""
+WORKER_CHECK_INTERVAL = 5
+
+"""
+Number of batches of data each worker may have waiting for the writer before it blocks.
+"""
+QUEUED_BATCHES_PER_WORKER = 4
+
+
+class AccountSet(object):
+    """
+    Presents the CloudwatchMetrics objects of several AWS accounts as a single one to CloudwatchPlugin.
+    The objects are expected to share their rate limiter, connection registry and instrumentation.
+    """
+
+    def __init__(self, collectors):
+        self.collectors = collectors
+        self.rate_limiter = collectors[0].rate_limiter
+        self.connections = collectors[0].connections
+        self.instrumentation = collectors[0].instrumentation
+        self.sentinel_metric = collectors[0].sentinel_metric
+        self.get_derived_metrics = collectors[0].get_derived_metrics
+
+    def get_topology(self):
+        return [collector.get_topology() for collector in self.collectors]
+
+    def seed_topology(self, topology):
+        for collector, collector_topology in zip(self.collectors, topology):
+            collector.seed_topology(collector_topology)
+
+    def get_metric_data(self, *args, **kwargs):
+        out = SeriesStore()
+        for collector in self.collectors:
+            out.update(collector.get_metric_data(*args, **kwargs))
+        return out
+
+    def iter_metric_data(self, *args, **kwargs):
+        # Each account's regions are listed straight away, so that errors doing so are raised here.
+        return itertools.chain(*[collector.iter_metric_data(*args, **kwargs) for collector in self.collectors])
+
+    def close(self):
+        for collector in self.collectors:
+            collector.close()
+
+
+class ShardDiscovery(object):
+    """
+    Discovers the entities of every account and region in the main process, and sends each worker the entities
+    of its shard over its own queue whenever they change.  Metric keys don't include the account, so an entity
+    with the same name as one in the same region of an earlier account (in the order of the accounts setting)
+    is left out.
+    """
+
+    def __init__(self, collectors, account_names, shard_count, region_workers=1):
+        """
+        @param collectors The CloudwatchMetrics objects to discover the entities of each account with.
+        @param account_names The names of the accounts, which entities are hashed with.
+        @param region_workers Number of regions to discover in parallel.
+        """
+        self.collectors, self.account_names, self.region_workers = collectors, account_names, region_workers
+        self.ring = sharding.HashRing(shard_count)
+        self.queues = [multiprocessing.Queue() for _ in range(shard_count)]
+        # (account index, RegionId) -> [[EntityName, dimensions], ...] as last discovered
+        self.entities = dict()
+        # Indexed by shard: the last topology sent to its worker, a list of {RegionId: [[EntityName, dimensions],
+        # ...]} per account.
+        self.topologies = [None] * shard_count
+        self.lock = threading.Lock()
+
+    def discover_region(self, account_region):
+        account_index, region = account_region
+        collector = self.collectors[account_index]
+        return [[collector.entity_source_name(entity), collector.entity_dimensions(region, entity)]
+                for entity in collector.discover_entities(region)]
+
+    def discover(self):
+        """
+        Rediscovers the entities of every account and region, and sends each worker its shard's entities if they
+        have changed.  A region whose discovery fails keeps the entities found last time.
+        """
+        account_regions = [(account_index, region) for account_index, collector in enumerate(self.collectors)
+                           for region in collector.get_regions()]
+        results = worker_pool.map_concurrently(self.discover_region, account_regions, self.region_workers,
+                                               return_exceptions=True)
+        for (account_index, region), result in zip(account_regions, results):
+            if isinstance(result, Exception):
+                logging.error("Error discovering entities in region %s of account %s: %s", region.name,
+                              self.account_names[account_index], result)
+            else:
+                self.entities[(account_index, region.name)] = result
+
+        topologies = [[dict() for _ in self.collectors] for _ in self.queues]
+        owners = dict()
+        for (account_index, region_name), entities in sorted(self.entities.items()):
+            for entity_name, dimensions in entities:
+                owner = owners.setdefault((region_name, entity_name), account_index)
+                if owner != account_index:
+                    logging.error("Skipping %s in region %s of account %s: it has the same name as one in account %s",
+                                  entity_name, region_name, self.account_names[account_index],
+                                  self.account_names[owner])
+                    continue
+                shard = self.ring.get_shard((self.account_names[account_index], region_name, entity_name))
+                topologies[shard][account_index].setdefault(region_name, []).append([entity_name, dimensions])
+
+        with self.lock:
+            for shard, topology in enumerate(topologies):
+                if topology != self.topologies[shard]:
+                    self.topologies[shard] = topology
+                    self.queues[shard].put(topology)
+
+    def resend(self, shard):
+        """
+        Sends a shard's entities to its worker again, e.g. because the worker was restarted.
+        """
+        with self.lock:
+            if self.topologies[shard] is not None:
+                self.queues[shard].put(self.topologies[shard])
+
+    def start(self, interval):
+        """
+        Starts a background thread discovering the entities every interval seconds.
+        """
+        def discovery_main():
+            while True:
+                try:
+                    self.discover()
+                except Exception as e:
+                    logging.error("Error discovering entities: %s", e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=discovery_main, name='discovery')
+        thread.daemon = True
+        thread.start()
+
+
+class ShardEntities(object):
+    """
+    The entities of a worker's shard, as received from ShardDiscovery in the main process.
+    """
+
+    def __init__(self, entity_queue):
+        self.entity_queue = entity_queue
+        self.topology = None
+        self.lock = threading.Lock()
+
+    def get(self, account_index, region):
+        """
+        Returns the entities of an account in a region, as SnapshotEntity objects.  Blocks until the first
+        entities have been received; after that, the latest received are used.
+        """
+        with self.lock:
+            if self.topology is None:
+                self.topology = self.entity_queue.get()
+            while True:
+                try:
+                    self.topology = self.entity_queue.get_nowait()
+                except queue.Empty:
+                    break
+            return [SnapshotEntity(entity_name, dimensions)
+                    for entity_name, dimensions in self.topology[account_index].get(region.name, [])]
+
+
+class ShardWorker(CloudwatchPlugin):
+    """
+    Collects the metrics of one shard in a worker process, putting new samples on a queue for the writer
+    instead of reporting them.
+    """
+
+    def __init__(self, cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename, shard, shard_count,
+                 data_queue, entity_queue):
+        """
+        @param shard, shard_count This worker's shard number, and the total number of shards.
+        @param data_queue The multiprocessing.Queue to put SeriesStores of new samples on.
+        @param entity_queue The multiprocessing.Queue this shard's entities are received on; see ShardDiscovery.
+        """
+        super(ShardWorker, self).__init__(cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename)
+        self.shard, self.shard_count, self.data_queue = shard, shard_count, data_queue
+        self.entities = ShardEntities(entity_queue)
+        # Each worker backfills only its own shard's entities, and keeps its own topology snapshot.
+        self.state_basename = '%s-shard-%d' % (status_store_filename, shard)
+        self.parent_pid = None
+
+    def handle_metrics(self, data, reported_metrics):
+        # Stop if the writer is gone, rather than filling the queue for nobody.  Note that os.getppid()
+        # doesn't exist on Windows, hence the getattr workaround.
+        if getattr(os, 'getppid', lambda: self.parent_pid)() != self.parent_pid:
+            sys.exit(0)
+
+        out = data.select_after(reported_metrics)
+        reported_metrics.update(out.latest_samples())
+        if out:
+            self.data_queue.put(out)
+
+    def run(self, settings, reported_metrics):
+        """
+        Collects this shard's metrics forever.
+        @param reported_metrics Dictionary of the last sample reported for every metric, as in the status store.
+        """
+        self.parent_pid = getattr(os, 'getppid', lambda: None)()
+        logging.basicConfig(level=logging.ERROR, filename=settings.get('log_file', None))
+
+        options = get_shard_collector_options(self, settings)
+        # The entities come from the main process, which has already applied the collection filter; a shard may
+        # gain entities in a region that has none yet, so those are looked up as often as the others.
+        options['empty_region_ttl'] = options['entity_cache_ttl']
+        collectors = []
+        for account_index, account in enumerate(self.get_accounts(settings)):
+            def entity_source(region, account_index=account_index):
+                return self.entities.get(account_index, region)
+            collectors.append(self.cloudwatch_metrics_type(account.access_key_id, account.secret_key,
+                                                           entity_source=entity_source, **options))
+        self.cloudwatch_metrics = AccountSet(collectors)
+        self.collect(settings, reported_metrics)
+
+
+def get_shard_collector_options(plugin, settings):
+    """
+    Returns the keyword arguments used to construct the CloudwatchMetrics objects of the workers and of discovery,
+    which share api_rate_limit: it applies to the plugin as a whole.
+    """
+    options = plugin.get_collector_options(settings)
+    options['rate_limiter'] = rate_limiter.RateLimiter(float(settings.get('api_rate_limit', 20)) /
+                                                       max(1, int(settings.get('shards', 1))))
+    return options
+
+
+def _worker_main(cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename, shard, shard_count,
+                 data_queue, entity_queue, settings, reported_metrics):
+    worker = ShardWorker(cloudwatch_metrics_type, boundary_metric_prefix, status_store_filename, shard, shard_count,
+                         data_queue, entity_queue)
+    worker.run(settings, reported_metrics)
+
+
+def supervise(plugin, settings, reported_metrics):
+    """
+    Runs the plugin in sharded mode: starts a worker process for each of the configured number of shards
+    (restarting any that exit), and reports the samples they collect and saves the status store, as the
+    only writer.  Does not return.
+    @param plugin The CloudwatchPlugin to report data with.
+    @param reported_metrics The status store, as loaded by load_status_store.
+    """
+    shard_count = max(1, int(settings.get('shards', 1)))
+    data_queue = multiprocessing.Queue(shard_count * QUEUED_BATCHES_PER_WORKER)
+    workers = [None] * shard_count
+    restart_times = [0] * shard_count
+
+    # Discovery only needs the threaded collector, whatever the workers use.
+    options = get_shard_collector_options(plugin, settings)
+    options['collector'] = 'threads'
+    accounts = plugin.get_accounts(settings)
+    discovery = ShardDiscovery([plugin.cloudwatch_metrics_type(account.access_key_id, account.secret_key, **options)
+                                for account in accounts],
+                               [account.name for account in accounts], shard_count, options['region_workers'])
+
+    def start_worker(shard):
+        # Restarted workers pick up from what has been reported so far.
+        worker = multiprocessing.Process(target=_worker_main, name='shard-%d' % shard,
+                                         args=(plugin.cloudwatch_metrics_type, plugin.boundary_metric_prefix,
+                                               plugin.status_store_filename, shard, shard_count, data_queue,
+                                               discovery.queues[shard], settings, dict(reported_metrics)))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    discovery.start(max(options['entity_cache_ttl'], boundary_plugin.poll_interval()))
+    try:
+        while True:
+            for shard, worker in enumerate(workers):
+                if worker and worker.is_alive():
+                    continue
+                if worker:
+                    if not restart_times[shard]:
+                        logging.error("Shard %d worker exited with code %s; restarting it", shard, worker.exitcode)
+                        restart_times[shard] = time.time() + PLUGIN_RETRY_DELAY
+                    if time.time() < restart_times[shard]:
+                        continue
+                    discovery.resend(shard)
+                workers[shard], restart_times[shard] = start_worker(shard), 0
+
+            try:
+                data = data_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            plugin.handle_metrics(data, reported_metrics)
+    finally:
+        for worker in workers:
+            if worker and worker.is_alive():
+                worker.terminate()
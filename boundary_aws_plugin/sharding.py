@@ -0,0 +1,43 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import bisect
+import hashlib
+import struct
+
+"""
+Number of points each shard gets on the hash ring.  More points spread entities more evenly across shards.
+"""
+DEFAULT_REPLICAS = 128
+
+
+def _hash(value):
+    return struct.unpack('>Q', hashlib.md5(value.encode('utf-8')).digest()[:8])[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys (e.g. (account, region, load balancer) tuples) onto a number of shards.
+    A key keeps its shard when other keys come and go, and when a shard is added only about 1/n of the
+    keys move to it, so a rebalance after entities appear or disappear moves as few of them as possible.
+    """
+
+    def __init__(self, shard_count, replicas=DEFAULT_REPLICAS):
+        """
+        @param shard_count Number of shards, numbered from 0.
+        @param replicas Number of points on the ring for each shard.
+        """
+        self.shard_count = shard_count
+        points = sorted((_hash('%d-%d' % (shard, replica)), shard)
+                        for shard in range(shard_count) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def get_shard(self, key):
+        """
+        Returns the shard a key belongs to.
+        @param key A string, or a tuple of strings.
+        """
+        if self.shard_count == 1:
+            return 0
+        if isinstance(key, tuple):
+            key = '\0'.join(key)
+        return self.shards[bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)]
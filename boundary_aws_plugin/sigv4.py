@@ -0,0 +1,83 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import hashlib
+import hmac
+
+try:
+    from urllib.parse import quote, urlsplit, parse_qsl
+except ImportError:
+    # Python 2
+    from urllib import quote
+    from urlparse import urlsplit, parse_qsl
+
+"""
+AWS Signature Version 4 request signing, for making AWS API requests without boto.
+See http://docs.aws.amazon.com/general/latest/gr/signature-version-4.html
+"""
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+AMZ_DATE_FORMAT = '%Y%m%dT%H%M%SZ'
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _quote(value, safe='-_.~'):
+    return quote(_to_bytes(value), safe=safe)
+
+
+def _hmac(key, message):
+    return hmac.new(key, _to_bytes(message), hashlib.sha256).digest()
+
+
+def canonical_request(method, url, headers, body):
+    """
+    Returns the canonical form of a request, and the semicolon-separated list of header names it covers.
+    @param headers Dictionary of the headers to sign.
+    @param body The request body, as bytes.
+    """
+    parts = urlsplit(url)
+    query = '&'.join('%s=%s' % (_quote(name), _quote(value))
+                     for name, value in sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    canonical_headers = sorted((name.lower(), ' '.join(value.split())) for name, value in headers.items())
+    signed_headers = ';'.join(name for name, _ in canonical_headers)
+    return '\n'.join([method, _quote(parts.path or '/', safe='/-_.~'), query,
+                      ''.join('%s:%s\n' % header for header in canonical_headers), signed_headers,
+                      hashlib.sha256(_to_bytes(body)).hexdigest()]), signed_headers
+
+
+def authorization(method, url, headers, body, region, service, access_key_id, secret_access_key):
+    """
+    Returns the value of the Authorization header for a request.
+    @param headers Dictionary of the headers to sign; must include Host and X-Amz-Date.
+    """
+    amz_date = dict((name.lower(), value) for name, value in headers.items())['x-amz-date']
+    scope = '%s/%s/%s/aws4_request' % (amz_date[:8], region, service)
+    request, signed_headers = canonical_request(method, url, headers, body)
+    string_to_sign = '\n'.join([ALGORITHM, amz_date, scope, hashlib.sha256(_to_bytes(request)).hexdigest()])
+
+    key = _to_bytes('AWS4' + secret_access_key)
+    for part in (amz_date[:8], region, service, 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, _to_bytes(string_to_sign), hashlib.sha256).hexdigest()
+    return '%s Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (ALGORITHM, access_key_id, scope,
+                                                                    signed_headers, signature)
+
+
+def sign_request(method, url, headers, body, region, service, access_key_id, secret_access_key, now=None):
+    """
+    Signs a request, returning a copy of headers with the Host, X-Amz-Date and Authorization headers added.
+    @param method The HTTP method, e.g. 'POST'.
+    @param url The full URL of the request, including any query string.
+    @param headers Dictionary of headers to send (and sign).
+    @param body The request body, as bytes.
+    @param region, service The AWS region and service name (e.g. 'monitoring' for CloudWatch).
+    @param now The time to sign the request at; defaults to now.
+    """
+    headers = dict(headers)
+    headers.setdefault('Host', urlsplit(url).netloc)
+    headers['X-Amz-Date'] = (now or datetime.datetime.utcnow()).strftime(AMZ_DATE_FORMAT)
+    headers['Authorization'] = authorization(method, url, headers, body, region, service, access_key_id,
+                                             secret_access_key)
+    return headers
@@ -1,21 +1,252 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import io
+import logging
 import os
-import pickle
 import tempfile
 
+"""
+The status store keeps the last sample reported for every metric, so we can avoid reporting duplicates and
+can catch up on data we missed while the plugin wasn't running.
+
+It is stored as a UTF-8 text file: a header line identifying the format version, followed by one
+tab-separated record per line:
+    RegionId  EntityName  MetricName  Timestamp  Value  Statistic
+where Timestamp is in seconds since the epoch.  Records are only ever appended; when a metric appears
+more than once, the last record wins.  A record that was only partially written (e.g. because the
+plugin was killed) is ignored.  Once the file has grown well beyond the number of metrics it describes,
+it is compacted by writing a fresh copy and atomically replacing the old one.
+"""
+STATUS_STORE_HEADER = 'boundary-status-store 1'
+
+"""
+The file is compacted when it holds more than this many superseded records, and more superseded
+records than live ones.
+"""
+COMPACTION_MIN_STALE_RECORDS = 1024
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
 
 def status_store_filename(basename):
     return os.path.join(tempfile.gettempdir(), basename)
 
 
+def _encode_record(key, value):
+    timestamp, metric_value, statistic = value
+    delta = timestamp - EPOCH
+    seconds = delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+    return '%s\t%s\t%s\t%r\t%r\t%s\n' % (key[0], key[1], key[2], seconds, float(metric_value), statistic)
+
+
+def _decode_records(lines, out):
+    """
+    Decodes records into the dictionary out, returning the lines that could not be decoded.
+    """
+    # Most metrics were last reported at one of a handful of timestamps, so convert each only once.
+    timestamps = dict()
+    malformed = []
+    for line in lines:
+        try:
+            region, entity, metric, seconds, metric_value, statistic = line.split('\t')
+            timestamp = timestamps.get(seconds)
+            if timestamp is None:
+                timestamp = timestamps[seconds] = EPOCH + datetime.timedelta(seconds=float(seconds))
+            out[(region, entity, metric)] = (timestamp, float(metric_value), statistic)
+        except ValueError:
+            malformed.append(line)
+    return malformed
+
+
+def fsync_directory(path):
+    # Make the rename itself durable.  Not supported on Windows, where it isn't needed either.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (AttributeError, OSError):
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def replace_file(src, dst):
+    """
+    Renames src to dst, atomically replacing dst if it exists (where the platform allows).
+    """
+    replace = getattr(os, 'replace', None)
+    if replace:
+        replace(src, dst)
+        return
+    # Python 2: rename is atomic on POSIX, but fails on Windows if the destination exists.
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class StatusStore(dict):
+    """
+    A dictionary of {(RegionId, EntityName, MetricName): (Timestamp, Value, Statistic)} that tracks which
+    metrics have changed since it was last saved, so that saving only appends those.
+    """
+
+    def __init__(self, basename, *args, **kwargs):
+        super(StatusStore, self).__init__(*args, **kwargs)
+        self.basename = basename
+        self.dirty = set(self.keys())
+        # Number of records in the file on disk, including superseded ones.  None if the
+        # file needs to be rewritten from scratch.
+        self.file_records = None
+
+    def __setitem__(self, key, value):
+        super(StatusStore, self).__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super(StatusStore, self).__delitem__(key)
+        self.dirty.discard(key)
+        self.file_records = None
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def save(self):
+        """
+        Writes all changes since the last save to disk, compacting the file if necessary.
+        """
+        stale_records = (self.file_records or 0) + len(self.dirty) - len(self)
+        if self.file_records is None or stale_records > max(COMPACTION_MIN_STALE_RECORDS, len(self)):
+            self.compact()
+            return
+        if not self.dirty:
+            return
+
+        with io.open(status_store_filename(self.basename), 'a', encoding='utf-8') as f:
+            f.write(''.join(_encode_record(key, self[key]) for key in self.dirty))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file_records += len(self.dirty)
+        self.dirty.clear()
+
+    def compact(self):
+        """
+        Rewrites the status store file with a single record per metric.  The new file is written alongside
+        the old one and then renamed over it, so a crash leaves either the old or the new file in place.
+        """
+        filename = status_store_filename(self.basename)
+        temp_filename = filename + '.tmp'
+        with io.open(temp_filename, 'w', encoding='utf-8') as f:
+            f.write(STATUS_STORE_HEADER + '\n')
+            f.write(''.join(_encode_record(key, value) for key, value in self.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_filename, filename)
+        fsync_directory(os.path.dirname(filename))
+        self.file_records = len(self)
+        self.dirty.clear()
+
+
+def _load_legacy_pickle(filename):
+    # Only needed to convert old status stores, so kept off the startup path.
+    import pickle
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
 def load_status_store(basename):
+    """
+    Loads the status store, returning a (possibly empty) StatusStore object.
+    Status stores written by older versions of the plugin (as a pickle) are converted.
+    """
+    logger = logging.getLogger('status_store')
+    filename = status_store_filename(basename)
+    store = StatusStore(basename)
+    try:
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+    except IOError:
+        # No status store yet
+        return store
+    except UnicodeDecodeError:
+        lines = None
+
+    if lines and lines[0] == STATUS_STORE_HEADER:
+        # The last element is either empty (the file ends with a newline), or a partially written record.
+        records = lines[1:-1]
+        data = dict()
+        for line in _decode_records(records, data):
+            logger.error("Ignoring malformed status store record: %r", line)
+        dict.update(store, data)
+        # Appending after a partially written record would corrupt the next one, so rewrite the file instead.
+        store.file_records = len(records) if not lines[-1] else None
+        return store
+
+    try:
+        data = _load_legacy_pickle(filename)
+    except Exception as e:
+        # Keep the unreadable file around for inspection instead of overwriting it.
+        logger.error("Unable to read status store %s (%s); starting with an empty one", filename, e)
+        replace_file(filename, filename + '.corrupt')
+        return store
+    store.update(data)
+    return store
+
+
+def backfill_marker_filename(basename):
+    return status_store_filename(basename) + '.backfill'
+
+
+def save_backfill_start(basename, start_time):
+    """
+    Records that a backfill from start_time (a naive UTC datetime) is in progress.  The status store is saved as
+    each region's data is reported, so an interrupted backfill leaves some metrics further along than others;
+    the marker lets the next run catch up on the metrics that were behind from where the backfill started,
+    rather than from the latest reported sample.
+    """
+    filename = backfill_marker_filename(basename)
+    delta = start_time - EPOCH
+    with io.open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('%r\n' % (delta.days * 86400 + delta.seconds + delta.microseconds / 1e6))
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(filename + '.tmp', filename)
+    fsync_directory(os.path.dirname(filename))
+
+
+def load_backfill_start(basename):
+    """
+    Returns the start time of an interrupted backfill (see save_backfill_start), or None if there is none.
+    """
     try:
-        with open(status_store_filename(basename), 'rb') as f:
-            return pickle.load(f)
-    except:
+        with io.open(backfill_marker_filename(basename), 'r', encoding='utf-8') as f:
+            return EPOCH + datetime.timedelta(seconds=float(f.read()))
+    except IOError:
+        return None
+    except ValueError:
+        logging.getLogger('status_store').error("Ignoring unreadable backfill marker")
         return None
 
 
-def save_status_store(basename, data):
-    with open(status_store_filename(basename), 'wb') as f:
-        return pickle.dump(data, f)
+def clear_backfill_start(basename):
+    """
+    Records that the backfill is complete.
+    """
+    try:
+        os.remove(backfill_marker_filename(basename))
+    except OSError:
+        pass
 
+
+def save_status_store(basename, data):
+    """
+    Saves the status store.  If data is the StatusStore returned by load_status_store, only changes since the last
+    save are written; any other dictionary is written in full.
+    """
+    if not isinstance(data, StatusStore) or data.basename != basename:
+        data = StatusStore(basename, data)
+    data.save()
@@ -0,0 +1,94 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+
+from .status_store import fsync_directory, replace_file, status_store_filename
+
+"""
+The topology snapshot records what the plugin has discovered: the regions, the entities in each region with
+their dimensions, and the resolutions learned for metrics.  It is saved as JSON next to the status store, so
+that a restarted plugin can poll straight away instead of waiting on discovery, while the snapshot is
+revalidated in the background.  A snapshot of another format version, or taken with other settings (see
+settings_fingerprint), is ignored.
+"""
+TOPOLOGY_SNAPSHOT_VERSION = 1
+
+"""
+Seconds between saves of the topology snapshot while polling; the first poll always saves one.
+"""
+TOPOLOGY_SNAPSHOT_INTERVAL = 300
+
+"""
+A region restored from a snapshot, standing in for a boto.regioninfo.RegionInfo object until the region list
+has been revalidated.
+"""
+SnapshotRegion = collections.namedtuple('SnapshotRegion', 'name')
+
+"""
+An entity restored from a snapshot, standing in for the entities returned by get_entities_for_region until
+they have been rediscovered.
+"""
+SnapshotEntity = collections.namedtuple('SnapshotEntity', 'name dimensions')
+
+
+def topology_snapshot_filename(basename):
+    return status_store_filename(basename) + '.topology'
+
+
+def settings_fingerprint(*settings):
+    """
+    Returns a string identifying the settings that decide which entities are discovered, so that a snapshot is
+    only reused with the same settings.  It is a hash, so the settings themselves (e.g. access key IDs) aren't
+    written out.
+    @param settings Any values that can be saved as JSON.
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def save_topology_snapshot(basename, fingerprint, topology, resolutions):
+    """
+    Saves a topology snapshot, replacing the previous one atomically.
+    @param fingerprint See settings_fingerprint.
+    @param topology The regions and entities, as returned by CloudwatchMetrics.get_topology.
+    @param resolutions Dictionary of {(RegionId, EntityName, MetricName): resolution in seconds}.
+    """
+    filename = topology_snapshot_filename(basename)
+    snapshot = dict(version=TOPOLOGY_SNAPSHOT_VERSION, fingerprint=fingerprint, saved_at=time.time(),
+                    topology=topology,
+                    resolutions=[list(metric_key) + [seconds] for metric_key, seconds in resolutions.items()])
+    with io.open(filename + '.tmp', 'wb') as f:
+        f.write(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+    replace_file(filename + '.tmp', filename)
+    fsync_directory(os.path.dirname(filename))
+
+
+def load_topology_snapshot(basename, fingerprint):
+    """
+    Loads the topology snapshot, returning a (topology, resolutions) tuple as passed to save_topology_snapshot,
+    or None if there is no usable snapshot.
+    """
+    filename = topology_snapshot_filename(basename)
+    logger = logging.getLogger('topology_snapshot')
+    try:
+        with io.open(filename, 'rb') as f:
+            snapshot = json.loads(f.read().decode('utf-8'))
+    except IOError:
+        return None
+    except ValueError as e:
+        logger.error("Ignoring unreadable topology snapshot %s (%s)", filename, e)
+        return None
+
+    if snapshot.get('version') != TOPOLOGY_SNAPSHOT_VERSION or snapshot.get('fingerprint') != fingerprint:
+        logger.info("Ignoring topology snapshot taken with other settings")
+        return None
+    try:
+        resolutions = dict((tuple(record[:3]), record[3]) for record in snapshot['resolutions'])
+        return snapshot['topology'], resolutions
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        logger.error("Ignoring malformed topology snapshot %s (%s)", filename, e)
+        return None
@@ -0,0 +1,172 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+"""
+Seconds an idle worker thread waits for more work before it exits.  Longer than the usual poll interval,
+so that polls reuse the threads of the previous one.
+"""
+WORKER_IDLE_TIMEOUT = 600
+
+
+class ThreadCache(object):
+    """
+    Runs tasks on long-lived daemon threads, starting a new thread only when none is idle.  Unlike a pool of
+    fixed size, a task can itself wait for tasks it submits (e.g. a region's fetches, from a task of the
+    region pool) without running out of threads.
+    """
+
+    def __init__(self, idle_timeout=WORKER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        self.tasks = queue.Queue()
+        # Number of threads waiting for a task, less the tasks queued for them
+        self.idle = 0
+        self.pid = os.getpid()
+
+    def submit(self, task):
+        """
+        Calls task (a function without arguments) on a worker thread.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked: the threads stayed with the parent.
+                self.reset()
+            if self.idle:
+                self.idle -= 1
+                self.tasks.put(task)
+                return
+        t = threading.Thread(target=self.worker, args=(task,))
+        t.daemon = True
+        t.start()
+
+    def worker(self, task):
+        while True:
+            task()
+            # Not kept alive (along with whatever it refers to) while waiting for the next one
+            task = None
+            with self.lock:
+                self.idle += 1
+            while True:
+                try:
+                    task = self.tasks.get(timeout=self.idle_timeout)
+                    break
+                except queue.Empty:
+                    with self.lock:
+                        if self.tasks.empty():
+                            self.idle -= 1
+                            return
+
+
+"""
+The worker threads shared by map_concurrently and imap_unordered.
+"""
+_threads = ThreadCache()
+
+
+def map_concurrently(func, items, max_workers=1, return_exceptions=False):
+    """
+    Calls func on every item of items, using up to max_workers threads (reused from earlier calls).
+    @param func The function to call; it is passed a single item.
+    @param items An iterable of items to process.
+    @param max_workers Maximum number of worker threads.  With 1 (or a single item), all
+        calls are made sequentially on the calling thread.
+    @param return_exceptions False to raise the first exception (in item order) once all
+        calls have completed; True to return exceptions in place of the failed results.
+    @return A list of results, in the same order as items.
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        results = []
+        for item in items:
+            try:
+                results.append(func(item))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    results = [None] * len(items)
+    failed = [False] * len(items)
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    worker_count = min(max_workers, len(items))
+    finished = threading.Semaphore(0)
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except queue.Empty:
+                finished.release()
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                results[index], failed[index] = e, True
+
+    for _ in range(worker_count):
+        _threads.submit(worker)
+    for _ in range(worker_count):
+        finished.acquire()
+
+    if not return_exceptions:
+        for index, result in enumerate(results):
+            if failed[index]:
+                raise result
+    return results
+
+
+def imap_unordered(func, items, max_workers=1):
+    """
+    Like map_concurrently, but yields the results one by one as they become available (in completion
+    order rather than item order), so that the caller can handle the first results while the rest are
+    still being computed.  An exception raised by func is raised from the generator in place of its result.
+    If the caller stops iterating, items not yet started are skipped.
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pending, done = queue.Queue(), queue.Queue()
+    for item in items:
+        pending.put(item)
+    stopped = []
+
+    def worker():
+        while not stopped:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((func(item), None))
+            except Exception as e:
+                done.put((None, e))
+
+    for _ in range(min(max_workers, len(items))):
+        _threads.submit(worker)
+    try:
+        for _ in items:
+            result, error = done.get()
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        stopped.append(True)
@@ -2,8 +2,8 @@ import boto
 import boto.ec2.elb
 import datetime
 import logging
-from boto.ec2.cloudwatch import CloudWatchConnection
-from boto.ec2 import RegionInfo
+
+from boundary_aws_plugin.connection_registry import default_registry
 
 __all__ = ['get_elb_metrics']
 
@@ -69,44 +69,42 @@ def get_elb_metrics(access_key_id, secret_access_key, only_latest=True, start_ti
         # Some regions are returned that actually do not support EC2.  Skip those.
         if region.name in ['cn-north-1', 'us-gov-west-1']:
             continue
-        elb = boto.connect_elb(access_key_id, secret_access_key, region=region)
-        cloud_watch = boto.connect_cloudwatch(access_key_id, secret_access_key,region=region)
-
-        load_balancers = elb.get_all_load_balancers()
-        for lb in load_balancers:
-            logger.info("\tELB: %s" % lb.name)
-
-            for metric in ELB_METRICS:
-                # AWS ELB Metric Name
-                metric_name = metric[0]
-                # AWS Statistic
-                metric_statistic = metric[1]
-                # Boundary metric identifier
-                metric_name_id = metric[2]
-                logger.info("\t\tELB Metric: %s %s %s" % (metric_name, metric_statistic, metric_name_id))
-                
-                region = RegionInfo(name=region.name,endpoint="monitoring." + region.name + ".amazonaws.com")
-                cw = boto.connect_cloudwatch(access_key_id, secret_access_key,region=region)
-                data = cw.get_metric_statistics(period=period, start_time=start_time, end_time=end_time,
-                                                metric_name=metric_name, namespace='AWS/ELB',
-                                                statistics=metric_statistic,
-                                                dimensions=dict(LoadBalancerName=lb.name))
-                if not data:
-                    logger.info("\t\t\tNo data")
-                    continue
-
-                if only_latest:
-                    # Pick out the latest sample only
-                    data = [max(data, key=lambda d: d['Timestamp'])]
-                else:
-                    # Output all retrieved samples as a list, sorted by timestamp
-                    data = sorted(data, key=lambda d: d['Timestamp'])
-
-                out_metric = []
-                for sample in data:
-                    logger.info("\t\t\tELB Value: %s: %s" % (sample['Timestamp'], sample[metric_statistic]))
-                    out_metric.append((sample['Timestamp'], sample[metric_statistic], metric_statistic, metric_name_id))
-                out[(region.name, lb.name, metric_name)] = out_metric
+        with default_registry.connection('elb', region.name, access_key_id, secret_access_key) as elb:
+            load_balancers = elb.get_all_load_balancers()
+
+        with default_registry.connection('cloudwatch', region.name, access_key_id, secret_access_key) as cw:
+            for lb in load_balancers:
+                logger.info("\tELB: %s" % lb.name)
+
+                for metric in ELB_METRICS:
+                    # AWS ELB Metric Name
+                    metric_name = metric[0]
+                    # AWS Statistic
+                    metric_statistic = metric[1]
+                    # Boundary metric identifier
+                    metric_name_id = metric[2]
+                    logger.info("\t\tELB Metric: %s %s %s" % (metric_name, metric_statistic, metric_name_id))
+
+                    data = cw.get_metric_statistics(period=period, start_time=start_time, end_time=end_time,
+                                                    metric_name=metric_name, namespace='AWS/ELB',
+                                                    statistics=metric_statistic,
+                                                    dimensions=dict(LoadBalancerName=lb.name))
+                    if not data:
+                        logger.info("\t\t\tNo data")
+                        continue
+
+                    if only_latest:
+                        # Pick out the latest sample only
+                        data = [max(data, key=lambda d: d['Timestamp'])]
+                    else:
+                        # Output all retrieved samples as a list, sorted by timestamp
+                        data = sorted(data, key=lambda d: d['Timestamp'])
+
+                    out_metric = []
+                    for sample in data:
+                        logger.info("\t\t\tELB Value: %s: %s" % (sample['Timestamp'], sample[metric_statistic]))
+                        out_metric.append((sample['Timestamp'], sample[metric_statistic], metric_statistic, metric_name_id))
+                    out[(region.name, lb.name, metric_name)] = out_metric
 
     return out
 
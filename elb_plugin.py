@@ -1,22 +1,70 @@
-import boto
-import boto.ec2.elb
 import sys
 
 from boundary_aws_plugin.cloudwatch_plugin import CloudwatchPlugin
 from boundary_aws_plugin.cloudwatch_metrics import CloudwatchMetrics
+from boundary_aws_plugin.derived_metrics import Ratio, RollingSum
+
+"""
+DescribeTags accepts at most this many load balancer names in a single call.
+"""
+DESCRIBE_TAGS_MAX_NAMES = 20
+
+
+def _local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def parse_describe_tags(body):
+    """
+    Parses a DescribeTags response body into a dictionary of {LoadBalancerName: {TagKey: TagValue}}.
+    """
+    # Only needed with tag rules, so kept off the startup path.
+    import xml.etree.ElementTree as ElementTree
+    out = dict()
+    for element in ElementTree.fromstring(body).iter():
+        if _local_name(element) != 'TagDescriptions':
+            continue
+        for description in element:
+            fields = dict((_local_name(child), child) for child in description)
+            tags = out[fields['LoadBalancerName'].text] = dict()
+            for tag in fields.get('Tags', []):
+                tag_fields = dict((_local_name(child), child.text or '') for child in tag)
+                tags[tag_fields['Key']] = tag_fields.get('Value', '')
+    return out
 
 
 class ElbCloudwatchMetrics(CloudwatchMetrics):
-    def __init__(self, access_key_id, secret_access_key):
-        return super(ElbCloudwatchMetrics, self).__init__(access_key_id, secret_access_key, 'AWS/ELB')
+    sentinel_metric = 'AWS_ELB_REQUEST_COUNT'
+
+    def __init__(self, access_key_id, secret_access_key, **kwargs):
+        return super(ElbCloudwatchMetrics, self).__init__(access_key_id, secret_access_key, 'AWS/ELB', **kwargs)
 
     def get_region_list(self):
+        import boto.ec2.elb
         # Some regions are returned that actually do not support EC2.  Skip those.
         return [r for r in boto.ec2.elb.regions() if r.name not in ['cn-north-1', 'us-gov-west-1']]
 
     def get_entities_for_region(self, region):
-        elb = boto.connect_elb(self.access_key_id, self.secret_access_key, region=region)
-        return elb.get_all_load_balancers()
+        with self.connection('elb', region) as elb:
+            return self.call_aws(elb.get_all_load_balancers)
+
+    def get_entity_tags(self, region, load_balancers):
+        # boto 2 has no wrapper for ELB's DescribeTags, so it is called through the connection's make_request.
+        names = [load_balancer.name for load_balancer in load_balancers]
+        out = dict()
+        with self.connection('elb', region) as elb:
+            for i in range(0, len(names), DESCRIBE_TAGS_MAX_NAMES):
+                params = dict(('LoadBalancerNames.member.%d' % (n + 1), name)
+                              for n, name in enumerate(names[i:i + DESCRIBE_TAGS_MAX_NAMES]))
+                out.update(parse_describe_tags(self.call_aws(self.describe_tags, elb, params)))
+        return out
+
+    def describe_tags(self, elb, params):
+        response = elb.make_request('DescribeTags', params)
+        body = response.read()
+        if response.status != 200:
+            raise elb.ResponseError(response.status, response.reason, body)
+        return body
 
     def get_entity_dimensions(self, region, load_balancer):
         return dict(LoadBalancerName=load_balancer.name)
@@ -27,6 +75,9 @@ class ElbCloudwatchMetrics(CloudwatchMetrics):
             ('UnHealthyHostCount', 'Average', 'AWS_ELB_UNHEALTHY_HOST_COUNT'),
             ('RequestCount', 'Sum', 'AWS_ELB_REQUEST_COUNT'),
             ('Latency', 'Average', 'AWS_ELB_LATENCY'),
+            ('Latency', 'p50', 'AWS_ELB_LATENCY_P50'),
+            ('Latency', 'p90', 'AWS_ELB_LATENCY_P90'),
+            ('Latency', 'p99', 'AWS_ELB_LATENCY_P99'),
             ('HTTPCode_ELB_4XX', 'Sum', 'AWS_ELB_HTTP_CODE_4XX'),
             ('HTTPCode_ELB_5XX', 'Sum', 'AWS_ELB_HTTP_CODE_5XX'),
             ('HTTPCode_Backend_2XX', 'Sum', 'AWS_ELB_HTTP_CODE_BACKEND_2XX'),
@@ -38,12 +89,22 @@ class ElbCloudwatchMetrics(CloudwatchMetrics):
             ('SpilloverCount', 'Sum', 'AWS_ELB_SPILLOVER_COUNT'),
         )
 
+    def get_derived_metric_list(self):
+        return (
+            ('AWS_ELB_HTTP_CODE_5XX_RATE', Ratio('AWS_ELB_HTTP_CODE_5XX', 'AWS_ELB_REQUEST_COUNT')),
+            ('AWS_ELB_HTTP_CODE_BACKEND_5XX_RATE', Ratio('AWS_ELB_HTTP_CODE_BACKEND_5XX', 'AWS_ELB_REQUEST_COUNT')),
+            ('AWS_ELB_HTTP_CODE_BACKEND_5XX_RATE_5M',
+             Ratio('AWS_ELB_HTTP_CODE_BACKEND_5XX', 'AWS_ELB_REQUEST_COUNT', window=300)),
+            ('AWS_ELB_REQUEST_COUNT_5M', RollingSum('AWS_ELB_REQUEST_COUNT', 300)),
+        )
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == '-v':
         import logging
         logging.basicConfig(level=logging.INFO)
 
-    plugin = CloudwatchPlugin(ElbCloudwatchMetrics, '', 'boundary-plugin-aws-elb-python-status')
+    plugin = CloudwatchPlugin(ElbCloudwatchMetrics, '', 'boundary-plugin-aws-elb-python-status',
+                              self_metrics_prefix='AWS_ELB_PLUGIN_')
     plugin.main()
 
@@ -0,0 +1,409 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import datetime
+import random
+import re
+import threading
+import time
+import zlib
+from xml.sax.saxutils import escape
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+
+from boundary_aws_plugin import sigv4
+from boundary_aws_plugin.connection_registry import ConnectionRegistry
+from boundary_aws_plugin.metric_fetchers import CLOUDWATCH_TIMESTAMP_FORMAT, parse_timestamp
+from elb_plugin import ElbCloudwatchMetrics
+
+"""
+Offline stand-ins for the AWS APIs used by the plugin.  These implement just enough of the boto 2
+connection interface for CloudwatchMetrics to run against them without network access or credentials.
+Used by the tests and the benchmarks; not part of the plugin.
+"""
+
+CLOUDWATCH_XMLNS = 'http://monitoring.amazonaws.com/doc/2010-08-01/'
+
+ELB_XMLNS = 'http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/'
+
+THROTTLING_RESPONSE = ('<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+                       '<Message>Rate exceeded</Message></Error></ErrorResponse>')
+
+INTERNAL_FAILURE_RESPONSE = ('<ErrorResponse><Error><Type>Receiver</Type><Code>InternalFailure</Code>'
+                             '</Error></ErrorResponse>')
+
+
+class FakeServerError(Exception):
+    """
+    Mirrors boto.exception.BotoServerError.
+    """
+    def __init__(self, status, reason, body=None, error_code=None):
+        super(FakeServerError, self).__init__(status, reason, body)
+        self.status, self.reason, self.body = status, reason, body
+        match = re.search('<Code>(.*?)</Code>', body or '')
+        self.error_code = error_code or (match and match.group(1))
+
+
+class FakeResponse(object):
+    def __init__(self, body, status=200, reason='OK'):
+        self.body, self.status, self.reason = body, status, reason
+
+    def read(self):
+        return self.body
+
+
+def _hash(*args):
+    return zlib.crc32(('|'.join('%s' % arg for arg in args)).encode('utf-8')) & 0xffffffff
+
+
+def default_value(region_name, metric_name, statistic, dimensions, timestamp):
+    """
+    Returns a deterministic pseudo-random value for a datapoint.
+    """
+    return float(_hash(region_name, metric_name, statistic, sorted(dimensions.items()), timestamp) % 1000)
+
+
+class FakeService(object):
+    """
+    Base class for the fake services: counts requests, and simulates latency, throttling and failures.
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        """
+        @param latency Time each request takes, in seconds.
+        @param throttle_rate Fraction of requests that are rejected with a Throttling error.
+        @param seed Seed for the random choice of throttled requests.
+        """
+        self.latency, self.throttle_rate, self.random = latency, throttle_rate, random.Random(seed)
+        self.calls = collections.Counter()
+        # Region or entity name -> number of the next requests about it that fail; see check_failures.
+        self.failures = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record_call(self, action):
+        """
+        Counts a request, returning False if it should be throttled.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[action] += 1
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                self.calls['Throttled'] += 1
+                return False
+        return True
+
+    def check_failures(self, *names):
+        """
+        Raises an InternalFailure error if any of the given region or entity names has failures left in
+        self.failures, using one of them up.
+        """
+        with self.lock:
+            for name in names:
+                if self.failures[name] > 0:
+                    self.failures[name] -= 1
+                    self.calls['Failed'] += 1
+                    raise FakeServerError(500, 'Internal Server Error', INTERNAL_FAILURE_RESPONSE)
+
+
+class FakeCloudwatch(FakeService):
+    """
+    An in-memory CloudWatch service.  Metrics have a datapoint at each period boundary, or at a
+    deterministic pseudo-random subset of them if density is less than 1.
+    """
+    def __init__(self, period=60, page_size=100800, value_function=default_value, density=1.0, **kwargs):
+        """
+        @param period Spacing of the generated datapoints, in seconds.
+        @param page_size Maximum number of datapoints returned by one GetMetricData call
+            before a NextToken is issued.
+        @param value_function Function computing the value of each datapoint; see default_value.
+        @param density Fraction of periods that have a datapoint.
+        Other keyword arguments are passed to FakeService.
+        """
+        super(FakeCloudwatch, self).__init__(**kwargs)
+        self.period, self.page_size, self.value_function = period, page_size, value_function
+        self.density = density
+
+    def connect_to_region(self, region_name, **kwargs):
+        return FakeCloudwatchConnection(self, region_name)
+
+    def datapoints(self, region_name, metric_name, statistic, dimensions, start_time, end_time):
+        """
+        Returns a list of (Timestamp, Value) tuples for a metric over [start_time, end_time).
+        """
+        epoch = datetime.datetime.utcfromtimestamp(0)
+        offset = int((start_time - epoch).total_seconds())
+        timestamp = epoch + datetime.timedelta(seconds=offset + (-offset % self.period))
+        out = []
+        while timestamp < end_time:
+            if self.density >= 1 or _hash(region_name, metric_name, dimensions, timestamp) % 1000 < self.density * 1000:
+                out.append((timestamp, self.value_function(region_name, metric_name, statistic, dimensions, timestamp)))
+            timestamp += datetime.timedelta(seconds=self.period)
+        return out
+
+
+class FakeCloudwatchConnection(object):
+    """
+    Mirrors the subset of boto.ec2.cloudwatch.CloudWatchConnection used by the plugin.
+    """
+    ResponseError = FakeServerError
+
+    def __init__(self, service, region_name):
+        self.service, self.region_name = service, region_name
+
+    def get_metric_statistics(self, period, start_time, end_time, metric_name, namespace, statistics,
+                              dimensions=None, unit=None):
+        if not self.service.record_call('GetMetricStatistics'):
+            raise FakeServerError(400, 'Bad Request', THROTTLING_RESPONSE)
+        return [{'Timestamp': t, statistics: v} for t, v in
+                self.service.datapoints(self.region_name, metric_name, statistics, dimensions or {},
+                                        start_time, end_time)]
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        if not self.service.record_call(action):
+            return FakeResponse(THROTTLING_RESPONSE, 400, 'Bad Request')
+        if action != 'GetMetricData':
+            return FakeResponse('<ErrorResponse><Error><Code>InvalidAction</Code></Error></ErrorResponse>',
+                                400, 'Bad Request')
+        try:
+            return FakeResponse(self.get_metric_data_response(params))
+        except FakeServerError as e:
+            return FakeResponse(e.body, e.status, e.reason)
+
+    def get_metric_data_response(self, params):
+        start_time, end_time = parse_timestamp(params['StartTime']), parse_timestamp(params['EndTime'])
+
+        series = []
+        n = 1
+        while 'MetricDataQueries.member.%d.Id' % n in params:
+            prefix = 'MetricDataQueries.member.%d.' % n
+            dimensions, m = dict(), 1
+            while prefix + 'MetricStat.Metric.Dimensions.member.%d.Name' % m in params:
+                dimension_prefix = prefix + 'MetricStat.Metric.Dimensions.member.%d.' % m
+                dimensions[params[dimension_prefix + 'Name']] = params[dimension_prefix + 'Value']
+                m += 1
+            self.service.check_failures(self.region_name, *dimensions.values())
+            series.append((params[prefix + 'Id'],
+                           self.service.datapoints(self.region_name, params[prefix + 'MetricStat.Metric.MetricName'],
+                                                   params[prefix + 'MetricStat.Stat'], dimensions,
+                                                   start_time, end_time)))
+            n += 1
+
+        # Page through the datapoints of all queries in order, as CloudWatch does.
+        offset = int(params.get('NextToken', 0))
+        remaining, position = self.service.page_size, 0
+        members = []
+        for query_id, datapoints in series:
+            page = datapoints[max(0, offset - position):][:remaining]
+            position += len(datapoints)
+            remaining -= len(page)
+            members.append(
+                '<member><Id>%s</Id><StatusCode>%s</StatusCode><Timestamps>%s</Timestamps><Values>%s</Values></member>' %
+                (escape(query_id), 'PartialData' if position > offset + self.service.page_size else 'Complete',
+                 ''.join('<member>%s</member>' % t.strftime(CLOUDWATCH_TIMESTAMP_FORMAT) for t, _ in page),
+                 ''.join('<member>%r</member>' % v for _, v in page)))
+
+        next_offset = offset + self.service.page_size
+        next_token = '<NextToken>%d</NextToken>' % next_offset if position > next_offset else ''
+        return ('<GetMetricDataResponse xmlns="%s"><GetMetricDataResult><MetricDataResults>%s</MetricDataResults>'
+                '%s</GetMetricDataResult></GetMetricDataResponse>' % (CLOUDWATCH_XMLNS, ''.join(members), next_token))
+
+
+class _FakeCloudwatchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = dict(parse_qsl(body.decode('utf-8')))
+        # The region is the first component of the path.
+        region_name = self.path.strip('/').split('/')[0]
+
+        if server.secret_access_key is not None and not self.signature_matches(region_name, body):
+            response = FakeResponse('<ErrorResponse><Error><Code>SignatureDoesNotMatch</Code></Error></ErrorResponse>',
+                                    403, 'Forbidden')
+        else:
+            response = server.cloudwatch.connect_to_region(region_name).make_request(params.pop('Action', None),
+                                                                                      params, verb='POST')
+        response_body = response.read().encode('utf-8')
+        self.send_response(response.status, response.reason)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def signature_matches(self, region_name, body):
+        authorization = self.headers.get('Authorization', '')
+        match = re.search('SignedHeaders=([^,]*)', authorization)
+        if not match:
+            return False
+        headers = dict((name, self.headers.get(name, '')) for name in match.group(1).split(';'))
+        return authorization == sigv4.authorization('POST', self.path, headers, body, region_name, 'monitoring',
+                                                    self.server.access_key_id, self.server.secret_access_key)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCloudwatchServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a FakeCloudwatch's GetMetricData API over HTTP on localhost, as a stub CloudWatch endpoint for
+    clients that make their own HTTP requests.  The region is taken from the first component of the path, so
+    the endpoint for each region is endpoint.format(region=region_name).
+    """
+    daemon_threads = True
+
+    def __init__(self, cloudwatch, access_key_id='', secret_access_key=None, port=0):
+        """
+        @param cloudwatch The FakeCloudwatch service to serve.
+        @param access_key_id, secret_access_key If secret_access_key is given, requests must be signed with
+            these credentials (AWS Signature Version 4) and are rejected with SignatureDoesNotMatch otherwise.
+        @param port Port to listen on; by default, any free port.
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), _FakeCloudwatchRequestHandler)
+        self.cloudwatch = cloudwatch
+        self.access_key_id, self.secret_access_key = access_key_id, secret_access_key
+        self.endpoint = 'http://127.0.0.1:%d/{region}/' % self.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """
+        Starts serving requests on a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-cloudwatch-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connections aren't worth a traceback.
+        pass
+
+
+class FakeRegion(object):
+    """
+    Mirrors boto.regioninfo.RegionInfo.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'RegionInfo:%s' % self.name
+
+
+class FakeLoadBalancer(object):
+    """
+    Mirrors boto.ec2.elb.loadbalancer.LoadBalancer.
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeElb(FakeService):
+    """
+    An in-memory ELB service with a fixed number of load balancers in each region.  Load balancers are
+    tagged with an env of production or staging, alternately, and one of three teams.
+    """
+    def __init__(self, load_balancers_per_region=10, **kwargs):
+        super(FakeElb, self).__init__(**kwargs)
+        self.load_balancers_per_region = load_balancers_per_region
+
+    def connect_to_region(self, region_name, **kwargs):
+        return FakeElbConnection(self, region_name)
+
+    def tags(self, load_balancer_name):
+        index = int(load_balancer_name.rsplit('-', 1)[-1])
+        return dict(env=('production', 'staging')[index % 2], team='team-%d' % (index % 3))
+
+
+class FakeElbConnection(object):
+    """
+    Mirrors the subset of boto.ec2.elb.ELBConnection used by the plugin.
+    """
+    ResponseError = FakeServerError
+
+    def __init__(self, service, region_name):
+        self.service, self.region_name = service, region_name
+
+    def get_all_load_balancers(self):
+        if not self.service.record_call('DescribeLoadBalancers'):
+            raise FakeServerError(400, 'Bad Request', THROTTLING_RESPONSE)
+        self.service.check_failures(self.region_name)
+        return [FakeLoadBalancer('%s-elb-%d' % (self.region_name, i))
+                for i in range(self.service.load_balancers_per_region)]
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        if not self.service.record_call(action):
+            return FakeResponse(THROTTLING_RESPONSE, 400, 'Bad Request')
+        names = [params[name] for name in sorted(params, key=lambda name: int(name.rsplit('.', 1)[-1]))
+                 if name.startswith('LoadBalancerNames.member.')]
+        if action != 'DescribeTags' or not 0 < len(names) <= 20:
+            return FakeResponse('<ErrorResponse><Error><Code>ValidationError</Code></Error></ErrorResponse>',
+                                400, 'Bad Request')
+        return FakeResponse(
+            '<DescribeTagsResponse xmlns="%s"><DescribeTagsResult><TagDescriptions>%s</TagDescriptions>'
+            '</DescribeTagsResult></DescribeTagsResponse>' %
+            (ELB_XMLNS, ''.join('<member><LoadBalancerName>%s</LoadBalancerName><Tags>%s</Tags></member>' %
+                                (escape(name), ''.join('<member><Key>%s</Key><Value>%s</Value></member>' %
+                                                       (escape(key), escape(value))
+                                                       for key, value in sorted(self.service.tags(name).items())))
+                                for name in names)))
+
+
+class FakeAws(object):
+    """
+    A fake AWS account: a set of regions, each with its own ELBs, and CloudWatch metrics for them.
+    """
+    def __init__(self, region_count=8, load_balancers_per_region=10, latency=0.0, throttle_rate=0.0,
+                 density=1.0, seed=0, **kwargs):
+        """
+        @param region_count Number of regions.
+        @param load_balancers_per_region Number of load balancers in each region.
+        @param latency, throttle_rate, seed See FakeService; apply to both services.
+        @param density See FakeCloudwatch.
+        Other keyword arguments are passed to FakeCloudwatch.
+        """
+        self.regions = [FakeRegion('fake-region-%d' % i) for i in range(region_count)]
+        self.elb = FakeElb(load_balancers_per_region, latency=latency, throttle_rate=throttle_rate, seed=seed)
+        self.cloudwatch = FakeCloudwatch(density=density, latency=latency, throttle_rate=throttle_rate,
+                                         seed=seed + 1, **kwargs)
+
+    def connection_registry(self):
+        """
+        Returns a ConnectionRegistry that connects to the fake services.
+        """
+        return ConnectionRegistry(dict(
+            cloudwatch=lambda region_name, access_key_id, secret_access_key:
+                self.cloudwatch.connect_to_region(region_name),
+            elb=lambda region_name, access_key_id, secret_access_key: self.elb.connect_to_region(region_name)))
+
+    def get_calls(self):
+        """
+        Returns the number of requests made to each API action.
+        """
+        calls = collections.Counter(self.cloudwatch.calls)
+        calls.update(self.elb.calls)
+        return dict(calls)
+
+
+class FakeElbCloudwatchMetrics(ElbCloudwatchMetrics):
+    """
+    ElbCloudwatchMetrics for the regions of a FakeAws; pass connections=fake_aws.connection_registry() to reach
+    its services.
+    """
+    def __init__(self, fake_aws, *args, **kwargs):
+        super(FakeElbCloudwatchMetrics, self).__init__(*args, **kwargs)
+        self.fake_aws = fake_aws
+
+    def get_region_list(self):
+        return self.fake_aws.regions
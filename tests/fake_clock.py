@@ -0,0 +1,19 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module of the module under test: time() returns a time that only moves when sleep
+    is called (or now is set), and the sleeps are recorded.
+    """
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
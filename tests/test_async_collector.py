@@ -0,0 +1,144 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import sys
+import time
+import unittest
+
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from tests.fake_aws import FakeAws, FakeCloudwatch, FakeCloudwatchServer, FakeElbCloudwatchMetrics
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from boundary_aws_plugin.async_collector import AwsResponseError
+
+END_TIME = datetime.datetime(2026, 1, 1, 12, 0)
+START_TIME = END_TIME - datetime.timedelta(minutes=20)
+
+
+class SlowRegionCloudwatch(FakeCloudwatch):
+    """
+    A FakeCloudwatch that takes slow_latency seconds to answer for the region named slow_region.
+    """
+    def __init__(self, slow_region, slow_latency, **kwargs):
+        super(SlowRegionCloudwatch, self).__init__(**kwargs)
+        self.slow_region, self.slow_latency = slow_region, slow_latency
+
+    def datapoints(self, region_name, *args):
+        if region_name == self.slow_region:
+            time.sleep(self.slow_latency)
+        return FakeCloudwatch.datapoints(self, region_name, *args)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the async collector requires Python 3.7")
+class AsyncCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.fake_aws = FakeAws(region_count=3, load_balancers_per_region=4)
+        self.servers, self.collectors = [], []
+
+    def tearDown(self):
+        for metrics in self.collectors:
+            metrics.close()
+        for server in self.servers:
+            server.stop()
+
+    def make_metrics(self, secret_access_key='secret', **kwargs):
+        server = FakeCloudwatchServer(self.fake_aws.cloudwatch, 'key', 'secret').start()
+        self.servers.append(server)
+        kwargs.setdefault('rate_limiter', RateLimiter(1e6, base_delay=0.001, max_delay=0.01))
+        metrics = FakeElbCloudwatchMetrics(self.fake_aws, 'key', secret_access_key, collector='async',
+                                           cloudwatch_endpoint=server.endpoint,
+                                           connections=self.fake_aws.connection_registry(), **kwargs)
+        self.collectors.append(metrics)
+        return metrics
+
+    def threaded_data(self):
+        metrics = FakeElbCloudwatchMetrics(self.fake_aws, 'key', 'secret', fetch_backend='batched',
+                                           rate_limiter=RateLimiter(1e6),
+                                           connections=self.fake_aws.connection_registry())
+        return dict(metrics.get_metric_data(only_latest=False, start_time=START_TIME, end_time=END_TIME))
+
+    def get_metric_data(self, metrics):
+        return dict(metrics.get_metric_data(only_latest=False, start_time=START_TIME, end_time=END_TIME))
+
+    def iter_metric_data(self, metrics):
+        return metrics.iter_metric_data(only_latest=False, start_time=START_TIME, end_time=END_TIME)
+
+    def pending_tasks(self, metrics):
+        return [task for task in asyncio.all_tasks(metrics.async_collector.loop) if not task.done()]
+
+    def test_matches_threaded_collector(self):
+        expected = self.threaded_data()
+        self.assertEqual(len(expected), 3 * 4 * 16)
+        self.assertEqual(self.get_metric_data(self.make_metrics()), expected)
+        self.assertEqual(
+            dict(self.make_metrics().get_metric_data(start_time=START_TIME, end_time=END_TIME)),
+            dict((key, samples[-1:]) for key, samples in expected.items()))
+
+    def test_rejected_signature(self):
+        metrics = self.make_metrics(secret_access_key='wrong')
+        region_data = list(self.iter_metric_data(metrics))
+        self.assertEqual(len(region_data), 3)
+        for data in region_data:
+            self.assertEqual(len(data.data), 0)
+            for keys, error in data.failures:
+                self.assertIsInstance(error, AwsResponseError)
+                self.assertEqual((error.status, error.error_code), (403, 'SignatureDoesNotMatch'))
+            self.assertEqual(sum(len(keys) for keys, _ in data.failures), 4 * 16)
+        with self.assertRaises(AwsResponseError):
+            metrics.get_metric_data(start_time=START_TIME, end_time=END_TIME)
+
+    def test_retries_throttled_requests(self):
+        expected = self.threaded_data()
+        self.fake_aws.cloudwatch.throttle_rate = 0.3
+        metrics = self.make_metrics(metric_workers=4)
+        self.assertEqual(self.get_metric_data(metrics), expected)
+        stats = metrics.rate_limiter.get_stats()
+        self.assertGreater(self.fake_aws.get_calls()['Throttled'], 0)
+        self.assertEqual(stats['throttles'], self.fake_aws.get_calls()['Throttled'])
+        self.assertEqual(stats['retries'], stats['throttles'])
+        # Each throttle halves the request rate, which then recovers gradually.
+        self.assertLess(stats['rate'], 1e6)
+
+    def test_follows_next_token(self):
+        expected = self.threaded_data()
+        self.fake_aws.cloudwatch.page_size = 50
+        calls = self.fake_aws.get_calls()['GetMetricData']
+        self.assertEqual(self.get_metric_data(self.make_metrics()), expected)
+        # 64 metrics of 20 datapoints per region, 50 datapoints per page.
+        self.assertEqual(self.fake_aws.get_calls()['GetMetricData'] - calls, 3 * 26)
+
+    def test_timeout(self):
+        metrics = self.make_metrics()
+        metrics.async_collector.timeout = 0.1
+        self.fake_aws.cloudwatch.latency = 2
+        start = time.time()
+        region_data = list(self.iter_metric_data(metrics))
+        # The request for each region's batch, then one per load balancer as the batch is retried.
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(len(region_data), 3)
+        for data in region_data:
+            self.assertEqual(len(data.data), 0)
+            self.assertTrue(data.failures)
+            for _, error in data.failures:
+                self.assertIsInstance(error, asyncio.TimeoutError)
+        self.assertEqual(self.pending_tasks(metrics), [])
+
+    def test_cancelled_when_caller_stops(self):
+        self.fake_aws.cloudwatch = SlowRegionCloudwatch('fake-region-1', 5)
+        metrics = self.make_metrics()
+        start = time.time()
+        region_data = self.iter_metric_data(metrics)
+        first = next(region_data)
+        self.assertNotEqual(first.region_name, 'fake-region-1')
+        self.assertEqual(first.failures, [])
+        region_data.close()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.pending_tasks(metrics), [])
+
+        # The collector is still usable afterwards.
+        self.fake_aws.cloudwatch.slow_region = None
+        self.assertEqual(len(self.get_metric_data(metrics)), 3 * 4 * 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import unittest
+
+from boundary_aws_plugin import boundary_plugin
+
+
+class ReportMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+        self.write_output = boundary_plugin.write_output
+        boundary_plugin.write_output = self.writes.append
+
+    def tearDown(self):
+        boundary_plugin.write_output = self.write_output
+
+    def test_batches(self):
+        start = datetime.datetime(2026, 1, 1)
+        count = boundary_plugin.OUTPUT_BATCH_SIZE * 2 + 1
+        metrics = (('METRIC', i, 'source', start + datetime.timedelta(minutes=i)) for i in range(count))
+        boundary_plugin.boundary_report_metrics(metrics)
+
+        self.assertEqual([out.count('\n') for out in self.writes],
+                         [boundary_plugin.OUTPUT_BATCH_SIZE, boundary_plugin.OUTPUT_BATCH_SIZE, 1])
+        lines = ''.join(self.writes).splitlines()
+        self.assertEqual(len(lines), count)
+        self.assertEqual(lines[0], 'METRIC 0 source %d' % (boundary_plugin.unix_time(start) * 1000))
+        self.assertEqual(lines[-1].split()[1], str(count - 1))
+
+    def test_nothing_to_report(self):
+        boundary_plugin.boundary_report_metrics([])
+        self.assertEqual(self.writes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
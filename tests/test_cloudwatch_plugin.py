@@ -0,0 +1,197 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import os
+import unittest
+
+from boundary_aws_plugin import boundary_plugin, cloudwatch_plugin, status_store
+from boundary_aws_plugin.cloudwatch_plugin import Account, CloudwatchPlugin
+from boundary_aws_plugin.derived_metrics import DerivedMetrics
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from boundary_aws_plugin.series_store import SeriesStore
+from tests.fake_aws import FakeAws, FakeElbCloudwatchMetrics
+
+
+class GetAccountsTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin = CloudwatchPlugin(None, '', 'test-cloudwatch-plugin')
+
+    def test_single_account(self):
+        self.assertEqual(self.plugin.get_accounts(dict(access_key_id='key', secret_key='secret', accounts=[])),
+                         [Account('key', 'key', 'secret')])
+
+    def test_accounts(self):
+        settings = dict(access_key_id='', secret_key='',
+                        accounts=[dict(name='production', access_key_id='key1', secret_key='secret1'),
+                                  dict(access_key_id='key2', secret_key='secret2')])
+        self.assertEqual(self.plugin.get_accounts(settings),
+                         [Account('production', 'key1', 'secret1'), Account('key2', 'key2', 'secret2')])
+
+    def test_missing_credentials(self):
+        for settings in (dict(), dict(access_key_id='', secret_key='', accounts=[]),
+                         dict(access_key_id='key'), dict(accounts=[dict(name='staging', access_key_id='key')])):
+            with self.assertRaises(ValueError):
+                self.plugin.get_accounts(settings)
+
+
+class HandleMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.basename = 'test-handle-metrics-%d' % os.getpid()
+        self.plugin = CloudwatchPlugin(None, 'AWS_ELB_', self.basename)
+        self.reported_metrics = status_store.load_status_store(self.basename)
+        self.writes = []
+        self.write_output = boundary_plugin.write_output
+        boundary_plugin.write_output = self.writes.append
+
+    def tearDown(self):
+        boundary_plugin.write_output = self.write_output
+        os.remove(status_store.status_store_filename(self.basename))
+
+    def handle_metrics(self, series):
+        """
+        Passes handle_metrics a SeriesStore of series, a list of (key, [(timestamp, value), ...]), and returns the
+        lines it reported.
+        """
+        data = SeriesStore()
+        for key, samples in series:
+            for timestamp, value in samples:
+                data.add(key, 'Sum', timestamp, value)
+        del self.writes[:]
+        self.plugin.handle_metrics(data, self.reported_metrics)
+        return ''.join(self.writes).splitlines()
+
+    def test_oldest_first(self):
+        lines = self.handle_metrics([(('region', 'elb-1', 'REQUEST_COUNT'), [(60, 1.0), (120, 2.0), (180, 3.0)]),
+                                     (('region', 'elb-2', 'REQUEST_COUNT'), [(120, 4.0), (240, 5.0)]),
+                                     (('region', 'elb-1', 'LATENCY'), [(60, 6.0), (180, 7.0)])])
+        # Ordered by timestamp across series; samples with the same timestamp in series order.
+        self.assertEqual(lines, ['AWS_ELB_REQUEST_COUNT 1.0 elb-1 60000',
+                                 'AWS_ELB_LATENCY 6.0 elb-1 60000',
+                                 'AWS_ELB_REQUEST_COUNT 2.0 elb-1 120000',
+                                 'AWS_ELB_REQUEST_COUNT 4.0 elb-2 120000',
+                                 'AWS_ELB_REQUEST_COUNT 3.0 elb-1 180000',
+                                 'AWS_ELB_LATENCY 7.0 elb-1 180000',
+                                 'AWS_ELB_REQUEST_COUNT 5.0 elb-2 240000'])
+        self.assertEqual(self.reported_metrics[('region', 'elb-2', 'REQUEST_COUNT')][1], 5.0)
+
+    def test_duplicates(self):
+        key = ('region', 'elb-1', 'REQUEST_COUNT')
+        self.handle_metrics([(key, [(60, 1.0), (120, 2.0)])])
+        # The sample at 120 was already reported: its revised value is a duplicate, and so is the sample at 60.
+        self.assertEqual(self.handle_metrics([(key, [(60, 1.0), (120, 2.5), (180, 3.0)])]),
+                         ['AWS_ELB_REQUEST_COUNT 3.0 elb-1 180000'])
+        self.assertEqual(self.handle_metrics([(key, [(120, 2.5), (180, 3.5)])]), [])
+        self.assertEqual(self.reported_metrics[key][1], 3.0)
+        # The status store on disk agrees.
+        self.assertEqual(status_store.load_status_store(self.basename)[key][1], 3.0)
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.basename = 'test-backfill-%d' % os.getpid()
+        self.fake_aws = FakeAws(region_count=2, load_balancers_per_region=2)
+        self.plugin = CloudwatchPlugin(None, '', self.basename)
+        self.plugin.cloudwatch_metrics = FakeElbCloudwatchMetrics(self.fake_aws, '', '', fetch_backend='batched',
+                                                                  rate_limiter=RateLimiter(1e6),
+                                                                  connections=self.fake_aws.connection_registry())
+        self.plugin.derived_metrics = DerivedMetrics([])
+        self.plugin.handle_metrics = self.handle_metrics
+        self.reported = SeriesStore()
+        # Each call to report_metric_data, as a (region_names, set of (RegionId, EntityName)) tuple of the regions
+        # it was asked for and the entities whose metrics it got.
+        self.calls = []
+        self.report_metric_data = self.plugin.report_metric_data
+        self.plugin.report_metric_data = self.record_report_metric_data
+
+        self.settings = cloudwatch_plugin.PLUGIN_RETRY_COUNT, cloudwatch_plugin.PLUGIN_RETRY_DELAY
+        cloudwatch_plugin.PLUGIN_RETRY_DELAY = 0
+        self.write_output = boundary_plugin.write_output
+        boundary_plugin.write_output = lambda out: None
+
+        self.now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        self.entities = [(region.name, '%s-elb-%d' % (region.name, i))
+                         for region in self.fake_aws.regions for i in range(2)]
+
+    def tearDown(self):
+        cloudwatch_plugin.PLUGIN_RETRY_COUNT, cloudwatch_plugin.PLUGIN_RETRY_DELAY = self.settings
+        boundary_plugin.write_output = self.write_output
+        status_store.clear_backfill_start(self.basename)
+        try:
+            os.remove(status_store.status_store_filename(self.basename))
+        except OSError:
+            pass
+
+    def handle_metrics(self, data, reported_metrics):
+        self.reported.update(data.select_after(reported_metrics))
+        CloudwatchPlugin.handle_metrics(self.plugin, data, reported_metrics)
+
+    def record_report_metric_data(self, reported_metrics, **kwargs):
+        entities = set()
+        result = self.report_metric_data(reported_metrics, observe=lambda data: entities.update(
+            key[:2] for key in data), **kwargs)
+        self.calls.append((kwargs.get('region_names'), entities))
+        return result
+
+    def reported_metrics(self, minutes_ago):
+        """
+        Returns a status store in which every metric was last reported minutes_ago minutes ago.
+        """
+        out = status_store.load_status_store(self.basename)
+        for region_name, entity_name in self.entities:
+            for metric in self.plugin.cloudwatch_metrics.get_metrics():
+                out[(region_name, entity_name, metric[2])] = (self.now - datetime.timedelta(minutes=minutes_ago),
+                                                              0.0, metric[1])
+        return out
+
+    def first_reported(self, entity):
+        return self.reported[entity + ('AWS_ELB_REQUEST_COUNT',)][0][0]
+
+    def test_retries_only_failures(self):
+        cloudwatch_plugin.PLUGIN_RETRY_COUNT = 3
+        failed_entity, failed_region = self.entities[1], self.fake_aws.regions[1].name
+        # The metrics of one load balancer fail twice (its batch, then on its own), and a whole region once.
+        self.fake_aws.cloudwatch.failures[failed_entity[1]] = 2
+        self.fake_aws.elb.failures[failed_region] = 1
+        self.plugin.backfill(self.reported_metrics(30))
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.calls[0], (None, set([self.entities[0]])))
+        self.assertEqual(self.calls[1], (set([failed_entity[0], failed_region]),
+                                         set([failed_entity]) | set(self.entities[2:])))
+        for entity in self.entities:
+            self.assertEqual(self.first_reported(entity), self.now - datetime.timedelta(minutes=29))
+
+    def test_unlimited_retries(self):
+        cloudwatch_plugin.PLUGIN_RETRY_COUNT = 0
+        # Each attempt uses up two failures: the load balancer's batch, then the load balancer on its own.
+        self.fake_aws.cloudwatch.failures[self.entities[0][1]] = 20
+        self.plugin.backfill(self.reported_metrics(30))
+        self.assertEqual(len(self.calls), 11)
+        self.assertEqual(self.first_reported(self.entities[0]), self.now - datetime.timedelta(minutes=29))
+
+        cloudwatch_plugin.PLUGIN_RETRY_COUNT = 3
+        self.fake_aws.cloudwatch.failures[self.entities[0][1]] = 20
+        with self.assertRaises(Exception):
+            self.plugin.backfill(self.reported_metrics(30))
+
+    def test_resumes_interrupted_backfill(self):
+        cloudwatch_plugin.PLUGIN_RETRY_COUNT = 1
+        failed_region = self.fake_aws.regions[1].name
+        self.fake_aws.elb.failures[failed_region] = 1
+        with self.assertRaises(Exception):
+            self.plugin.backfill(self.reported_metrics(120))
+        self.assertEqual(status_store.load_backfill_start(self.basename), self.now - datetime.timedelta(minutes=140))
+
+        # The region that was reported is now up to date, so on its own it would only be caught up from 20 minutes
+        # ago; the marker keeps the start of the interrupted backfill for the region that wasn't.
+        self.reported = SeriesStore()
+        self.plugin.backfill(status_store.load_status_store(self.basename))
+        for entity in self.entities:
+            if entity[0] == failed_region:
+                self.assertEqual(self.first_reported(entity), self.now - datetime.timedelta(minutes=119))
+            else:
+                self.assertNotIn(entity + ('AWS_ELB_REQUEST_COUNT',), self.reported)
+        self.assertIsNone(status_store.load_backfill_start(self.basename))
+
+
+if __name__ == '__main__':
+    unittest.main()
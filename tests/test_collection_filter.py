@@ -0,0 +1,72 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import unittest
+
+from boundary_aws_plugin.collection_filter import CollectionFilter, compile_patterns
+
+
+class CompilePatternsTest(unittest.TestCase):
+    def test_no_patterns(self):
+        self.assertIsNone(compile_patterns(None))
+        self.assertIsNone(compile_patterns([]))
+
+    def test_wildcards(self):
+        match = compile_patterns(['us-*', 'eu-west-?', 'elb-[ab]'])
+        for name in ('us-east-1', 'us-', 'eu-west-1', 'elb-a', 'elb-b'):
+            self.assertTrue(match(name), name)
+        # Patterns match whole names, case-sensitively.
+        for name in ('ap-us-east-1', 'eu-west-10', 'elb-c', 'elb-ab', 'US-east-1'):
+            self.assertFalse(match(name), name)
+
+    def test_metacharacters(self):
+        # Regex metacharacters in one pattern are literal, and do not spill over into the others in the alternation.
+        match = compile_patterns(['a|b', 'elb.(1)', 'x+', '^y$', 'p\\q'])
+        for name in ('a|b', 'elb.(1)', 'x+', '^y$', 'p\\q'):
+            self.assertTrue(match(name), name)
+        for name in ('a', 'b', 'elb-1', 'xx', 'y', 'pq'):
+            self.assertFalse(match(name), name)
+
+
+class CollectionFilterTest(unittest.TestCase):
+    def test_everything_by_default(self):
+        collection_filter = CollectionFilter.from_settings(dict())
+        self.assertTrue(collection_filter.region_selected('us-east-1'))
+        self.assertTrue(collection_filter.entity_selected('elb'))
+        self.assertTrue(collection_filter.tags_selected(dict()))
+        self.assertTrue(collection_filter.metric_selected('RequestCount', 'AWS_ELB_REQUEST_COUNT'))
+        self.assertFalse(collection_filter.has_tag_rules)
+
+    def test_include_and_exclude(self):
+        collection_filter = CollectionFilter.from_settings(dict(include_regions='us-*, eu-*',
+                                                                exclude_regions=['us-gov-*'],
+                                                                exclude_entities=' ,internal-*,'))
+        self.assertTrue(collection_filter.region_selected('us-east-1'))
+        self.assertTrue(collection_filter.region_selected('eu-west-1'))
+        self.assertFalse(collection_filter.region_selected('ap-southeast-2'))
+        # Exclude rules win over include rules.
+        self.assertFalse(collection_filter.region_selected('us-gov-west-1'))
+        # Empty patterns in a setting are ignored rather than matching empty names only.
+        self.assertTrue(collection_filter.entity_selected('public-web'))
+        self.assertFalse(collection_filter.entity_selected('internal-api'))
+
+    def test_metrics(self):
+        collection_filter = CollectionFilter(include_metrics=['AWS_ELB_HTTP_CODE_*', 'Latency'],
+                                             exclude_metrics=['HTTPCode_ELB_4XX'])
+        # Either name of a metric may match.
+        self.assertTrue(collection_filter.metric_selected('Latency', 'AWS_ELB_LATENCY'))
+        self.assertTrue(collection_filter.metric_selected('HTTPCode_Backend_5XX', 'AWS_ELB_HTTP_CODE_BACKEND_5XX'))
+        self.assertFalse(collection_filter.metric_selected('HTTPCode_ELB_4XX', 'AWS_ELB_HTTP_CODE_ELB_4XX'))
+        self.assertFalse(collection_filter.metric_selected('RequestCount', 'AWS_ELB_REQUEST_COUNT'))
+
+    def test_tags(self):
+        collection_filter = CollectionFilter(include_tags=['env=prod*', 'team'], exclude_tags=['env=production-old'])
+        self.assertTrue(collection_filter.has_tag_rules)
+        self.assertTrue(collection_filter.tags_selected(dict(env='production')))
+        # A rule without a value matches the tag whatever its value.
+        self.assertTrue(collection_filter.tags_selected(dict(env='staging', team='')))
+        self.assertFalse(collection_filter.tags_selected(dict(env='staging')))
+        self.assertFalse(collection_filter.tags_selected(dict()))
+        self.assertFalse(collection_filter.tags_selected(dict(env='production-old')))
+
+
+if __name__ == '__main__':
+    unittest.main()
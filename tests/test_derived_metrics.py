@@ -0,0 +1,153 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import os
+import unittest
+
+from boundary_aws_plugin import status_store
+from boundary_aws_plugin.boundary_plugin import unix_time
+from boundary_aws_plugin.cloudwatch_plugin import CloudwatchPlugin
+from boundary_aws_plugin.derived_metrics import DerivedMetrics, Ratio, RollingSum
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from boundary_aws_plugin.series_store import SeriesStore
+from tests.fake_aws import FakeAws, FakeElbCloudwatchMetrics
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+ENTITY = ('region', 'elb')
+
+
+def minutes(n):
+    return unix_time(T0 + datetime.timedelta(minutes=n))
+
+
+def samples(metric_name, first, last, value=1.0):
+    """
+    Returns a SeriesStore with a sample of metric_name for ENTITY every minute from minute first to last.
+    """
+    data = SeriesStore()
+    for n in range(first, last + 1):
+        data.add(ENTITY + (metric_name,), 'Sum', minutes(n), value)
+    return data
+
+
+class DerivedMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.derived_metrics = DerivedMetrics([('COUNT_5M', RollingSum('COUNT', 300)),
+                                               ('ERROR_RATE', Ratio('ERRORS', 'COUNT')),
+                                               ('ERROR_RATE_5M', Ratio('ERRORS', 'COUNT', window=300))])
+
+    def derive(self, data, fetch_start, now=None):
+        data = self.derived_metrics.derive(data, lambda metric_key: fetch_start, now)
+        return dict((key[2], list(zip(timestamps, values))) for key, _, timestamps, values in data.series())
+
+    def test_lookback(self):
+        self.assertEqual(self.derived_metrics.sparse_inputs, dict(ERRORS='COUNT'))
+        self.assertEqual(self.derived_metrics.lookback(ENTITY + ('COUNT',)), datetime.timedelta(minutes=5))
+        self.assertEqual(self.derived_metrics.lookback(ENTITY + ('OTHER',)), datetime.timedelta(0))
+        self.derive(samples('COUNT', 0, 9), T0)
+        self.assertEqual(self.derived_metrics.lookback(ENTITY + ('COUNT',)), datetime.timedelta(0))
+
+    def test_skips_partial_windows(self):
+        data = samples('COUNT', 0, 9)
+        data.add(ENTITY + ('ERRORS',), 'Sum', minutes(7), 2.0)
+        out = self.derive(data, T0)
+
+        # Windows from minute 5 onwards are fully covered by the samples fetched from minute 0.
+        self.assertEqual(out['COUNT_5M'], [(minutes(n), 5.0) for n in range(5, 10)])
+        self.assertEqual(out['ERROR_RATE_5M'], [(minutes(n), 40.0 if n >= 7 else 0.0) for n in range(5, 10)])
+        # Ratios of single samples need no history.
+        self.assertEqual(len(out['ERROR_RATE']), 10)
+
+        # Later samples are computed from the history.
+        out = self.derive(samples('COUNT', 10, 10, 3.0), T0 + datetime.timedelta(minutes=8))
+        self.assertEqual(out['COUNT_5M'], [(minutes(10), 7.0)])
+
+    def test_trimmed_history(self):
+        self.derive(samples('COUNT', 0, 9), T0)
+        self.derived_metrics.trim(minutes(8))
+        out = self.derive(samples('COUNT', 10, 14), T0 + datetime.timedelta(minutes=8))
+        self.assertEqual(out['COUNT_5M'], [(minutes(n), 5.0) for n in range(13, 15)])
+
+        # An entity whose history is gone altogether starts over.
+        self.derived_metrics.trim(minutes(20))
+        self.assertEqual(self.derived_metrics.lookback(ENTITY + ('COUNT',)), datetime.timedelta(minutes=5))
+
+    def test_late_numerator(self):
+        self.derived_metrics.settle_time = 120
+        out = self.derive(samples('COUNT', 0, 9), T0, T0 + datetime.timedelta(minutes=10))
+        # Ratios are held until their numerator has had time to be published; rolling sums are not.
+        self.assertEqual(out['ERROR_RATE'], [(minutes(n), 0.0) for n in range(9)])
+        self.assertEqual(out['COUNT_5M'][-1], (minutes(9), 5.0))
+
+        # The numerator for minute 9 only arrives with the next poll, and still counts.
+        data = samples('COUNT', 10, 10)
+        data.add(ENTITY + ('ERRORS',), 'Sum', minutes(9), 1.0)
+        out = self.derive(data, T0 + datetime.timedelta(minutes=8), T0 + datetime.timedelta(minutes=12))
+        self.assertEqual(out['ERROR_RATE'], [(minutes(9), 100.0), (minutes(10), 0.0)])
+        self.assertEqual(out['ERROR_RATE_5M'], [(minutes(9), 20.0), (minutes(10), 20.0)])
+        self.assertEqual(out['COUNT_5M'], [(minutes(10), 5.0)])
+
+        # Held samples of entities that are gone are dropped with them.
+        self.derive(samples('COUNT', 11, 11), T0 + datetime.timedelta(minutes=10), T0 + datetime.timedelta(minutes=12))
+        self.derived_metrics.trim(minutes(20))
+        self.assertFalse(self.derived_metrics.held)
+
+
+class RestartTest(unittest.TestCase):
+    """
+    Restarts the plugin after an outage, and checks that the rolling windows reported by the backfill are
+    computed from all 5 minutes of their inputs.
+    """
+
+    def setUp(self):
+        self.basename = 'test-derived-metrics-%d' % os.getpid()
+        self.fake_aws = FakeAws(region_count=1, load_balancers_per_region=2)
+        self.plugin = CloudwatchPlugin(None, '', self.basename)
+        self.plugin.cloudwatch_metrics = FakeElbCloudwatchMetrics(self.fake_aws, '', '', fetch_backend='batched',
+                                                                  rate_limiter=RateLimiter(1e6),
+                                                                  connections=self.fake_aws.connection_registry())
+        self.plugin.derived_metrics = DerivedMetrics(self.plugin.cloudwatch_metrics.get_derived_metrics())
+        self.reported = SeriesStore()
+        self.plugin.handle_metrics = self.handle_metrics
+
+    def tearDown(self):
+        status_store.clear_backfill_start(self.basename)
+
+    def handle_metrics(self, data, reported_metrics):
+        new_data = data.select_after(reported_metrics)
+        self.reported.update(new_data)
+        reported_metrics.update(new_data.latest_samples())
+
+    def window_sum(self, load_balancer, metric_name, timestamp):
+        region = self.fake_aws.regions[0].name
+        end_time = datetime.datetime.utcfromtimestamp(timestamp) + datetime.timedelta(minutes=1)
+        return sum(value for _, value in self.fake_aws.cloudwatch.datapoints(
+            region, metric_name, 'Sum', dict(LoadBalancerName=load_balancer),
+            end_time - datetime.timedelta(minutes=5), end_time))
+
+    def test_backfill_after_restart(self):
+        watermark = datetime.datetime.utcnow().replace(second=0, microsecond=0) - datetime.timedelta(minutes=30)
+        region = self.fake_aws.regions[0].name
+        reported_metrics = dict()
+        for load_balancer in ('%s-elb-0' % region, '%s-elb-1' % region):
+            for metric_name in ('AWS_ELB_REQUEST_COUNT', 'AWS_ELB_HTTP_CODE_BACKEND_5XX', 'AWS_ELB_REQUEST_COUNT_5M',
+                                'AWS_ELB_HTTP_CODE_BACKEND_5XX_RATE_5M'):
+                reported_metrics[(region, load_balancer, metric_name)] = (watermark, 0.0, 'Sum')
+        self.plugin.backfill(reported_metrics)
+
+        for load_balancer in ('%s-elb-0' % region, '%s-elb-1' % region):
+            request_counts = self.reported[(region, load_balancer, 'AWS_ELB_REQUEST_COUNT_5M')]
+            rates = self.reported[(region, load_balancer, 'AWS_ELB_HTTP_CODE_BACKEND_5XX_RATE_5M')]
+            # Nothing is left out after the watermark...
+            self.assertEqual(request_counts[0][0], watermark + datetime.timedelta(minutes=1))
+            self.assertEqual(rates[0][0], watermark + datetime.timedelta(minutes=1))
+            # ...and every window is complete.
+            for timestamp, value, _ in request_counts:
+                self.assertEqual(value, self.window_sum(load_balancer, 'RequestCount', unix_time(timestamp)))
+            for timestamp, value, _ in rates:
+                errors = self.window_sum(load_balancer, 'HTTPCode_Backend_5XX', unix_time(timestamp))
+                requests = self.window_sum(load_balancer, 'RequestCount', unix_time(timestamp))
+                self.assertAlmostEqual(value, 100.0 * errors / requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
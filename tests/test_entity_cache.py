@@ -0,0 +1,125 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import logging
+import threading
+import time
+import unittest
+
+from boundary_aws_plugin import entity_cache
+from boundary_aws_plugin.entity_cache import EntityCache
+from tests.fake_clock import FakeClock
+
+Region = collections.namedtuple('Region', 'name')
+REGION = Region('us-east-1')
+
+
+class Loader(object):
+    """
+    A discovery function returning (or raising) the given outcomes in turn, and counting its calls.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        # Cleared to hold calls until it is set again
+        self.proceed = threading.Event()
+        self.proceed.set()
+
+    def __call__(self, region):
+        self.calls += 1
+        self.proceed.wait()
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class EntityCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.time = entity_cache.time
+        entity_cache.time = self.clock
+        self.log_level = logging.getLogger('EntityCache').level
+        logging.getLogger('EntityCache').setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        entity_cache.time = self.time
+        logging.getLogger('EntityCache').setLevel(self.log_level)
+
+    def wait_for_refresh(self, cache):
+        deadline = time.time() + 5
+        while cache.refreshing and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(cache.refreshing)
+
+    def test_expiry(self):
+        loader = Loader(['elb-0'], ['elb-0', 'elb-1'])
+        cache = EntityCache(loader, ttl=900)
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        self.clock.now += 899
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        self.assertEqual(loader.calls, 1)
+
+        # Expired entities are still returned while they are refreshed, once, in the background.
+        self.clock.now += 1
+        loader.proceed.clear()
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        loader.proceed.set()
+        self.wait_for_refresh(cache)
+        self.assertEqual(loader.calls, 2)
+        self.assertEqual(cache.get(REGION), ['elb-0', 'elb-1'])
+
+    def test_empty_regions(self):
+        loader = Loader([], ['elb-0'])
+        cache = EntityCache(loader, ttl=900, empty_ttl=3600)
+        self.assertEqual(cache.get(REGION), [])
+        self.clock.now += 900
+        self.assertEqual(cache.get(REGION), [])
+        self.assertEqual(loader.calls, 1)
+        self.clock.now += 2700
+        cache.get(REGION)
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+
+    def test_no_caching(self):
+        loader = Loader(['elb-0'], ['elb-1'])
+        cache = EntityCache(loader, ttl=0)
+        self.assertEqual([cache.get(REGION), cache.get(REGION)], [['elb-0'], ['elb-1']])
+
+    def test_failed_discovery(self):
+        loader = Loader(Exception("first"), ['elb-0'], Exception("background"), ['elb-1'])
+        cache = EntityCache(loader, ttl=900)
+        # Nothing to fall back on: the error is raised, and the next lookup tries again.
+        with self.assertRaises(Exception):
+            cache.get(REGION)
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+
+        # A failed refresh keeps the expired entities, and is retried by the next lookup.
+        self.clock.now += 900
+        cache.get(REGION)
+        self.wait_for_refresh(cache)
+        self.assertEqual(loader.calls, 3)
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        self.wait_for_refresh(cache)
+        self.assertEqual(loader.calls, 4)
+        self.assertEqual(cache.get(REGION), ['elb-1'])
+
+    def test_seed_and_invalidate(self):
+        loader = Loader(['elb-1'], ['elb-2'])
+        cache = EntityCache(loader, ttl=900)
+        cache.seed(REGION.name, ['elb-0'])
+        # Seeded entities are returned straight away, and refreshed in the background.
+        self.assertEqual(cache.get(REGION), ['elb-0'])
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get_entries(), {REGION.name: ['elb-1']})
+
+        cache.invalidate(REGION.name)
+        self.assertEqual(cache.get(REGION), ['elb-1'])
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get(REGION), ['elb-2'])
+        self.assertEqual(loader.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import unittest
+
+from boundary_aws_plugin.boundary_plugin import unix_time
+from boundary_aws_plugin.metric_fetchers import BatchedFetcher, MetricQuery, get_metric_data_result
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from boundary_aws_plugin.series_store import SeriesStore
+from tests.fake_aws import (CLOUDWATCH_XMLNS, FakeAws, FakeCloudwatch, FakeCloudwatchConnection,
+                            FakeElbCloudwatchMetrics, FakeServerError)
+
+END_TIME = datetime.datetime(2026, 1, 1, 12, 0)
+START_TIME = END_TIME - datetime.timedelta(minutes=20)
+
+
+class RecordingCloudwatchConnection(FakeCloudwatchConnection):
+    def get_metric_data_response(self, params):
+        self.service.requests.append(dict(params))
+        load_balancers = set(value for name, value in params.items() if name.endswith('Dimensions.member.1.Value'))
+        if load_balancers & self.service.failing_load_balancers:
+            raise FakeServerError(400, 'Bad Request', 'LoadBalancer not found')
+        return FakeCloudwatchConnection.get_metric_data_response(self, params)
+
+
+class RecordingCloudwatch(FakeCloudwatch):
+    """
+    A FakeCloudwatch that records the parameters of each GetMetricData request, and fails those asking for any
+    of failing_load_balancers.
+    """
+    def __init__(self, **kwargs):
+        super(RecordingCloudwatch, self).__init__(**kwargs)
+        self.requests = []
+        self.failing_load_balancers = set()
+
+    def connect_to_region(self, region_name, **kwargs):
+        return RecordingCloudwatchConnection(self, region_name)
+
+
+def query_count(params):
+    return sum(1 for name in params if name.startswith('MetricDataQueries.member.') and name.endswith('.Id'))
+
+
+def make_queries(region_name, load_balancer_names, metrics):
+    return [MetricQuery((region_name, name, boundary_id), metric_name, statistic, dict(LoadBalancerName=name),
+                        START_TIME)
+            for name in load_balancer_names for metric_name, statistic, boundary_id in metrics]
+
+
+class BatchedFetcherTest(unittest.TestCase):
+    metrics = [('RequestCount', 'Sum', 'AWS_ELB_REQUEST_COUNT'),
+               ('Latency', 'Average', 'AWS_ELB_LATENCY'),
+               ('Latency', 'p99', 'AWS_ELB_LATENCY_P99')]
+
+    def expected(self, cloudwatch, queries):
+        out = dict()
+        for query in queries:
+            out[query.key] = [(unix_time(timestamp), value) for timestamp, value in
+                              cloudwatch.datapoints('fake-region-0', query.metric_name, query.statistic,
+                                                    query.dimensions, query.start_time, END_TIME)]
+        return out
+
+    def fetched(self, data):
+        return dict((key, list(zip(timestamps, values))) for key, _, timestamps, values in data.series())
+
+    def test_follows_next_token(self):
+        cloudwatch = RecordingCloudwatch(page_size=7)
+        queries = make_queries('fake-region-0', ['elb-0', 'elb-1'], self.metrics)
+        data = BatchedFetcher('AWS/ELB').fetch(cloudwatch.connect_to_region('fake-region-0'), queries, END_TIME)
+        data.sort()
+
+        # 6 queries of 20 datapoints each, 7 datapoints per page.
+        self.assertEqual(len(cloudwatch.requests), 18)
+        self.assertNotIn('NextToken', cloudwatch.requests[0])
+        self.assertEqual([int(params['NextToken']) for params in cloudwatch.requests[1:]], list(range(7, 120, 7)))
+        self.assertEqual(self.fetched(data), self.expected(cloudwatch, queries))
+
+    def test_groups_queries_by_start_time(self):
+        cloudwatch = RecordingCloudwatch()
+        queries = make_queries('fake-region-0', ['elb-0'], self.metrics)
+        queries[0] = queries[0]._replace(start_time=END_TIME - datetime.timedelta(minutes=5))
+        data = BatchedFetcher('AWS/ELB').fetch(cloudwatch.connect_to_region('fake-region-0'), queries, END_TIME)
+
+        self.assertEqual(sorted(query_count(params) for params in cloudwatch.requests), [1, 2])
+        self.assertEqual(len(data[queries[0].key]), 5)
+        self.assertEqual(len(data[queries[1].key]), 20)
+
+    def test_raises_on_failed_query(self):
+        queries = make_queries('fake-region-0', ['elb-0'], self.metrics[:2])
+        body = ('<GetMetricDataResponse xmlns="%s"><GetMetricDataResult><MetricDataResults>'
+                '<member><Id>q0</Id><StatusCode>PartialData</StatusCode>'
+                '<Timestamps><member>2026-01-01T11:59:00Z</member></Timestamps><Values><member>1.0</member></Values>'
+                '</member>'
+                '<member><Id>q1</Id><StatusCode>InternalError</StatusCode><Timestamps/><Values/></member>'
+                '</MetricDataResults></GetMetricDataResult></GetMetricDataResponse>' % CLOUDWATCH_XMLNS)
+        fetcher = BatchedFetcher('AWS/ELB')
+        with self.assertRaises(FakeServerError) as context:
+            fetcher.parse_result(get_metric_data_result(body), queries, SeriesStore(), FakeServerError)
+        self.assertEqual(context.exception.reason, 'InternalError')
+
+        # PartialData is not an error: the rest comes with the NextToken.
+        out = SeriesStore()
+        fetcher.parse_result(get_metric_data_result(body.replace('InternalError', 'Complete')), queries, out,
+                             FakeServerError)
+        self.assertEqual(out[queries[0].key], [(datetime.datetime(2026, 1, 1, 11, 59), 1.0, 'Sum')])
+
+
+class BatchedCollectionTest(unittest.TestCase):
+    def setUp(self):
+        # 40 load balancers of 16 metrics each: 640 queries, more than fit in one request.
+        self.fake_aws = FakeAws(region_count=1, load_balancers_per_region=40)
+        self.fake_aws.cloudwatch = self.cloudwatch = RecordingCloudwatch()
+        self.metrics = FakeElbCloudwatchMetrics(self.fake_aws, '', '', fetch_backend='batched',
+                                                rate_limiter=RateLimiter(1e6),
+                                                connections=self.fake_aws.connection_registry())
+
+    def collect(self):
+        region_data = list(self.metrics.iter_metric_data(only_latest=False, start_time=START_TIME,
+                                                         end_time=END_TIME))
+        self.assertEqual(len(region_data), 1)
+        return region_data[0]
+
+    def test_packs_at_most_500_queries_per_request(self):
+        region_data = self.collect()
+
+        self.assertEqual(sorted(query_count(params) for params in self.cloudwatch.requests), [140, 500])
+        self.assertEqual(region_data.failures, [])
+        self.assertEqual(len(region_data.data), 640)
+
+    def test_retries_failed_batch_per_entity(self):
+        expected = self.collect().data
+        del self.cloudwatch.requests[:]
+        failing = 'fake-region-0-elb-3'
+        self.cloudwatch.failing_load_balancers.add(failing)
+        region_data = self.collect()
+
+        # The batch holding the failed load balancer is retried one load balancer at a time.
+        first_batch_entities = set(value for name, value in self.cloudwatch.requests[0].items()
+                                   if name.endswith('Dimensions.member.1.Value'))
+        self.assertIn(failing, first_batch_entities)
+        self.assertEqual(len(self.cloudwatch.requests), 2 + len(first_batch_entities))
+        retried = [query_count(params) for params in self.cloudwatch.requests[2:]]
+        self.assertEqual(sum(retried), 500)
+        self.assertLessEqual(max(retried), 16)
+
+        self.assertEqual(len(region_data.failures), 1)
+        keys, error = region_data.failures[0]
+        self.assertIsInstance(error, FakeServerError)
+        self.assertEqual(set(key[1] for key in keys), set([failing]))
+        self.assertEqual(len(keys), 16)
+        self.assertEqual(dict(region_data.data),
+                         dict((key, value) for key, value in expected.items() if key[1] != failing))
+
+        with self.assertRaises(FakeServerError):
+            self.metrics.get_metric_data(only_latest=False, start_time=START_TIME, end_time=END_TIME)
+
+
+if __name__ == '__main__':
+    unittest.main()
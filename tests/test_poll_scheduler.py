@@ -0,0 +1,85 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import unittest
+
+from boundary_aws_plugin import poll_scheduler
+from boundary_aws_plugin.boundary_plugin import unix_time
+from boundary_aws_plugin.poll_scheduler import PollScheduler
+from boundary_aws_plugin.series_store import SeriesStore
+from tests.fake_clock import FakeClock
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+REQUESTS = ('region', 'elb', 'REQUESTS')
+ERRORS = ('region', 'elb', 'ERRORS')
+LATENCY = ('region', 'elb', 'LATENCY')
+
+
+def minutes(n):
+    return T0 + datetime.timedelta(minutes=n)
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = PollScheduler(60, 60, sentinel_metric='REQUESTS', idle_interval=600,
+                                       sparse_metrics=dict(ERRORS='REQUESTS'))
+
+    def poll(self, now, data=None):
+        """
+        Makes a poll at time now returning data, a dictionary of {key: [(minute, value), ...]}, and returns the
+        keys it fetched.
+        """
+        fetched = set(key for key in (REQUESTS, ERRORS, LATENCY) if self.scheduler.should_fetch(key, now))
+        store = SeriesStore()
+        for key, samples in (data or dict()).items():
+            if key in fetched:
+                for minute, value in samples:
+                    store.add(key, 'Sum', unix_time(minutes(minute)), value)
+        self.scheduler.observe(store, now)
+        self.scheduler.end_poll(now)
+        return fetched
+
+    def test_sparse_metric_follows_driver(self):
+        self.assertEqual(self.poll(minutes(0), {REQUESTS: [(-2, 5.0)], LATENCY: [(-2, 1.0)]}),
+                         set([REQUESTS, ERRORS, LATENCY]))
+        # Nothing new can exist yet, however often ERRORS came back empty.
+        self.assertEqual(self.poll(minutes(0.5)), set())
+        self.assertEqual(self.poll(minutes(1), {REQUESTS: [(-1, 5.0)], ERRORS: [(-1, 1.0)], LATENCY: [(-1, 1.0)]}),
+                         set([REQUESTS, ERRORS, LATENCY]))
+
+    def test_sparse_metric_of_idle_entity(self):
+        self.poll(minutes(0), {REQUESTS: [(-2, 5.0)], LATENCY: [(-2, 1.0)]})
+        now = 1
+        # No requests for long enough to be idle: the sentinel is still polled, and ERRORS with it.
+        while now < 20:
+            fetched = self.poll(minutes(now), {REQUESTS: [(now - 2, 0.0)]})
+            now += 1
+        self.assertTrue(self.scheduler.is_idle(REQUESTS[:2], minutes(now)))
+        self.assertEqual(fetched, set([REQUESTS, ERRORS]))
+        # ERRORS is skipped whenever REQUESTS is.
+        fetched = self.poll(minutes(now - 0.5))
+        self.assertNotIn(REQUESTS, fetched)
+        self.assertNotIn(ERRORS, fetched)
+
+
+class WaitForNextPollTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.time = poll_scheduler.time
+        poll_scheduler.time = self.clock
+
+    def tearDown(self):
+        poll_scheduler.time = self.time
+
+    def test_fixed_rate(self):
+        scheduler = PollScheduler(60)
+        # Intervals are measured from the start of each poll, the first one included.
+        for poll_duration, sleep in ((20, 40), (5, 55), (70, 0), (10, 50)):
+            self.clock.now += poll_duration
+            scheduler.wait_for_next_poll()
+            self.assertEqual(self.clock.sleeps[-1], sleep)
+        # An overrunning poll moves the clock on rather than being made up for.
+        self.assertEqual(self.clock.now, 1000.0 + 60 + 60 + 70 + 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import unittest
+
+from boundary_aws_plugin import rate_limiter
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from tests.fake_clock import FakeClock
+
+
+class ThrottlingError(Exception):
+    error_code = 'Throttling'
+
+
+class MaxRandom(object):
+    """
+    Stands in for the random module, always picking the longest delay.
+    """
+
+    @staticmethod
+    def uniform(a, b):
+        return b
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.time, self.random = rate_limiter.time, rate_limiter.random
+        rate_limiter.time, rate_limiter.random = self.clock, MaxRandom
+
+    def tearDown(self):
+        rate_limiter.time, rate_limiter.random = self.time, self.random
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=10, burst=5)
+        self.assertEqual([limiter.reserve() for _ in range(5)], [0] * 5)
+        # Further requests wait their turn, each a token's time after the previous one.
+        for wait in (0.1, 0.2, 0.3):
+            self.assertAlmostEqual(limiter.reserve(), wait)
+
+    def test_refill(self):
+        limiter = RateLimiter(rate=10, burst=5)
+        for _ in range(5):
+            limiter.reserve()
+        self.clock.now += 0.25
+        self.assertEqual([limiter.reserve(), limiter.reserve()], [0, 0])
+        self.assertAlmostEqual(limiter.reserve(), 0.05)
+
+        # The bucket fills up to the burst size only, however long it was left alone.
+        self.clock.now += 3600
+        self.assertAlmostEqual(limiter.get_stats()['tokens'], 5)
+        self.assertEqual([limiter.reserve() for _ in range(5)], [0] * 5)
+        self.assertAlmostEqual(limiter.reserve(), 0.1)
+
+    def test_acquire_blocks(self):
+        limiter = RateLimiter(rate=4)
+        for _ in range(6):
+            limiter.acquire()
+        self.assertEqual(self.clock.sleeps, [0.25, 0.25])
+        self.assertEqual(self.clock.now, 1000.5)
+        stats = limiter.get_stats()
+        self.assertEqual((stats['requests'], stats['waits']), (6, 2))
+        self.assertAlmostEqual(stats['wait_time'], 0.5)
+
+    def test_throttled_requests_are_retried(self):
+        limiter = RateLimiter(rate=100, base_delay=0.5, max_delay=1.5)
+        outcomes = [ThrottlingError(), ThrottlingError(), ThrottlingError(), 'result']
+
+        def request():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        self.assertEqual(limiter.call(request), 'result')
+        # Backing off exponentially, up to max_delay
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0, 1.5])
+        # Every throttle halved the rate, and the success raised it by a step.
+        self.assertAlmostEqual(limiter.rate, 100 / 8 + 1)
+        stats = limiter.get_stats()
+        self.assertEqual((stats['throttles'], stats['retries']), (3, 3))
+
+    def test_retries_are_limited(self):
+        limiter = RateLimiter(rate=100, max_retries=2, min_rate=20)
+        calls = []
+
+        def throttled():
+            calls.append(None)
+            raise ThrottlingError()
+        with self.assertRaises(ThrottlingError):
+            limiter.call(throttled)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(limiter.rate, 25)
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 20)
+
+        # Other errors are not retried.
+        def failed():
+            calls.append(None)
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            limiter.call(failed)
+        self.assertEqual(len(calls), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
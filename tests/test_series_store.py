@@ -0,0 +1,42 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import unittest
+
+from boundary_aws_plugin.series_store import SeriesStore, from_unix_time
+
+KEY = ('region', 'elb', 'REQUESTS')
+OTHER_KEY = ('region', 'elb', 'LATENCY')
+
+
+class SeriesStoreTest(unittest.TestCase):
+    def columns(self, store, key):
+        series_id = store.ids[key]
+        return list(store.series_timestamps[series_id]), list(store.series_values[series_id])
+
+    def test_sort(self):
+        store = SeriesStore()
+        store.extend(KEY, 'Sum', [180.0, 60.0, 120.0, 60.0], [3.0, 1.0, 2.0, 1.5])
+        store.extend(OTHER_KEY, 'Average', [60.0, 120.0, 120.0], [1.0, 2.0, 2.5])
+        in_order = store.series_timestamps[store.ids[OTHER_KEY]]
+        store.sort()
+
+        # Values follow their timestamps; equal timestamps keep their order.
+        self.assertEqual(self.columns(store, KEY), ([60.0, 60.0, 120.0, 180.0], [1.0, 1.5, 2.0, 3.0]))
+        # A series already in order is left alone.
+        self.assertIs(store.series_timestamps[store.ids[OTHER_KEY]], in_order)
+        self.assertEqual(self.columns(store, OTHER_KEY), ([60.0, 120.0, 120.0], [1.0, 2.0, 2.5]))
+
+    def test_select_after(self):
+        store = SeriesStore()
+        store.extend(KEY, 'Sum', [60.0, 120.0, 180.0], [1.0, 2.0, 3.0])
+        store.extend(OTHER_KEY, 'Average', [60.0, 120.0], [1.0, 2.0])
+        # A sample at the watermark's timestamp is a duplicate, even if CloudWatch has since revised its value.
+        selected = store.select_after({KEY: (from_unix_time(120.0), 1.5, 'Sum'),
+                                       OTHER_KEY: (from_unix_time(120.0), 2.0, 'Average')})
+        self.assertEqual(self.columns(selected, KEY), ([180.0], [3.0]))
+        self.assertNotIn(OTHER_KEY, selected)
+        # Series without a watermark are kept whole.
+        self.assertEqual(self.columns(store.select_after(dict()), KEY), ([60.0, 120.0, 180.0], [1.0, 2.0, 3.0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import time
+import unittest
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from boundary_aws_plugin.rate_limiter import RateLimiter
+from boundary_aws_plugin.sharded_plugin import ShardDiscovery, ShardEntities
+from boundary_aws_plugin.sharding import HashRing
+from boundary_aws_plugin.topology_snapshot import SnapshotEntity
+from tests.fake_aws import FakeAws, FakeElbCloudwatchMetrics
+
+ACCOUNT_NAMES = ['production', 'staging']
+
+
+class ShardDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        # Both accounts have load balancers elb-0 and elb-1 in each region; only staging has elb-2.
+        self.fake_aws = [FakeAws(region_count=2, load_balancers_per_region=2),
+                         FakeAws(region_count=2, load_balancers_per_region=3)]
+        self.discovery = ShardDiscovery([FakeElbCloudwatchMetrics(fake_aws, '', '', rate_limiter=RateLimiter(1e6),
+                                                                  connections=fake_aws.connection_registry())
+                                         for fake_aws in self.fake_aws], ACCOUNT_NAMES, 3)
+
+    def received(self):
+        """
+        Returns the topology each shard's worker has been sent since the last call, or None.
+        """
+        out = []
+        for entity_queue in self.discovery.queues:
+            try:
+                out.append(entity_queue.get(timeout=0.5))
+            except queue.Empty:
+                out.append(None)
+        return out
+
+    def test_discovers_once_for_all_shards(self):
+        self.discovery.discover()
+        # One DescribeLoadBalancers call per account and region, whatever the number of shards.
+        self.assertEqual([fake_aws.get_calls()['DescribeLoadBalancers'] for fake_aws in self.fake_aws], [2, 2])
+
+        ring = HashRing(3)
+        entities = []
+        for shard, topology in enumerate(self.received()):
+            for account_index, regions in enumerate(topology):
+                for region_name, region_entities in regions.items():
+                    for entity_name, dimensions in region_entities:
+                        self.assertEqual(ring.get_shard((ACCOUNT_NAMES[account_index], region_name, entity_name)),
+                                         shard)
+                        self.assertEqual(dimensions, dict(LoadBalancerName=entity_name))
+                        entities.append((account_index, entity_name))
+        # Load balancers whose names are taken by the first account are left out of the second.
+        self.assertEqual(sorted(entities), [(0, 'fake-region-%d-elb-%d' % (region, i))
+                                            for region in range(2) for i in range(2)] +
+                         [(1, 'fake-region-0-elb-2'), (1, 'fake-region-1-elb-2')])
+
+    def test_sends_changes_only(self):
+        self.discovery.discover()
+        first = self.received()
+        self.discovery.discover()
+        self.assertEqual(self.received(), [None] * 3)
+
+        # A region that fails keeps its entities.
+        self.fake_aws[1].elb.failures['fake-region-0'] = 1
+        self.discovery.discover()
+        self.assertEqual(self.received(), [None] * 3)
+
+        # A restarted worker gets its entities again.
+        self.discovery.resend(1)
+        self.assertEqual(self.received(), [None, first[1], None])
+
+        # New load balancers are sent to the shards they belong to.
+        self.fake_aws[1].elb.load_balancers_per_region = 4
+        self.discovery.discover()
+        shard = HashRing(3).get_shard(('staging', 'fake-region-0', 'fake-region-0-elb-3'))
+        received = self.received()
+        self.assertIn(['fake-region-0-elb-3', dict(LoadBalancerName='fake-region-0-elb-3')],
+                      received[shard][1]['fake-region-0'])
+
+    def test_shard_entities(self):
+        self.discovery.discover()
+        entities = ShardEntities(self.discovery.queues[0])
+        region = self.fake_aws[0].regions[0]
+        self.assertEqual(entities.get(0, region),
+                         [SnapshotEntity(entity_name, dimensions)
+                          for entity_name, dimensions in self.discovery.topologies[0][0].get(region.name, [])])
+
+        # The latest entities sent are used.
+        self.fake_aws[0].elb.load_balancers_per_region = 0
+        self.discovery.discover()
+        self.assertEqual(self.discovery.topologies[0][0], dict())
+        # The queue's feeder thread delivers them shortly.
+        deadline = time.time() + 5
+        while entities.get(0, region) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(entities.get(0, region), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import unittest
+
+from boundary_aws_plugin.sharding import HashRing
+
+KEYS = [('account-%d' % (i % 3), 'region-%d' % (i % 7), 'elb-%d' % i) for i in range(10000)]
+
+
+class HashRingTest(unittest.TestCase):
+    def test_stable(self):
+        ring = HashRing(4)
+        shards = [ring.get_shard(key) for key in KEYS]
+        # The same on every ring, whatever other keys there are.
+        other_ring = HashRing(4)
+        self.assertEqual([other_ring.get_shard(key) for key in reversed(KEYS)], shards[::-1])
+        self.assertEqual(ring.get_shard('\0'.join(KEYS[0])), shards[0])
+        self.assertEqual(HashRing(1).get_shard(KEYS[0]), 0)
+
+    def test_distribution(self):
+        ring = HashRing(4)
+        counts = collections.Counter(ring.get_shard(key) for key in KEYS)
+        self.assertEqual(sorted(counts), [0, 1, 2, 3])
+        for count in counts.values():
+            self.assertLess(abs(count - len(KEYS) / 4), len(KEYS) / 4 * 0.2)
+
+    def test_adding_a_shard(self):
+        before, after = HashRing(4), HashRing(5)
+        moved = [key for key in KEYS if before.get_shard(key) != after.get_shard(key)]
+        # Only keys taken by the new shard move, about a fifth of them.
+        self.assertEqual(set(after.get_shard(key) for key in moved), set([4]))
+        self.assertLess(abs(len(moved) - len(KEYS) / 5), len(KEYS) / 5 * 0.25)
+
+    def test_removing_a_shard(self):
+        before, after = HashRing(5), HashRing(4)
+        # Only the keys of the removed shard move, spread over the others.
+        for key in KEYS:
+            if before.get_shard(key) != 4:
+                self.assertEqual(after.get_shard(key), before.get_shard(key))
+        self.assertEqual(set(after.get_shard(key) for key in KEYS if before.get_shard(key) == 4), set([0, 1, 2, 3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
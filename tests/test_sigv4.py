@@ -0,0 +1,49 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import unittest
+
+from boundary_aws_plugin import sigv4
+
+# The example credentials of the AWS Signature Version 4 test suite and documentation.
+ACCESS_KEY_ID = 'AKIDEXAMPLE'
+SECRET_ACCESS_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+AMZ_DATE = '20150830T123600Z'
+
+
+class Sigv4Test(unittest.TestCase):
+    def test_get_vanilla(self):
+        # get-vanilla from the Signature Version 4 test suite.
+        headers = {'Host': 'example.amazonaws.com', 'X-Amz-Date': AMZ_DATE}
+        self.assertEqual(
+            sigv4.authorization('GET', 'https://example.amazonaws.com/', headers, b'', 'us-east-1', 'service',
+                                ACCESS_KEY_ID, SECRET_ACCESS_KEY),
+            'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, '
+            'SignedHeaders=host;x-amz-date, '
+            'Signature=5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b8aae1d763fbf31')
+
+    def test_query_parameters_are_sorted(self):
+        # get-vanilla-query-order-key-case from the Signature Version 4 test suite.
+        headers = {'Host': 'example.amazonaws.com', 'X-Amz-Date': AMZ_DATE}
+        self.assertTrue(
+            sigv4.authorization('GET', 'https://example.amazonaws.com/?Param2=value2&Param1=value1', headers, b'',
+                                'us-east-1', 'service', ACCESS_KEY_ID, SECRET_ACCESS_KEY).endswith(
+                'Signature=b97d918cfa904a5beff61c982a1b6f458b799221646efd99d3219ec94cdf2500'))
+
+    def test_documented_example(self):
+        # The IAM ListUsers request used as the example in the AWS General Reference.
+        url = 'https://iam.amazonaws.com/?Action=ListUsers&Version=2010-05-08'
+        headers = sigv4.sign_request('GET', url,
+                                     {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'}, b'',
+                                     'us-east-1', 'iam', ACCESS_KEY_ID, SECRET_ACCESS_KEY,
+                                     now=datetime.datetime(2015, 8, 30, 12, 36))
+        self.assertEqual(headers['Host'], 'iam.amazonaws.com')
+        self.assertEqual(headers['X-Amz-Date'], AMZ_DATE)
+        self.assertEqual(
+            headers['Authorization'],
+            'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/iam/aws4_request, '
+            'SignedHeaders=content-type;host;x-amz-date, '
+            'Signature=5d672d79c15b13162d9279b0855cfba6789a8edb4c82c400e06b5924a6f2b5d7')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import io
+import os
+import pickle
+import unittest
+
+from boundary_aws_plugin import status_store
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+
+
+def record(n, minutes=0):
+    return ('us-east-1', 'elb-%d' % n, 'AWS_ELB_REQUEST_COUNT'), (T0 + datetime.timedelta(minutes=minutes), float(n),
+                                                                  'Sum')
+
+
+class StatusStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.basename = 'test-status-store-%d' % os.getpid()
+        self.filename = status_store.status_store_filename(self.basename)
+        self.compaction_min_stale_records = status_store.COMPACTION_MIN_STALE_RECORDS
+        self.replace_file = status_store.replace_file
+
+    def tearDown(self):
+        status_store.COMPACTION_MIN_STALE_RECORDS = self.compaction_min_stale_records
+        status_store.replace_file = self.replace_file
+        for filename in (self.filename, self.filename + '.tmp', self.filename + '.corrupt'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def read_lines(self):
+        with io.open(self.filename, 'r', encoding='utf-8') as f:
+            return f.read().split('\n')
+
+    def test_round_trip(self):
+        data = dict(record(n) for n in range(3))
+        status_store.save_status_store(self.basename, data)
+        self.assertEqual(self.read_lines()[0], status_store.STATUS_STORE_HEADER)
+        store = status_store.load_status_store(self.basename)
+        self.assertEqual(store, data)
+        self.assertEqual(store.file_records, 3)
+
+    def test_truncated_record(self):
+        status_store.save_status_store(self.basename, dict(record(n) for n in range(3)))
+        with io.open(self.filename, 'a', encoding='utf-8') as f:
+            f.write('us-east-1\telb-3\tAWS_ELB_REQ')
+
+        # The partial record is ignored, and the file rewritten by the next save rather than appended to.
+        store = status_store.load_status_store(self.basename)
+        self.assertEqual(store, dict(record(n) for n in range(3)))
+        self.assertIsNone(store.file_records)
+        store.update([record(3)])
+        store.save()
+        self.assertEqual(len(self.read_lines()), 1 + 4 + 1)
+        self.assertEqual(status_store.load_status_store(self.basename), dict(record(n) for n in range(4)))
+
+    def test_malformed_record(self):
+        status_store.save_status_store(self.basename, dict(record(n) for n in range(2)))
+        with io.open(self.filename, 'a', encoding='utf-8') as f:
+            f.write('us-east-1\telb-2\tAWS_ELB_REQUEST_COUNT\tnot a time\t1.0\tSum\n')
+        self.assertEqual(status_store.load_status_store(self.basename), dict(record(n) for n in range(2)))
+
+    def test_compaction(self):
+        status_store.COMPACTION_MIN_STALE_RECORDS = 4
+        store = status_store.load_status_store(self.basename)
+        store.update(record(n) for n in range(5))
+        store.save()
+
+        # Updates are appended until there are more superseded records than both the minimum and the live ones.
+        for minutes in range(1, 6):
+            store.update([record(0, minutes)])
+            store.save()
+            self.assertEqual(len(self.read_lines()), 1 + 5 + minutes + 1)
+        store.update([record(0, 6)])
+        store.save()
+        self.assertEqual(len(self.read_lines()), 1 + 5 + 1)
+        self.assertEqual(store.file_records, 5)
+
+        # The last record of a metric wins.
+        loaded = status_store.load_status_store(self.basename)
+        self.assertEqual(loaded, store)
+        self.assertEqual(loaded[record(0)[0]], record(0, 6)[1])
+
+    def test_compaction_replaces_atomically(self):
+        status_store.save_status_store(self.basename, dict(record(n) for n in range(3)))
+
+        def fail(src, dst):
+            raise OSError("simulated crash")
+        status_store.replace_file = fail
+        store = status_store.load_status_store(self.basename)
+        store.update([record(3)])
+        with self.assertRaises(OSError):
+            store.compact()
+        # The old file is untouched until the new one is complete.
+        self.assertEqual(status_store.load_status_store(self.basename), dict(record(n) for n in range(3)))
+
+        status_store.replace_file = self.replace_file
+        store.compact()
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+        self.assertEqual(status_store.load_status_store(self.basename), dict(record(n) for n in range(4)))
+
+    def test_legacy_pickle(self):
+        data = dict(record(n) for n in range(3))
+        with open(self.filename, 'wb') as f:
+            pickle.dump(data, f)
+
+        store = status_store.load_status_store(self.basename)
+        self.assertEqual(store, data)
+        # Converted to the new format by the next save.
+        store.save()
+        self.assertEqual(self.read_lines()[0], status_store.STATUS_STORE_HEADER)
+        self.assertEqual(status_store.load_status_store(self.basename), data)
+
+    def test_unreadable_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'\x80\x03not a status store')
+
+        self.assertEqual(status_store.load_status_store(self.basename), dict())
+        # Kept for inspection, out of the way of the next save.
+        self.assertFalse(os.path.exists(self.filename))
+        with open(self.filename + '.corrupt', 'rb') as f:
+            self.assertEqual(f.read(), b'\x80\x03not a status store')
+
+
+if __name__ == '__main__':
+    unittest.main()
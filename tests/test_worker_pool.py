@@ -0,0 +1,68 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import threading
+import time
+import unittest
+
+from boundary_aws_plugin import worker_pool
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.threads = worker_pool._threads
+        worker_pool._threads = worker_pool.ThreadCache()
+
+    def tearDown(self):
+        worker_pool._threads = self.threads
+
+    def thread_of(self, item):
+        # Long enough for every worker to get an item
+        time.sleep(0.05)
+        return threading.current_thread().ident
+
+    def wait_for_idle(self, count):
+        # Workers only go back to waiting shortly after the call that used them has returned.
+        deadline = time.time() + 5
+        while worker_pool._threads.idle != count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(worker_pool._threads.idle, count)
+
+    def test_reuses_threads(self):
+        first = set(worker_pool.map_concurrently(self.thread_of, range(4), max_workers=4))
+        self.assertEqual(len(first), 4)
+        self.wait_for_idle(4)
+        self.assertEqual(set(worker_pool.map_concurrently(self.thread_of, range(4), max_workers=4)), first)
+        self.wait_for_idle(4)
+        self.assertEqual(set(worker_pool.imap_unordered(self.thread_of, range(4), max_workers=4)), first)
+
+    def test_nested_calls(self):
+        # Every outer item waits for inner items, which still get threads of their own.
+        def outer(item):
+            return sum(worker_pool.map_concurrently(lambda inner: inner * item, range(3), max_workers=3))
+        self.assertEqual(sorted(worker_pool.imap_unordered(outer, range(4), max_workers=4)), [0, 3, 6, 9])
+
+    def test_exceptions(self):
+        def fail_on_odd(item):
+            if item % 2:
+                raise ValueError(item)
+            return item
+        results = worker_pool.map_concurrently(fail_on_odd, range(4), max_workers=4, return_exceptions=True)
+        self.assertEqual([result if isinstance(result, int) else str(result) for result in results], [0, '1', 2, '3'])
+        with self.assertRaises(ValueError):
+            worker_pool.map_concurrently(fail_on_odd, range(4), max_workers=4)
+
+    def test_idle_threads_exit(self):
+        worker_pool._threads.idle_timeout = 0.05
+        workers = set(worker_pool.map_concurrently(self.thread_of, range(2), max_workers=2))
+
+        def alive():
+            return workers & set(t.ident for t in threading.enumerate())
+        deadline = time.time() + 5
+        while alive() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(alive())
+        self.assertEqual(worker_pool._threads.idle, 0)
+        self.assertEqual(worker_pool.map_concurrently(lambda item: item, range(3), max_workers=3), [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()